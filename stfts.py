@@ -1,61 +1,162 @@
 import glob
+import hashlib
+import json
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import librosa
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "system"))
+from specstore import SpectrogramStore
+from onsetindex import compile_onsets
+
 """
 Calculate and save magnitude STFTs of all audio files as numpy matrices,
-in order to save computation time during optimization.
+in order to save computation time during optimization. Besides the per-file
+-{window}.npy files, every STFT is written to the memory-mapped spectrogram
+store of its window size (see system/specstore.py), from which the system reads them.
+
+Every WAV file is decoded once and all window sizes are computed from that decode,
+with the files spread over a pool of processes. A manifest in the data folder records
+the source file and STFT parameters of every output, and files whose source and
+parameters have not changed since the last run are skipped. The ground-truth onsets
+of the drum loops are compiled into the onset index as well (see system/onsetindex.py).
 """
 
 EPS = 2.0 ** -52
 
-def stft_magnitude(wav_file, window):
+# everything besides the window size that determines the STFT outputs
+STFT_PARAMS = {"sr": 22050, "hop": "window/2", "window": "hann", "center": True, "pad_mode": "constant", "eps": EPS}
+MANIFEST = "stft-manifest.json"
+
+data_folder = "/Users/juliavaghy/Desktop/0--data"
+windows = [256, 1024, 2048, 4096]
+workers = None  # number of processes, defaults to the number of cores
+# type of the stored spectrograms; librosa decodes to float32, and storing float64 would
+# double the disk space and I/O without adding information (see system/precision.py)
+dtype = np.float32
+
+def stft_magnitude(x, window, dtype=np.float32):
     hop = int(window / 2)
-    x, Fs = librosa.load(wav_file)
     X = librosa.stft(x, n_fft=window, hop_length=hop, win_length=window, window='hann', center=True, pad_mode='constant')
-    Y = np.abs(X) + EPS
+    Y = np.abs(X).astype(dtype) + EPS
     return Y
 
-data_folder = "/Users/juliavaghy/Desktop/0--data"
-windows = [256, 1024, 2048, 4096]
-for window in windows:
-    os.chdir(os.path.join(data_folder, "drum-loops"))
-    sample_directories = [item for item in os.listdir() if os.path.isdir(item)]
-    for sample_directory in sample_directories:
-        os.chdir(os.path.join(data_folder, "drum-loops", sample_directory))
-        make_path = lambda f : os.path.join(data_folder, "drum-loops", sample_directory, f)
-        wav_files = glob.glob("*.wav")
-        if len(wav_files) != 1:
+def list_wav_files(data_folder):
+    """
+        All recordings whose STFTs the system uses: the drum loops, the kit instruments
+        and the background noises.
+    """
+    wav_files = []
+    drum_loops = os.path.join(data_folder, "drum-loops")
+    for sample_directory in sorted(os.listdir(drum_loops)):
+        if not os.path.isdir(os.path.join(drum_loops, sample_directory)):
+            continue
+        sample_wavs = glob.glob(os.path.join(drum_loops, sample_directory, "*.wav"))
+        if len(sample_wavs) != 1:
             print(f"There should be a single WAV file in {sample_directory}")
             continue
-        f_name = wav_files[0]
-        wav_file = os.path.join(data_folder, "drum-loops", sample_directory, f_name)
-        stft = stft_magnitude(wav_file, window)
-        np.save(f"{f_name[:-4]}-{window}.npy", stft)
-
-    os.chdir(os.path.join(data_folder, "kits"))
-    kits = [item for item in os.listdir() if os.path.isdir(item)]
-    for kit in kits:
-        os.chdir(os.path.join(data_folder, "kits", kit, "instruments"))
-        instruments = glob.glob("*.wav")
-        for instrument in instruments:
-            wav_file = os.path.join(data_folder, "kits", kit, "instruments", instrument)
-            stft = stft_magnitude(wav_file, window)
-            np.save(f"{instrument[:-4]}-{window}.npy", stft)
-
-    os.chdir(os.path.join(data_folder, "background"))
-    noises = glob.glob("*.wav")
-    for noise in noises:
-        wav_file = os.path.join(data_folder, "background", noise)
-        stft = stft_magnitude(wav_file, window)
-        print(stft.shape)
-        np.save(f"{noise[:-4]}-{window}.npy", stft)
-
-    os.chdir(os.path.join(data_folder, "background-loud"))
-    noises = glob.glob("*.wav")
-    for noise in noises:
-        wav_file = os.path.join(data_folder, "background-loud", noise)
-        stft = stft_magnitude(wav_file, window)
-        print(stft.shape)
-        np.save(f"{noise[:-4]}-{window}.npy", stft)
\ No newline at end of file
+        wav_files += sample_wavs
+    wav_files += sorted(glob.glob(os.path.join(data_folder, "kits", "*", "instruments", "*.wav")))
+    wav_files += sorted(glob.glob(os.path.join(data_folder, "background", "*.wav")))
+    wav_files += sorted(glob.glob(os.path.join(data_folder, "background-loud", "*.wav")))
+    return wav_files
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def compute_stfts(wav_file, windows, dtype=np.float32):
+    """
+        Decode a recording once and save its magnitude STFT for every window size.
+
+        Returns:
+            stfts (dict of int: np.ndarray) : The STFT of each window size.
+            timings (dict of str: float) : Seconds spent decoding and computing the STFTs.
+    """
+    start = time.perf_counter()
+    x, Fs = librosa.load(wav_file, sr=STFT_PARAMS["sr"])
+    decoded = time.perf_counter()
+    stfts = {}
+    for window in windows:
+        stfts[window] = stft_magnitude(x, window, dtype)
+        np.save(f"{wav_file[:-4]}-{window}.npy", stfts[window])
+    timings = {"decode": decoded - start, "stft": time.perf_counter() - decoded}
+    return stfts, timings
+
+def load_manifest(data_folder):
+    path = os.path.join(data_folder, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+def save_manifest(data_folder, manifest):
+    path = os.path.join(data_folder, MANIFEST)
+    with open(path + ".tmp", 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def missing_windows(wav_file, entry, windows, stores, dtype=np.float32):
+    """
+        Window sizes whose STFT of the recording has to be (re)computed. The manifest
+        entry is trusted if the file's size and modification time, or else its hash,
+        and the STFT parameters are unchanged, and the outputs still exist in dtype.
+    """
+    if entry is None or entry["params"] != STFT_PARAMS:
+        return list(windows)
+    stat = os.stat(wav_file)
+    if (entry["size"], entry["mtime"]) != (stat.st_size, stat.st_mtime):
+        if entry["sha1"] != file_hash(wav_file):
+            return list(windows)
+        entry["mtime"] = stat.st_mtime
+    return [window for window in windows
+            if window not in entry["windows"]
+            or wav_file not in stores[window]
+            or stores[window].index[stores[window].key(wav_file)]["dtype"] != np.dtype(dtype).str
+            or not os.path.exists(f"{wav_file[:-4]}-{window}.npy")]
+
+def precompute(data_folder, windows, workers=None, dtype=np.float32):
+    """
+        Compute the STFTs of every recording in data_folder for every window size,
+        skipping those already up to date, and report the time spent per file.
+    """
+    manifest = load_manifest(data_folder)
+    stores = {window: SpectrogramStore(data_folder, window) for window in windows}
+    wav_files = list_wav_files(data_folder)
+    jobs = {}
+    for wav_file in wav_files:
+        key = stores[windows[0]].key(wav_file)
+        todo = missing_windows(wav_file, manifest.get(key), windows, stores, dtype)
+        if len(todo) > 0:
+            jobs[wav_file] = todo
+    print(f"{len(jobs)} of {len(wav_files)} files to process, the others are up to date")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(compute_stfts, wav_file, todo, dtype): wav_file for wav_file, todo in jobs.items()}
+        for future in as_completed(futures):
+            wav_file = futures[future]
+            stfts, timings = future.result()
+            for window, stft in stfts.items():
+                stores[window].add(wav_file, stft)
+            key = stores[windows[0]].key(wav_file)
+            stat = os.stat(wav_file)
+            entry = manifest.get(key)
+            previous = entry["windows"] if entry is not None and entry["params"] == STFT_PARAMS else []
+            manifest[key] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": file_hash(wav_file),
+                             "params": STFT_PARAMS, "windows": sorted(set(previous) | set(stfts))}
+            save_manifest(data_folder, manifest)
+            print(f"{key}: decode {timings['decode']:.2f} s, {len(stfts)} STFTs {timings['stft']:.2f} s")
+    # also keeps the modification times of touched but unchanged files
+    save_manifest(data_folder, manifest)
+    print(f"Done in {time.perf_counter() - start:.2f} s")
+
+if __name__ == "__main__":
+    precompute(data_folder, windows, workers, dtype)
+    compile_onsets(data_folder)
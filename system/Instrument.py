@@ -2,7 +2,14 @@ import matplotlib.pyplot as plt
 import librosa
 import numpy as np
 from scipy import signal
-import random
+
+from specstore import load_spectrogram
+from onsets import local_average, TOLERANCE
+from precision import get_dtype
+from filterbank import compress_frequencies
+from templatebank import get_template_bank, stack_patterns
+from noisebank import get_noise_bank
+from instrumentation import span
 
 EPS = 2.0 ** -52
 
@@ -15,15 +22,19 @@ class Instrument:
             _idx (int) : Allocated instrument index in the sample, to be used for plotting.
             _wav_file (str) : Path to the drum instrument's isolated recording.
             _params (dict) : Dictionary of parameters, defined in main.py.
+            _sample (str) : Name of the sample the instrument is read for, which seeds its noise segment.
     """
-    def __init__(self, _midi_note, _color, _idx, _wav_file, _params):
+    def __init__(self, _midi_note, _color, _idx, _wav_file, _params, _sample=None):
         self.midi_note = _midi_note
         self.color = _color
         self.idx = _idx
         self.midi_onsets = [] # tick
+        self.midi_onset_seconds = np.zeros(0)
         self.wav_file = _wav_file
         self.params = _params
-        self.init_template()
+        self.sample = _sample
+        with span("instrument templates"):
+            self.init_template()
         self.tp_count = 0    # true positives
         self.fp_count =0     # false positives
         self.fn_count = 0    # false negatives
@@ -49,35 +60,44 @@ class Instrument:
 
     def set_tick_duration(self, tick_duration):
         self.tick_duration = tick_duration
+        self.midi_onset_seconds = np.array(self.midi_onsets) * self.tick_duration
 
     def add_midi_onset(self, onset):
         self.midi_onsets.append(onset)
 
+    def set_midi_onsets(self, ticks, seconds):
+        """
+            Set the instrument's MIDI onsets at once, as sorted arrays of ticks and seconds,
+            after set_tick_duration.
+        """
+        self.midi_onsets = ticks
+        self.midi_onset_seconds = seconds
+
     def init_template(self):
         """
             Construct one-dimensional template to be used in initializing the NMF template matrix.
+            Templates computed before for the same recording and settings are taken from the
+            template bank, see templatebank.py.
         """
-        npy_file = self.wav_file[:-4] + f'-{self.params["window"]}.npy'
-        self.Y = np.load(npy_file, allow_pickle=True)
+        bank = get_template_bank()
+        banked = bank.get(self.wav_file, self.params, self.sample)
+        if banked is not None:
+            self.Y, self.template = banked
+            return
+        # converted to params["precision"] by the first operation that writes a new array, see load_spectrogram
+        self.Y = load_spectrogram(self.wav_file, self.params["window"])
         if self.params["noise"] != "None":
             self.add_noise()
-        self.Y = np.log(1 + 10 * self.Y)
+        self.Y = compress_frequencies(self.Y, self.params)
+        self.Y = np.log(1 + np.multiply(10, self.Y, dtype=get_dtype(self.params)))
         self.template = np.mean(self.Y, axis=1)
+        self.Y, self.template = bank.put(self.wav_file, self.params, self.Y, self.template, self.sample)
 
     def add_noise(self):
         """
-            Superpose the instrument audio sample with a randomly chosen noise segment.
+            Superpose the instrument audio sample with its noise segment, see noisebank.py.
         """
-        noise_dir = "background-loud"
-        if self.params["noise-lvl"] == 1:
-            noise_dir = "background"
-        noise_file = f'/Users/juliavaghy/Desktop/0--data/{noise_dir}/{self.params["noise"]}.wav'
-        print(noise_file)
-        npy_file = noise_file[:-4] + f'-{self.params["window"]}.npy'
-        noise = np.load(npy_file, allow_pickle=True)
-        start = random.randint(0, noise.shape[1] - self.Y.shape[1] - 1)
-        end = start + self.Y.shape[1]
-        self.Y = self.Y + noise[:, start:end]
+        self.Y = get_noise_bank().mix(self.Y, self.params, self.sample, self.wav_file)
 
     def template_2D(self, T, plot=False):
         """
@@ -85,11 +105,7 @@ class Instrument:
             Args:
                 T (int) : num of timeframes in the 2D template (zero-pad to this length)
         """
-        K = self.Y.shape[0]
-        pad_len = T - self.Y.shape[1]
-        template2D = self.Y
-        for _ in range(pad_len): # zero padding
-            template2D = np.append(template2D, np.zeros((K, 1)) + EPS, axis=1)
+        template2D = stack_patterns([self.Y], self.Y.dtype, T)[:, 0, :] if T > self.Y.shape[1] else self.Y
 
         if plot:
             T_coef = np.arange(template2D.shape[1]) * self.params["hop"] / self.Fs
@@ -137,16 +153,17 @@ class Instrument:
         Fs_feature = self.Fs / self.params["hop"]
         T_coef = np.arange(len(self.activations)) / Fs_feature
         
-        ## Equation 2.14 ##
-        novelty = half_wave(np.append(np.diff(self.activations),[0]))
-        
-        ## Equation 2.16 ##
-        enhanced_novelty = half_wave(novelty - self.local_avg(novelty))
+        with span("find_onsets"):
+            ## Equation 2.14 ##
+            novelty = half_wave(np.append(np.diff(self.activations),[0]))
+
+            ## Equation 2.16 ##
+            enhanced_novelty = half_wave(novelty - self.local_avg(novelty))
 
-        ## Equation 2.17 ##
-        height = max(enhanced_novelty)/self.THETA
-        peaks, properties = signal.find_peaks(enhanced_novelty, height=height)
-        self.nmf_onsets = T_coef[peaks]
+            ## Equation 2.17 ##
+            height = max(enhanced_novelty)/self.THETA
+            peaks, properties = signal.find_peaks(enhanced_novelty, height=height)
+            self.nmf_onsets = T_coef[peaks]
 
         ## Figure 2.3 ##
         if plot:
@@ -165,33 +182,31 @@ class Instrument:
 
     ## Equation 2.15 ##
     def local_avg(self, arr):
-        avg_window = 3
-        smoothed = np.zeros(arr.shape)
-        padded = np.append(np.append([0]*avg_window, arr), [0]*(avg_window+1))
-        for i in range(avg_window, len(arr)+avg_window):
-            smoothed[i-avg_window] = np.mean(padded[i-avg_window:i+avg_window+1])
-        return smoothed
+        return local_average(arr, avg_window=3)
+
+    def set_onsets(self, nmf_onsets):
+        self.nmf_onsets = nmf_onsets
 
     def evaluate(self):
         """
             Find the number of true positives, false positives, and false negatives.
-            See Section 2.5.
+            See Section 2.5. Sample.evaluate matches all instruments at once, see onsets.match_onsets.
         """
         nmf_idx = 0
-        for midi_idx in range(len(self.midi_onsets)):
+        for midi_idx in range(len(self.midi_onset_seconds)):
             if nmf_idx >= len(self.nmf_onsets):
-                self.fn_count += len(self.midi_onsets) - midi_idx
+                self.fn_count += len(self.midi_onset_seconds) - midi_idx
                 break
-            onset_sec = self.midi_onsets[midi_idx] * self.tick_duration
+            onset_sec = self.midi_onset_seconds[midi_idx]
             distance = abs(onset_sec - self.nmf_onsets[nmf_idx])
             while (nmf_idx+1 < len(self.nmf_onsets)) and (abs(onset_sec - self.nmf_onsets[nmf_idx+1]) < distance):
                 self.fp_count += 1
                 nmf_idx += 1
                 distance = abs(onset_sec - self.nmf_onsets[nmf_idx])
-            if distance <= 0.05:
+            if distance <= TOLERANCE:
                 self.tp_count += 1
                 nmf_idx += 1
             else:
                 self.fn_count += 1
         if nmf_idx < len(self.nmf_onsets)-1:
-            self.fp_count += len(self.nmf_onsets) - nmf_idx - 1
\ No newline at end of file
+            self.fp_count += len(self.nmf_onsets) - nmf_idx - 1
@@ -1,13 +1,12 @@
 import matplotlib.pyplot as plt
-import mido
-from mido import MidiFile
-from mido import Message
 
 from Instrument import Instrument
+from onsetindex import get_onsets
 
 class MIDILabels:
     """
-        A class storing the MIDI labels of a drum loop sample.
+        A class storing the MIDI labels of a drum loop sample. The onsets are read from the
+        precompiled onset index if it holds them, and parsed from the MIDI file otherwise, see onsetindex.py.
         Args:
             _midi_file (str): The path to the MIDI file.
             _bpm (int): BPM of the recording.
@@ -24,32 +23,12 @@ class MIDILabels:
     def __init__(self, _midi_file, _bpm, _instrument_codes):
         self.bpm = _bpm
         self.instrument_codes = _instrument_codes
-        mid = MidiFile(_midi_file, clip=True)
-        midi_notes = set()
-        for msg in mid.tracks[0]:
-            if msg.type == 'note_on':
-                midi_notes.add(msg.note) # each drum has its corresponding note in the MIDI file
-        midi_notes = sorted(list(midi_notes))
-        if midi_notes != sorted(list(_instrument_codes.keys())):
+        onsets, self.tick_duration = get_onsets(_midi_file, _bpm)  # each drum has its corresponding note in the MIDI file
+        if sorted(onsets.keys()) != sorted(list(_instrument_codes.keys())):
             raise Exception("MIDI codes don't match those provided in info.txt")
-        ticks = 0
-        time_signature_msg = 0
-        tempo = 0
-        for msg in mid.tracks[0]:
-            if msg.is_meta:
-                if msg.type == 'time_signature':
-                    time_signature_msg = msg
-                elif msg.type == 'set_tempo':
-                    tempo = msg.tempo
-                continue
-            ticks += msg.time
-            if msg.type == 'note_on':
-                self.instrument_codes[msg.note].add_midi_onset(ticks)
-        # TODO: the conversion below might be incorrect
-        #print(self.bpm, mid.length * (120/self.bpm))
-        self.tick_duration = (mid.length/ticks) * (120/self.bpm)
         for midi_note, instrument in self.instrument_codes.items():
             instrument.set_tick_duration(self.tick_duration)
+            instrument.set_midi_onsets(*onsets[midi_note])
 
     def print_onsets(self):
         """
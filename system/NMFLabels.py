@@ -1,11 +1,22 @@
+import os
 import matplotlib.pyplot as plt
 import librosa
 import numpy as np
-import random
 
 from Instrument import Instrument
 from nmfd import *
 from nmf import *
+from multiresolution import multiresolutionNMFD
+from cache import get_cache
+from warmstart import warm_start
+from specstore import load_spectrogram
+from streaming import stream_activations
+from onsets import detect_onsets
+from precision import get_dtype
+from filterbank import compress_frequencies
+from templatebank import get_template_bank
+from noisebank import get_noise_bank
+from instrumentation import span
 
 EPS = 2.0 ** -52
 
@@ -19,55 +30,124 @@ class NMFLabels:
         _instrument_codes (dict of int: str) :
             key : The note of instrument in the MIDI file.
             value : The path to the WAV template of the instrument.
+        _factorize (bool) : If False, the factorization is left to the caller, e.g. to
+            batch.factorize_samples, which then passes the activations to set_activations.
     """
 
-    def __init__(self, _params, _wav_file, _instrument_codes):
+    def __init__(self, _params, _wav_file, _instrument_codes, _factorize=True):
         self.wav_file = _wav_file
         self.instrument_codes = _instrument_codes
         self.params = _params
-        self.calculate_STFT()
-        self.initialize_template_matrix()
-        self.factorize()
+        with span("spectrogram"):
+            self.calculate_STFT()
+        with span("templates"):
+            self.initialize_template_matrix()
+        if _factorize:
+            self.factorize()
         self.Fs = 22050
         
     def initialize_template_matrix(self):
+        """
+            Take the template matrix (NMF) or pattern tensor (NMFD) of the instruments from the
+            template bank, which builds it on first use, see templatebank.py.
+        """
+        instruments = list(self.instrument_codes.values())
         if self.params["nmf_type"] == 'NMF':
-            templates = [instrument.template for midi_note, instrument in self.instrument_codes.items()]
-            self.W_init = np.array(templates, dtype=np.float64).transpose()
+            self.W_init = get_template_bank().templates(instruments, self.params)
         elif self.params["nmf_type"] == 'NMFD':
-            T = max([instrument.Y.shape[1] for midi_note, instrument in self.instrument_codes.items()])
-            templates = [instrument.template_2D(T) for midi_note, instrument in self.instrument_codes.items()]
-            self.P_init = np.array(templates, dtype=np.float64).transpose((1, 0, 2))
+            self.P_init = get_template_bank().templates(instruments, self.params)
 
-    def factorize(self):
+    def templates(self):
+        """
+            The template matrix (NMF) or pattern tensor (NMFD) the factorization starts from.
+        """
         if self.params["nmf_type"] == 'NMF':
-            V_approx, W, H = NMF(V=self.V, W_init=self.W_init, params=self.params)
+            return self.W_init
         elif self.params["nmf_type"] == 'NMFD':
-            V_approx, W, H = NMFD(V=self.V, P_init=self.P_init, params=self.params)
-        i = 0
-        for midi_note, instrument in self.instrument_codes.items():
+            return self.P_init
+
+    def cache_key(self):
+        """
+            Key of this factorization in the process-wide cache, or None if it cannot be cached.
+        """
+        cache = get_cache()
+        if cache is None or self.params.get("initH") == "random":
+            return None
+        return cache.key(self.V, self.templates(), self.params)
+
+    def factorize(self):
+        """
+            Factorize the drum loop, or load the factorization from the cache. With
+            params["warm_start_from"], a cache miss starts from the solution of the predecessor
+            configuration of the same drum loop, see warmstart.py. The number of iterations run is kept in
+            self.iterations (0 for a cache hit, None for a block-wise factorization).
+        """
+        with span("factorize"):
+            W, H = self.run_factorization()
+        self.set_activations(H)
+
+    def run_factorization(self):
+        """
+            The templates and activations (W or P, and H) of factorize, from the cache or the solver.
+        """
+        key = self.cache_key()
+        cached = get_cache().get(key) if key is not None else None
+        self.iterations = 0
+        self.warm_started = False
+        if cached is not None:
+            W, H = cached
+        elif self.params.get("stream_block") is not None:
+            W, H = None, stream_activations(self.V, self.templates(), self.params, block=self.params["stream_block"])
+            self.iterations = None
+        else:
+            start = None
+            if key is not None and self.params.get("warm_start_from"):
+                start = warm_start(get_cache(), self.V, self.templates(), self.params)
+                if start is None:
+                    # the predecessor is not in the cache, so the factorization starts cold and is cached as such
+                    key = get_cache().key(self.V, self.templates(), dict(self.params, warm_start_from=None))
+            templates_start, H_init = start if start is not None else (None, None)
+            self.warm_started = start is not None
+            info = {}
+            if self.params["nmf_type"] == 'NMF':
+                V_approx, W, H = NMF(V=self.V, W_init=self.W_init, params=self.params, H_init=H_init, W_start=templates_start, info=info)
+            elif self.params["nmf_type"] == 'NMFD' and self.params.get("nmfd_levels") is not None:
+                V_approx, W, H = multiresolutionNMFD(self.V, self.P_init, self.params, self.params["nmfd_levels"],
+                                                     H_init=H_init, P_start=templates_start, info=info)
+            elif self.params["nmf_type"] == 'NMFD':
+                V_approx, W, H = NMFD(V=self.V, P_init=self.P_init, params=self.params, H_init=H_init, P_start=templates_start, info=info)
+            self.iterations = info["iterations"]
+        if key is not None and cached is None and W is not None:
+            get_cache().put(key, W, H)
+        return W, H
+
+    def set_activations(self, H):
+        """
+            Pass each instrument its activation row in H and its onsets, detected on all rows at once.
+        """
+        instruments = list(self.instrument_codes.values())
+        with span("onsets"):
+            onsets = detect_onsets(H[:len(instruments)], instruments[0].THETA, self.params["hop"])
+        for i, instrument in enumerate(instruments):
             instrument.set_activation(H[i])
-            instrument.find_onsets()
-            i+=1
+            instrument.set_onsets(onsets[i])
 
     def calculate_STFT(self):
-        npy_file = self.wav_file[:-4] + f'-{self.params["window"]}.npy'
-        self.V = np.load(npy_file, allow_pickle=True)
+        # the stored spectrogram is converted to params["precision"] by the first operation
+        # that writes a new array, see load_spectrogram
+        self.V = load_spectrogram(self.wav_file, self.params["window"])
         if self.params["noise"] != "None":
             self.add_noise()
-        self.V = np.log(1 + 10 * self.V)
+        self.V = compress_frequencies(self.V, self.params)
+        self.V = np.log(1 + np.multiply(10, self.V, dtype=get_dtype(self.params)))
 
     def add_noise(self):
-        noise_dir = "background-loud"
-        if self.params["noise-lvl"] == 1:
-            noise_dir = "background"
-        noise_file = f'/Users/juliavaghy/Desktop/0--data/{noise_dir}/{self.params["noise"]}.wav'
-        npy_file = noise_file[:-4] + f'-{self.params["window"]}.npy'
-        noise = np.load(npy_file, allow_pickle=True)
-        start = random.randint(0, noise.shape[1] - self.V.shape[1] - 1)
-        end = start + self.V.shape[1]
-        self.V = self.V + noise[:, start:end]
-        
+        """
+            Superpose the drum loop with its noise segment, see noisebank.py.
+        """
+        sample = os.path.basename(os.path.dirname(self.wav_file))
+        self.V = get_noise_bank().mix(self.V, self.params, sample, self.wav_file)
+
     def plot_recording_spectrum(self):
         T_coef = np.arange(self.V.shape[1]) * self.params["hop"] / self.Fs
         F_coef = np.arange(self.V.shape[0]) * self.Fs / self.params["window"]
@@ -1,26 +1,72 @@
+import threading
+
 from MIDILabels import MIDILabels
 from NMFLabels import NMFLabels
 from Instrument import Instrument
+from instrumentation import span
+from onsets import evaluate_samples
+
+# colors allocated to the instruments of a sample, in the order of its info.txt
+COLORS = ["blue", "green", "cyan", "magenta", "yellow", "black", "orange"]
 
 class Sample:
     """
-        A class representing a single test sample.
+        A class representing a single test sample. It is lazy: its instruments, MIDI labels and
+        NMF labels are only loaded (and factorized) when one of them, or evaluate, is first
+        accessed, so a dataset can be listed without reading or factorizing it.
 
         Args:
+            _params (dict) : Dictionary of parameters, defined in main.py.
             _dir (str) : The name of the sample's directory.
             _bpm (int): BPM of the recording.
             _midi_file (str) : The path to the MIDI file.
             _wav_file (str) : The path to the WAV recording.
-            _instrument_codes (dict of int: Instrument) :
-                key : the note of the instrument in the MIDI file.
-                value : The instrument object.
+            _instruments (list of (int, str)) : The MIDI note and the path to the WAV recording
+                of every instrument, in the order of the sample's info.txt.
+            _factorize (bool) : If False, the drum loop is not factorized on loading, see NMFLabels.
     """
 
-    def __init__(self, _params, _dir, _bpm, _midi_file, _wav_file, _instrument_codes):
+    def __init__(self, _params, _dir, _bpm, _midi_file, _wav_file, _instruments, _factorize=True):
+        self.params = _params
         self.dir = _dir
-        self.instrument_codes = _instrument_codes
-        self.midi_labels = MIDILabels(_midi_file, _bpm, _instrument_codes)
-        self.nmf_labels = NMFLabels(_params, _wav_file, _instrument_codes)
+        self.bpm = _bpm
+        self.midi_file = _midi_file
+        self.wav_file = _wav_file
+        self.instruments = _instruments
+        self.factorize = _factorize
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+            Load the instruments and labels of the sample, and factorize it unless _factorize is False.
+            Only the first call loads; it returns the sample.
+        """
+        with self.lock:
+            if self.loaded is None:
+                instrument_codes = {}
+                for idx, (midi_note, instrument_wav) in enumerate(self.instruments):
+                    instrument_codes[midi_note] = Instrument(midi_note, COLORS[idx], idx, instrument_wav, self.params, self.dir)
+                with span("midi"):
+                    midi_labels = MIDILabels(self.midi_file, self.bpm, instrument_codes)
+                nmf_labels = NMFLabels(self.params, self.wav_file, instrument_codes, self.factorize)
+                self.loaded = (instrument_codes, midi_labels, nmf_labels)
+        return self
+
+    @property
+    def instrument_codes(self):
+        """
+            dict of int: Instrument : key : the note of the instrument in the MIDI file, value : The instrument object.
+        """
+        return self.load().loaded[0]
+
+    @property
+    def midi_labels(self):
+        return self.load().loaded[1]
+
+    @property
+    def nmf_labels(self):
+        return self.load().loaded[2]
 
     def __str__(self):
         return self.dir
@@ -33,11 +79,17 @@ class Sample:
         tp_count = 0
         fp_count = 0
         fn_count = 0
-        for midi_note, instrument in self.instrument_codes.items():
-            instrument.evaluate()
-            tp_count += instrument.tp_count
-            fp_count += instrument.fp_count
-            fn_count += instrument.fn_count
+        instrument_codes = self.instrument_codes
+        with span("evaluate"):
+            # one match_onsets call over all instruments, see onsets.evaluate_samples
+            counts, scores = evaluate_samples([self])
+            for instrument, (tp, fp, fn) in zip(instrument_codes.values(), counts[0]):
+                instrument.tp_count += int(tp)
+                instrument.fp_count += int(fp)
+                instrument.fn_count += int(fn)
+                tp_count += instrument.tp_count
+                fp_count += instrument.fp_count
+                fn_count += instrument.fn_count
         f_measure = (2*tp_count) / (2*tp_count + fp_count + fn_count)
         precision = tp_count / (tp_count + fp_count)
         recall = tp_count / (tp_count + fn_count)
@@ -0,0 +1,332 @@
+import numpy as np
+
+from nmfd import shiftStack, shiftSum, convModel, selectBackend
+from cache import get_cache
+from convergence import Convergence, get_solver
+from precision import get_dtype, eps
+from instrumentation import span
+
+EPS = 2.0 ** -52
+
+def batchNMF(Vs, W_inits, params, L = 1000, threshold = 0.001):
+    """
+        Non-Negative Matrix Factorization of several spectrograms at once, see nmf.NMF.
+        The spectrograms are zero-padded to a common number of time frames and
+        the templates to a common number of components, so that every multiplicative
+        update is one batched matrix product. A sample drops out of the batch as soon
+        as it has converged.
+
+        Args:
+            Vs (list of np.ndarray) : S magnitude spectrograms of size K x N_s.
+            W_inits (list of np.ndarray) : S template matrices of size K x R_s.
+            params (dict) : Dictionary of parameters, defined in main.py.
+            L (int) : The maximum number of NMF iterations, unless params["max_iter"] is set.
+            threshold (float) : Convergence threshold, applied per sample as in nmf.NMF.
+                The change criteria of convergence.Convergence are supported, "kl" is not.
+
+        Returns:
+            results (list of tuple) : For each sample, (V_approx, W, H) with the same sizes
+                as returned by nmf.NMF.
+    """
+    convergence = batchConvergence(params, L, threshold)
+    L = convergence.L
+    dtype = get_dtype(params)
+    EPS = eps(dtype)
+    V, lengths = stackSpectrograms(Vs, dtype)
+    S, K, N = V.shape
+    R_max = max(W_init.shape[1] for W_init in W_inits)
+    A = params["addedCompW"]
+    R = R_max + A
+
+    # drums of sample s occupy the first R_s columns, the added components the last A
+    W_init = np.zeros((S, K, R), dtype=dtype)
+    for s, W_s in enumerate(W_inits):
+        W_init[s, :, :W_s.shape[1]] = W_s
+    W_init[:, :, R_max:] = 1
+    components = (W_init.sum(axis=1) > 0)[:, :, None]
+    frames = frameMask(lengths, N)
+
+    if ("initH" not in params) or (params["initH"] == "uniform"):
+        H = np.ones((S, R, N), dtype=dtype)
+    elif params["initH"] == "random":
+        H = np.random.rand(S, R, N).astype(dtype)
+    H *= components * frames
+
+    W = W_init.copy()
+    active = np.arange(S)
+    results = [None] * S
+    # the S x K x N ratio is computed in place, fresh allocations of that size cost more than the division
+    Q = np.empty_like(V)
+
+    for iteration in range(L):
+        np.matmul(W, H, out=Q)
+        Q += EPS
+        np.divide(V, Q, out=Q)
+
+        ## Equations 2.3 and 2.4 ##
+        H_prev = H
+        H = H * ((W.transpose(0, 2, 1) @ Q) / (W.sum(axis=1)[:, :, None] + EPS))
+        W_prev = W
+        W = W * ((Q @ H.transpose(0, 2, 1)) / (H.sum(axis=2)[:, None, :] + EPS))
+
+        ## Equation 2.7 ##
+        if params["fixW"] == "fixed":
+            W[:, :, :R_max] = W_init[:, :, :R_max]
+
+        ## Equation 2.5 ##
+        elif params["fixW"] == "semi":
+            alpha = (iteration / L)**params["beta"]
+            W[:, :, :R_max] = (1-alpha) * W_init[:, :, :R_max] + alpha * W[:, :, :R_max]
+
+        converged = np.zeros(len(active), dtype=bool)
+        if convergence.due(iteration):
+            W_diff = convergence.change(W - W_prev, axis=(1, 2))
+            H_diff = convergence.change(H - H_prev, axis=(1, 2))
+            converged = (H_diff < convergence.threshold) & (W_diff < convergence.threshold)
+        if iteration == L - 1:
+            converged[:] = True
+        for b in np.flatnonzero(converged):
+            s = active[b]
+            W_s, H_s = unstackComponents(W[b], H[b], W_inits[s].shape[1], R_max, lengths[b])
+            results[s] = (W_s.dot(H_s), W_s, H_s)
+        if converged.all():
+            break
+        keep = ~converged
+        active, V, W, W_init, H, lengths = active[keep], V[keep], W[keep], W_init[keep], H[keep], lengths[keep]
+        Q = np.empty_like(V)
+
+    return results
+
+def batchNMFD(Vs, P_inits, params, L = 50, threshold = 0.001):
+    """
+        Non-Negative Matrix Factor Deconvolution of several spectrograms at once, see nmfd.NMFD.
+        Spectrograms are zero-padded in time, pattern tensors in components and in
+        template frames; zero template columns and frames stay zero under the
+        multiplicative updates, so every sample follows its own NMFD trajectory.
+
+        Args:
+            Vs (list of np.ndarray) : S magnitude spectrograms of size K x N_s.
+            P_inits (list of np.ndarray) : S pattern tensors of size K x R_s x T_s.
+            params (dict) : Dictionary of parameters, defined in main.py.
+            L (int) : The maximum number of NMFD iterations, unless params["max_iter"] is set.
+            threshold (float) : Convergence threshold, applied per sample as in nmfd.NMFD.
+                The change criteria of convergence.Convergence are supported, "kl" is not.
+
+        Returns:
+            results (list of tuple) : For each sample, (V_approx, P, H) with the same sizes
+                as returned by nmfd.NMFD.
+    """
+    convergence = batchConvergence(params, L, threshold)
+    L = convergence.L
+    dtype = get_dtype(params)
+    EPS = eps(dtype)
+    V, lengths = stackSpectrograms(Vs, dtype)
+    S, K, N = V.shape
+    R_max = max(P_init.shape[1] for P_init in P_inits)
+    T = max(P_init.shape[2] for P_init in P_inits)
+    template_lengths = np.array([P_init.shape[2] for P_init in P_inits])
+    A = params["addedCompW"]
+    R = R_max + A
+
+    P_init = np.zeros((S, K, R, T), dtype=dtype)
+    for s, P_s in enumerate(P_inits):
+        P_init[s, :, :P_s.shape[1], :P_s.shape[2]] = P_s
+        P_init[s, :, R_max:, :P_s.shape[2]] = 1
+    components = (P_init.sum(axis=(1, 3)) > 0)[:, :, None]
+    frames = frameMask(lengths, N)
+
+    if ("initH" not in params) or params["initH"] == "uniform":
+        H = np.ones((S, R, N), dtype=dtype)
+    elif params["initH"] == "random":
+        H = np.random.rand(S, R, N).astype(dtype)
+    H *= components * frames
+
+    if params["beta"] == None:
+        params["beta"] = 4
+        print("beta 4")
+
+    P = P_init.copy()
+    active = np.arange(S)
+    results = [None] * S
+    Q = np.empty_like(V)
+
+    for iteration in range(L):
+        if convergence.due(iteration):
+            H_prev = H.copy()
+            P_prev = P.copy()
+
+        shiftedH = shiftStack(H, T).reshape(len(active), R * T, N)
+        np.matmul(P.reshape(len(active), K, R * T), shiftedH, out=Q)
+        # EPS once for the model (see nmfd.convModel) and once for the ratio
+        Q += 2 * EPS
+        np.divide(V, Q, out=Q)
+
+        ## Equations 2.8 and 2.9 ##
+        corrP = (Q @ shiftedH.transpose(0, 2, 1)).reshape(len(active), K, R, T)
+        P *= corrP / (laggedSums(H, T, lengths)[:, None, :, :] + EPS)
+
+        if params["fixW"] == "fixed":
+            P[:, :, :R_max, :] = P_init[:, :, :R_max, :]
+
+        ## Equation 2.5 ##
+        elif params["fixW"] == "semi":
+            alpha = (iteration / L)**params["beta"]
+            P[:, :, :R_max, :] = (1-alpha) * P_init[:, :, :R_max, :] + alpha * P[:, :, :R_max, :]
+
+        normP = P / (P.sum(axis=1)[:, None, :, :] + EPS)
+        projection = normP.reshape(len(active), K, R * T).transpose(0, 2, 1) @ Q
+        H *= shiftSum(projection.reshape(len(active), R, T, N))
+
+        converged = np.zeros(len(active), dtype=bool)
+        if convergence.due(iteration):
+            H_diff = convergence.change(np.abs(H - H_prev), axis=(1, 2))
+            # rescale the lag mean so that padded template frames do not count
+            P_mean = np.mean(np.abs(P - P_prev), axis=3) * (T / template_lengths)[:, None, None]
+            P_diff = convergence.change(P_mean, axis=(1, 2))
+            converged = (H_diff < convergence.threshold) & (P_diff < convergence.threshold)
+        if iteration == L - 1:
+            converged[:] = True
+        for b in np.flatnonzero(converged):
+            s = active[b]
+            P_s, H_s = unstackComponents(P[b], H[b], P_inits[s].shape[1], R_max, lengths[b])
+            P_s = P_s[:, :, :template_lengths[b]]
+            results[s] = (convModel(P_s, H_s), P_s, H_s)
+        if converged.all():
+            break
+        keep = ~converged
+        active, V, P, P_init, H = active[keep], V[keep], P[keep], P_init[keep], H[keep]
+        lengths, template_lengths = lengths[keep], template_lengths[keep]
+        Q = np.empty_like(V)
+
+    return results
+
+def batchConvergence(params, L, threshold):
+    """
+        The stopping rule of the batched factorizations, see convergence.Convergence.
+        The KL divergence is not tracked per sample, so only the change criteria are supported,
+        and only the multiplicative updates are batched.
+    """
+    if get_solver(params) != "multiplicative":
+        raise Exception("The batched factorization only supports the multiplicative solver")
+    convergence = Convergence(params, L, threshold)
+    if convergence.criterion == "kl":
+        raise Exception("The batched factorization does not support the KL convergence criterion")
+    return convergence
+
+def stackSpectrograms(Vs, dtype=np.float64):
+    """
+        Zero-pad spectrograms to a common number of time frames.
+
+        Args:
+            Vs (list of np.ndarray) : S spectrograms of size K x N_s.
+            dtype (np.dtype) : Type of the stacked spectrograms, see precision.get_dtype.
+
+        Returns:
+            V (np.ndarray) : A 3D numpy array of size S x K x max(N_s).
+            lengths (np.ndarray) : The number of time frames N_s of every sample.
+    """
+    K = Vs[0].shape[0]
+    if any(V_s.shape[0] != K for V_s in Vs):
+        raise Exception("All spectrograms in a batch need the same number of spectral bands")
+    lengths = np.array([V_s.shape[1] for V_s in Vs])
+    V = np.zeros((len(Vs), K, lengths.max()), dtype=dtype)
+    for s, V_s in enumerate(Vs):
+        V[s, :, :V_s.shape[1]] = V_s
+    return V, lengths
+
+def frameMask(lengths, N):
+    """
+        Mask of the valid (unpadded) time frames, of size S x 1 x N.
+    """
+    return (np.arange(N)[None, :] < lengths[:, None])[:, None, :]
+
+def laggedSums(H, T, lengths):
+    """
+        Row sums of the shifted activations of every sample, see nmfd.laggedSums.
+        Shifted frames falling beyond the sample's own length N_s are excluded.
+
+        Args:
+            H (np.ndarray) : A 3D numpy array of size S x R x N.
+            T (int) : The number of lags.
+            lengths (np.ndarray) : The number of time frames N_s of every sample.
+
+        Returns:
+            sums (np.ndarray) : A 3D numpy array of size S x R x T.
+    """
+    cumulative = np.cumsum(H, axis=-1)
+    last = lengths[:, None] - 1 - np.arange(T)[None, :]
+    index = np.broadcast_to(np.maximum(last, 0)[:, None, :], (H.shape[0], H.shape[1], T))
+    sums = np.take_along_axis(cumulative, index, axis=-1)
+    sums[np.broadcast_to((last < 0)[:, None, :], sums.shape)] = 0
+    return sums
+
+def unstackComponents(W, H, R_s, R_max, N_s):
+    """
+        Drop the padded drum components and time frames of one sample.
+
+        Args:
+            W (np.ndarray) : Templates of size K x R (x T) with R = R_max + addedCompW.
+            H (np.ndarray) : Activations of size R x N.
+            R_s (int) : The number of drum components of the sample.
+            R_max (int) : The number of drum components in the batch.
+            N_s (int) : The number of time frames of the sample.
+
+        Returns:
+            W (np.ndarray) : Templates of size K x (R_s + addedCompW) (x T).
+            H (np.ndarray) : Activations of size (R_s + addedCompW) x N_s.
+    """
+    components = np.r_[0:R_s, R_max:W.shape[1]]
+    return W[:, components].copy(), H[components, :N_s].copy()
+
+def batched(labels, params):
+    """
+        Whether the batched solvers compute the factorization of an NMFLabels object as
+        NMFLabels.factorize would: they have no multi-resolution, block-wise, warm-started
+        or FFT-based variant, only run the multiplicative updates and do not track the KL
+        divergence, see batchConvergence.
+    """
+    if params.get("nmfd_levels") is not None or params.get("stream_block") is not None or params.get("warm_start_from"):
+        return False
+    if get_solver(params) != "multiplicative" or params.get("convergence") == "kl":
+        return False
+    return params["nmf_type"] != 'NMFD' or selectBackend(params.get("nmfd_backend", "auto"), labels.P_init.shape[2]) == "direct"
+
+def factorize_samples(nmf_labels, params, batch_size=8):
+    """
+        Factorize the drum loops of several NMFLabels objects in batches and
+        pass the activations on to their instruments. Samples of similar length
+        are batched together to keep the zero-padding small. Samples found in the
+        factorization cache are not factorized again, and samples the batched solvers do
+        not implement the configuration of (see batched) are factorized one at a time.
+
+        Args:
+            nmf_labels (list of NMFLabels) : Objects created with _factorize=False.
+            params (dict) : Dictionary of parameters, defined in main.py.
+            batch_size (int) : The number of samples factorized together. Small batches keep
+                the stacked spectrograms in cache; very large ones become memory-bound.
+    """
+    missing = []
+    for labels in nmf_labels:
+        if not batched(labels, params):
+            labels.factorize()
+            continue
+        key = labels.cache_key()
+        cached = get_cache().get(key) if key is not None else None
+        if cached is not None:
+            labels.set_activations(cached[1])
+        else:
+            missing.append((labels, key))
+
+    missing = sorted(missing, key=lambda item: item[0].V.shape[1])
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        Vs = [labels.V for labels, key in chunk]
+        with span("factorize batch"):
+            if params["nmf_type"] == 'NMF':
+                results = batchNMF(Vs, [labels.W_init for labels, key in chunk], params)
+            elif params["nmf_type"] == 'NMFD':
+                results = batchNMFD(Vs, [labels.P_init for labels, key in chunk], params)
+        for (labels, key), (V_approx, W, H) in zip(chunk, results):
+            if key is not None:
+                get_cache().put(key, W, H)
+            labels.set_activations(H)
@@ -0,0 +1,332 @@
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import wave
+import mido
+import numpy as np
+
+from nmf import NMF
+from nmfd import NMFD, convModel
+from onsets import TOLERANCE, detect_onsets, match_onsets, evaluate_samples
+
+FS = 22050
+HOP = 256
+# onset detection thresholds, see Instrument
+THETA = {"NMF": 3, "NMFD": 6}
+# factorization parameters of the benchmarks, as in main.py
+PARAMS = {"fixW": "adaptive", "beta": 0, "addedCompW": 0, "window": 512, "hop": HOP, "noise": "None", "noise-lvl": 0}
+# problem size every scaling grid varies one dimension of
+BASE = {"K": 257, "N": 1000, "R": 4, "T": 10}
+GRID = {"K": [129, 257, 513, 1025], "N": [500, 1000, 2000, 4000], "R": [2, 4, 8], "T": [5, 10, 20, 40]}
+# the dimensions each benchmark depends on
+DIMENSIONS = {"NMF": ["K", "N", "R"], "NMFD": ["K", "N", "R", "T"], "convModel": ["K", "N", "R", "T"]}
+# result fields compared against a baseline, see compare
+METRICS = ["time", "peak_memory", "iterations", "F"]
+
+def synthetic_patterns(K, R, T, seed=0):
+    """
+        Synthetic drum kit: every instrument has a spectral envelope peaking at its own
+        frequency and an exponentially decaying pattern of T frames.
+
+        Returns:
+            P (np.ndarray) : Pattern tensor of size K x R x T.
+    """
+    rng = np.random.default_rng(seed)
+    bins = np.arange(K)[:, None]
+    centres = np.sort(rng.uniform(0.02, 0.8, R)) * K
+    widths = rng.uniform(0.05, 0.3, R) * K
+    envelopes = np.exp(-0.5 * ((bins - centres) / widths) ** 2) + 0.05
+    decays = np.exp(-np.arange(T)[None, :] / rng.uniform(1, max(T / 3, 1.5), R)[:, None])
+    return envelopes[:, :, None] * decays[None, :, :]
+
+def synthetic_loop(P, N, seed=0, noise=0.01):
+    """
+        Synthetic drum loop played on the kit P, with the onsets of every instrument at
+        least 2 * TOLERANCE apart.
+
+        Args:
+            P (np.ndarray) : Pattern tensor of size K x R x T, see synthetic_patterns.
+            N (int) : The number of time frames.
+            seed (int) : Seed of the random generator.
+            noise (float) : Level of the uniform noise floor added to the mixture.
+
+        Returns:
+            V (np.ndarray) : Magnitude spectrogram of size K x N.
+            onsets (list of np.ndarray) : Onset frames of every instrument.
+    """
+    K, R, T = P.shape
+    rng = np.random.default_rng(seed)
+    gap = int(np.ceil(2 * TOLERANCE * FS / HOP))
+    H = np.zeros((R, N))
+    onsets = []
+    for r in range(R):
+        frames = np.cumsum(rng.integers(gap, 8 * gap, N // gap + 1))
+        frames = frames[frames < N - 1]
+        H[r, frames] = rng.uniform(0.5, 1, len(frames))
+        onsets.append(frames)
+    V = convModel(P, H) + noise * rng.random((K, N))
+    return V, onsets
+
+def f_measure(H, onsets, nmf_type):
+    """
+        F-measure of the onsets detected in the activations H against the true onset frames.
+    """
+    R = len(onsets)
+    detections = detect_onsets(H[:R], THETA[nmf_type], HOP, FS)
+    tp, fp, fn = match_onsets(detections, [frames * HOP / FS for frames in onsets])
+    return float(2 * tp.sum() / max(2 * tp.sum() + fp.sum() + fn.sum(), 1))
+
+def measure(function):
+    """
+        Run function() twice: once timed, and once under tracemalloc for its peak memory,
+        as tracing slows down Python-level code several times over.
+
+        Returns:
+            result : The return value of the timed call.
+            seconds (float) : Wall time of the timed call.
+            peak_memory (int) : Peak traced memory (bytes) allocated during the traced call.
+    """
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak_memory
+
+def scaling_grid(dimensions, base=BASE, grid=GRID):
+    """
+        The problem sizes of a scaling grid: the base size, and the sizes that differ
+        from it in one of the dimensions.
+    """
+    sizes = [dict(base)]
+    for dimension in dimensions:
+        for value in grid[dimension]:
+            if value != base[dimension]:
+                sizes.append(dict(base, **{dimension: value}))
+    return sizes
+
+def benchmark_factorization(nmf_type, size, params=PARAMS, seed=0):
+    """
+        Time one NMF or NMFD factorization of a synthetic problem, started from the true
+        templates (the temporal mean of the patterns for NMF).
+
+        Returns:
+            record (dict) : The benchmark, problem size, time (s), peak memory (bytes),
+                iterations and F-measure of the detected onsets.
+    """
+    P = synthetic_patterns(size["K"], size["R"], size["T"], seed)
+    V, onsets = synthetic_loop(P, size["N"], seed)
+    params = dict(params, nmf_type=nmf_type)
+    info = {}
+    if nmf_type == "NMF":
+        (V_approx, W, H), seconds, peak_memory = measure(lambda: NMF(V, P.mean(axis=2), params, info=info))
+    elif nmf_type == "NMFD":
+        (V_approx, W, H), seconds, peak_memory = measure(lambda: NMFD(V, P, params, info=info))
+    record = {"benchmark": nmf_type, **{key: size[key] for key in DIMENSIONS[nmf_type]}}
+    record.update({"time": seconds, "peak_memory": peak_memory, "iterations": info["iterations"],
+                   "F": f_measure(H, onsets, nmf_type)})
+    return record
+
+def benchmark_solvers(size, params=PARAMS, targets=(0.01, 0.001), L=1000, seed=0):
+    """
+        Wall time of every NMF solver (params["solver"]) to reach its objective within each
+        of targets (relative) of the objective it reaches after L iterations, on a synthetic
+        problem with one added noise component, started from the temporal mean of the true
+        patterns. The objective is the KL divergence for the multiplicative updates and the
+        Euclidean distance for HALS, see convergence.Convergence. The iterations needed are
+        read from a traced run, and then timed without the per-iteration objective.
+
+        Returns:
+            records (list of dict) : One record per solver and target, with the time (s),
+                peak memory (bytes), iterations and F-measure of the timed run.
+    """
+    P = synthetic_patterns(size["K"], size["R"], size["T"], seed)
+    V, onsets = synthetic_loop(P, size["N"], seed)
+    W_init = P.mean(axis=2)
+    records = []
+    for solver in ["multiplicative", "hals"]:
+        solver_params = dict(params, nmf_type="NMF", addedCompW=1, solver=solver, tolerance=0)
+        info = {}
+        NMF(V, W_init, dict(solver_params, max_iter=L, convergence="kl", trace=True), info=info)
+        iterations, objectives = info["objective"][:, 0], info["objective"][:, 1]
+        for target in targets:
+            reached = int(iterations[np.argmax(objectives <= objectives[-1] * (1 + target))]) + 1
+            # a single convergence check, after the last iteration
+            timed_params = dict(solver_params, max_iter=reached, check_every=reached)
+            (V_approx, W, H), seconds, peak_memory = measure(lambda: NMF(V, W_init, timed_params))
+            records.append({"benchmark": f"NMF {solver}", **{key: size[key] for key in DIMENSIONS["NMF"]},
+                            "target": target, "time": seconds, "peak_memory": peak_memory,
+                            "iterations": reached, "F": f_measure(H, onsets, "NMF")})
+    return records
+
+def benchmark_conv_model(size, repeats=5, seed=0):
+    """
+        Time convModel on the true patterns and activations of a synthetic problem (best of repeats).
+    """
+    rng = np.random.default_rng(seed)
+    P = rng.random((size["K"], size["R"], size["T"]))
+    H = rng.random((size["R"], size["N"]))
+    convModel(P, H)
+    timings = [measure(lambda: convModel(P, H)) for _ in range(repeats)]
+    seconds = min(seconds for result, seconds, peak_memory in timings)
+    peak_memory = timings[0][2]
+    return {"benchmark": "convModel", **size, "time": seconds, "peak_memory": peak_memory}
+
+def write_dataset(data_folder, samples, size, seed=0):
+    """
+        Write synthetic drum loops in the layout of reader.read_data: the instrument
+        patterns as the kit's instrument spectrograms, the mixtures as the drum loops'
+        spectrograms and their onsets as MIDI files (120 bpm). The spectrograms are stored
+        as the -{window}.npy files the reader loads, the WAV files are empty placeholders.
+
+        Args:
+            data_folder (str) : Folder to write to.
+            samples (int) : The number of drum loops.
+            size (dict) : Frames N, instruments R and template frames T of every loop; K
+                follows the window of PARAMS.
+    """
+    window = PARAMS["window"]
+    K = window // 2 + 1
+    kit = os.path.join(data_folder, "kits", "synthetic", "instruments")
+    os.makedirs(kit, exist_ok=True)
+    P = synthetic_patterns(K, size["R"], size["T"], seed)
+    for r in range(size["R"]):
+        write_placeholder(os.path.join(kit, f"instrument{r}.wav"))
+        np.save(os.path.join(kit, f"instrument{r}-{window}.npy"), P[:, r, :])
+    for s in range(samples):
+        V, onsets = synthetic_loop(P, size["N"], seed=seed + s)
+        directory = os.path.join(data_folder, "drum-loops", str(s + 1))
+        os.makedirs(directory, exist_ok=True)
+        write_placeholder(os.path.join(directory, "sample.wav"))
+        np.save(os.path.join(directory, f"sample-{window}.npy"), V)
+        # 120 bpm at 480 ticks per beat: a tick is 1/960 s
+        events = sorted((int(round(frame * HOP / FS * 960)), 36 + r) for r in range(size["R"]) for frame in onsets[r])
+        midi = mido.MidiFile(ticks_per_beat=480)
+        track = mido.MidiTrack()
+        midi.tracks.append(track)
+        track.append(mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(120)))
+        last = 0
+        for tick, note in events:
+            track.append(mido.Message('note_on', note=note, velocity=100, time=tick - last))
+            track.append(mido.Message('note_off', note=note, velocity=0, time=0))
+            last = tick
+        midi.save(os.path.join(directory, "sample.mid"))
+        with open(os.path.join(directory, "info.txt"), "w") as info_file:
+            info_file.write("120 bpm\nsynthetic\nsynthetic\ninstruments\n")
+            info_file.writelines(f"{36 + r} instrument{r}.wav\n" for r in range(size["R"]))
+
+def write_placeholder(path):
+    """
+        Write an empty WAV file, standing in for a recording whose spectrogram is given.
+    """
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(FS)
+
+def benchmark_pipeline(nmf_type, size, samples=4, params=PARAMS, seed=0):
+    """
+        Time the pipeline on a synthetic dataset written by write_dataset: reading and
+        factorizing the samples (reader.read_data), Instrument.find_onsets on every
+        instrument, and onsets.evaluate_samples.
+
+        Returns:
+            records (list of dict) : One record per stage, with the mean F-measure of Sample.evaluate.
+    """
+    from reader import read_data
+    from templatebank import get_template_bank
+
+    params = dict(params, nmf_type=nmf_type)
+    with tempfile.TemporaryDirectory() as data_folder:
+        write_dataset(data_folder, samples, size, seed)
+        try:
+            # the samples are lazy, see Sample
+            loaded, read_seconds, read_memory = measure(lambda: [sample.load() for sample in read_data(data_folder, params)])
+            scores, evaluate_seconds, evaluate_memory = measure(lambda: evaluate_samples(loaded)[1])
+            instruments = [instrument for sample in loaded for instrument in sample.instrument_codes.values()]
+            _, onset_seconds, onset_memory = measure(lambda: [instrument.find_onsets() for instrument in instruments])
+        finally:
+            # the banked templates of the deleted dataset are of no further use
+            get_template_bank().clear()
+    size = dict(size, K=params["window"] // 2 + 1, samples=samples)
+    F = float(np.mean([score[2] for score in scores]))
+    return [{"benchmark": f"{nmf_type} read_data", **size, "time": read_seconds, "peak_memory": read_memory, "F": F},
+            {"benchmark": f"{nmf_type} find_onsets", **size, "time": onset_seconds, "peak_memory": onset_memory},
+            {"benchmark": f"{nmf_type} evaluate_samples", **size, "time": evaluate_seconds, "peak_memory": evaluate_memory, "F": F}]
+
+def run_benchmarks(base=BASE, grid=GRID, params=PARAMS, pipeline_sizes=({"N": 1000, "R": 4, "T": 10},)):
+    """
+        Run the benchmarks of NMF, NMFD and convModel over their scaling grids, of the NMF
+        solvers on the base problem and of the pipeline on a synthetic dataset of each of pipeline_sizes.
+
+        Returns:
+            results (dict) : "environment" (versions and machine) and "records" (list of dict).
+    """
+    records = []
+    for nmf_type in ["NMF", "NMFD"]:
+        for size in scaling_grid(DIMENSIONS[nmf_type], base, grid):
+            records.append(benchmark_factorization(nmf_type, size, params))
+            print(records[-1])
+    records.extend(benchmark_solvers(base, params))
+    print(records[-4:])
+    for size in scaling_grid(DIMENSIONS["convModel"], base, grid):
+        records.append(benchmark_conv_model(size))
+        print(records[-1])
+    for nmf_type in ["NMF", "NMFD"]:
+        for size in pipeline_sizes:
+            records.extend(benchmark_pipeline(nmf_type, size, params=params))
+            print(records[-3:])
+    environment = {"python": platform.python_version(), "numpy": np.__version__,
+                   "machine": platform.machine(), "processor": platform.processor()}
+    return {"environment": environment, "records": records}
+
+def record_key(record):
+    return tuple(sorted((key, value) for key, value in record.items() if key not in METRICS))
+
+def compare(results, baseline, slowdown=1.25, f_drop=0.01):
+    """
+        Compare benchmark results against a baseline and print every record that got
+        slower than slowdown times the baseline time or lost more than f_drop F-measure.
+
+        Args:
+            results, baseline (dict) : Results of run_benchmarks.
+
+        Returns:
+            regressions (list of tuple) : (record, baseline record) of every regression.
+    """
+    baseline_records = {record_key(record): record for record in baseline["records"]}
+    regressions = []
+    for record in results["records"]:
+        previous = baseline_records.get(record_key(record))
+        if previous is None:
+            continue
+        slower = record["time"] > slowdown * previous["time"]
+        worse = "F" in record and record["F"] < previous["F"] - f_drop
+        if slower or worse:
+            regressions.append((record, previous))
+            print(f"{record['benchmark']} {dict(record_key(record))}: time {previous['time']:.4f} -> {record['time']:.4f} s"
+                  + (f", F {previous['F']:.3f} -> {record['F']:.3f}" if "F" in record else ""))
+    print(f"{len(regressions)} regressions in {len(results['records'])} benchmarks")
+    return regressions
+
+if __name__ == "__main__":
+    # the results are written to RESULTS_FILE; copy it to BASELINE_FILE to compare later runs against it
+    RESULTS_FILE = "benchmark.json"
+    BASELINE_FILE = "benchmark-baseline.json"
+
+    results_path = os.path.abspath(RESULTS_FILE)
+    baseline_path = os.path.abspath(BASELINE_FILE)
+    results = run_benchmarks()
+    with open(results_path, "w") as results_file:
+        json.dump(results, results_file, indent=1)
+    print(f"Results written to {results_path}")
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as baseline_file:
+            compare(results, json.load(baseline_file))
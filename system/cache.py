@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# bump when a change to nmf.py/nmfd.py alters the factorization results
+CACHE_VERSION = 1
+
+# parameters that change the outcome of NMF/NMFD
+FACTORIZATION_KEYS = ["nmf_type", "fixW", "beta", "addedCompW", "initH", "nmfd_backend", "stream_block", "warm_start_from",
+                     "convergence", "tolerance", "check_every", "max_iter", "precision", "solver",
+                     "nmfd_levels"]
+# puts after which a process rescans the cache directory, to count the entries other processes wrote
+RESCAN_EVERY = 64
+# fraction of max_bytes an eviction shrinks the cache to, so that it is not scanned again on every put once full
+LOW_WATER = 0.9
+# parameters in which neighbouring sweep configurations differ, see warmstart.py
+NEIGHBOUR_KEYS = ["fixW", "beta", "addedCompW"]
+
+class FactorizationCache:
+    """
+        On-disk cache of factorization results (W or P, and H), keyed by a hash of the
+        spectrogram, the template matrix/tensor and the factorization parameters.
+        The spectrogram is hashed after noise mixing, so the noise segment is part of the key.
+        Entries are evicted least recently used first once the cache grows beyond max_bytes.
+        Writes are atomic, so several worker processes can share one cache directory.
+        Every process keeps a running total of the cache size, from a scan of the directory
+        plus the entries it wrote since, and only scans the directory again once that total
+        passes max_bytes or after RESCAN_EVERY puts. The entries written by the other
+        processes in between can take the cache beyond max_bytes until the next scan.
+
+        Args:
+            _directory (str) : Directory holding one .npz file per entry.
+            _max_bytes (int) : Size bound of the cache directory.
+    """
+    def __init__(self, _directory, _max_bytes=2 * 1024**3):
+        self.directory = _directory
+        self.max_bytes = _max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total = None  # bytes in the cache as of the last scan plus the entries put since
+        self.puts = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, V, templates, params):
+        """
+            Content hash identifying a factorization.
+
+            Args:
+                V (np.ndarray) : The (noisy, compressed) spectrogram to factorize.
+                templates (np.ndarray) : W_init or P_init.
+                params (dict) : Dictionary of parameters, defined in main.py.
+
+            Returns:
+                key (str) : Hex digest.
+        """
+        factorization_params = {key: params.get(key) for key in FACTORIZATION_KEYS}
+        if params.get("fixW") != "semi":
+            # beta only enters the semi-adaptive update
+            factorization_params["beta"] = None
+        return self.digest(V, templates, factorization_params)
+
+    def digest(self, V, templates, params):
+        digest = hashlib.sha1()
+        digest.update(json.dumps([CACHE_VERSION, params], sort_keys=True, default=str).encode())
+        for array in (V, templates):
+            array = np.ascontiguousarray(array)
+            digest.update(f"{array.shape}{array.dtype}".encode())
+            digest.update(array.data)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key):
+        """
+            Look up a factorization.
+
+            Returns:
+                (W, H) : The cached templates and activations, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                W, H = entry["W"], entry["H"]
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+        # the modification time doubles as the LRU timestamp
+        os.utime(path)
+        self.hits += 1
+        return W, H
+
+    def put(self, key, W, H):
+        """
+            Store a factorization and evict old entries if the cache is over its size bound.
+        """
+        temporary = os.path.join(self.directory, f".{key}.{os.getpid()}.tmp.npz")
+        np.savez(temporary, W=W, H=H)
+        size = os.path.getsize(temporary)
+        os.replace(temporary, self.path(key))
+        self.puts += 1
+        if self.total is not None and self.puts % RESCAN_EVERY != 0:
+            self.total += size
+            if self.total <= self.max_bytes:
+                return
+        self.evict()
+
+    def load(self, key):
+        """
+            Read an entry without counting it as a hit or a miss, e.g. a warm start.
+            Returns None if the entry has been evicted.
+        """
+        try:
+            with np.load(self.path(key)) as entry:
+                return entry["W"], entry["H"]
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def evict(self):
+        """
+            Scan the cache directory and, if it is beyond max_bytes, remove the least recently
+            used entries until it is within LOW_WATER * max_bytes. The size left is kept as the
+            running total of put.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz") or name.startswith("."):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue  # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        bound = self.max_bytes if total <= self.max_bytes else LOW_WATER * self.max_bytes
+        for _, size, name in sorted(entries):
+            if total <= bound:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total = total
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+_cache = None
+
+def configure(directory, max_bytes=2 * 1024**3):
+    """
+        Enable the process-wide factorization cache used by NMFLabels.
+        Passing directory=None disables it.
+    """
+    global _cache
+    _cache = None if directory is None else FactorizationCache(directory, max_bytes)
+    return _cache
+
+def get_cache():
+    """
+        The process-wide factorization cache, or None if it is disabled.
+    """
+    return _cache
@@ -0,0 +1,162 @@
+import time
+import numpy as np
+
+from precision import eps
+
+EPS = 2.0 ** -52
+
+CRITERIA = ["spectral", "frobenius", "maxabs", "kl"]
+# update rules selectable with params["solver"]: the KL multiplicative updates, and
+# hierarchical alternating least squares (NMF only), which minimizes the Euclidean distance
+SOLVERS = ["multiplicative", "hals"]
+
+def kl_divergence(V, V_approx):
+    """
+        Generalized Kullback-Leibler divergence D(V | V_approx), the objective the
+        multiplicative updates of NMF and NMFD minimize. It is accumulated in float64
+        whatever the precision of V.
+    """
+    EPS = eps(V.dtype)
+    return float(np.sum(V * np.log((V + EPS) / (V_approx + EPS)) - V + V_approx, dtype=np.float64))
+
+def euclidean_distance(V, V_approx):
+    """
+        Half the squared Euclidean distance between V and V_approx, the objective of the
+        HALS solver, accumulated in float64.
+    """
+    return 0.5 * float(np.sum(np.square(V - V_approx), dtype=np.float64))
+
+def get_solver(params):
+    """
+        The update rule selected by params["solver"] ("multiplicative" by default).
+    """
+    solver = params.get("solver", "multiplicative")
+    if solver not in SOLVERS:
+        raise Exception(f"Unknown solver {solver}, use one of {SOLVERS}")
+    return solver
+
+def iteration_budget(params, L):
+    """
+        The maximal number of iterations: params["max_iter"], either a number or a
+        dictionary by params["nmf_type"], and L, the solver's default, otherwise.
+    """
+    max_iter = params.get("max_iter")
+    if isinstance(max_iter, dict):
+        max_iter = max_iter.get(params["nmf_type"])
+    return L if max_iter is None else int(max_iter)
+
+class Convergence:
+    """
+        Stopping rule of NMF and NMFD, configured by the parameters:
+            params["convergence"] : The criterion,
+                "spectral" (default) - the spectral norm of the change of the templates and of the activations,
+                "frobenius" - the Frobenius norm of the changes,
+                "maxabs" - the largest absolute element of the changes,
+                "kl" - the relative decrease of the objective since the previous check; an increase,
+                    e.g. while semi-adaptive templates are blended in, does not stop the iterations.
+                    The objective is the KL divergence, or the Euclidean distance with params["solver"] = "hals".
+                The change criteria stop once both changes are below the threshold.
+            params["tolerance"] : The threshold, defaults to the solver's.
+            params["check_every"] : Check every k iterations, defaults to 1.
+            params["max_iter"] : The iteration budget, see iteration_budget.
+            params["trace"] : Record the objective at every check, see trace().
+        The spectral norms are computed by an SVD, which can cost more than the update itself.
+
+        Args:
+            _params (dict) : Dictionary of parameters, defined in main.py.
+            _L (int) : The solver's default iteration budget.
+            _threshold (float) : The solver's default threshold.
+            _callback (callable) : Optional callback(iteration, objective, elapsed) called at
+                every check with the objective and the seconds since construction,
+                see instrumentation.iteration_callback.
+    """
+    def __init__(self, _params, _L, _threshold, _callback=None):
+        self.criterion = _params.get("convergence", "spectral")
+        if self.criterion not in CRITERIA:
+            raise Exception(f"Unknown convergence criterion {self.criterion}, use one of {CRITERIA}")
+        self.objective = euclidean_distance if get_solver(_params) == "hals" else kl_divergence
+        self.L = iteration_budget(_params, _L)
+        self.threshold = _params.get("tolerance", _threshold)
+        self.every = _params.get("check_every", 1)
+        self.tracing = _params.get("trace", False)
+        self.objectives = []  # (iteration, objective) of every check
+        self.previous_objective = None
+        self.iterations = 0
+        self.converged = False
+        self.callback = _callback
+        self.start = time.perf_counter()
+
+    def due(self, iteration):
+        """
+            Whether convergence is checked after this iteration.
+        """
+        return (iteration + 1) % self.every == 0 or iteration + 1 == self.L
+
+    def needs_change(self, iteration):
+        """
+            Whether the check after this iteration needs the change of the templates and
+            activations, i.e. the solver has to keep their values before the update.
+        """
+        return self.criterion != "kl" and self.due(iteration)
+
+    def needs_model(self):
+        """
+            Whether the checks need the approximation V_approx, i.e. compute the objective.
+        """
+        return self.criterion == "kl" or self.tracing or self.callback is not None
+
+    def stop(self, iteration, V, V_approx, changes=None):
+        """
+            Check convergence after an iteration.
+
+            Args:
+                iteration (int) : The iteration just run, from 0.
+                V (np.ndarray) : The spectrogram.
+                V_approx (np.ndarray) : The approximation the iteration started from.
+                changes (list of np.ndarray) : The change of the templates and of the
+                    activations in this iteration, for the change criteria.
+
+            Returns:
+                stop (bool) : Whether the iterations stop.
+        """
+        self.iterations = iteration + 1
+        if self.needs_model():
+            objective = self.objective(V, V_approx)
+            if self.tracing:
+                self.objectives.append((iteration, objective))
+            if self.callback is not None:
+                self.callback(iteration, objective, time.perf_counter() - self.start)
+        if self.criterion == "kl":
+            previous = self.previous_objective
+            self.previous_objective = objective
+            self.converged = previous is not None and 0 <= (previous - objective) / (abs(previous) + EPS) < self.threshold
+        else:
+            self.converged = all(self.change(D) < self.threshold for D in changes)
+        return self.converged
+
+    def change(self, D, axis=None):
+        """
+            Size of a change D under the change criterion, of every matrix of a stack with axis=(1, 2).
+        """
+        if self.criterion == "spectral":
+            return np.linalg.norm(D, ord=2, axis=axis)
+        elif self.criterion == "frobenius":
+            return np.linalg.norm(D, axis=axis)
+        elif self.criterion == "maxabs":
+            return np.max(np.abs(D), axis=axis)
+
+    def trace(self):
+        """
+            Summary of the iterations run.
+
+            Returns:
+                info (dict) :
+                    "iterations" : The number of iterations run.
+                    "converged" : Whether the criterion was met before the budget ran out.
+                    "objective" : With params["trace"], an array of size checks x 2 holding
+                        the iteration and objective of every check.
+        """
+        info = {"iterations": self.iterations, "converged": self.converged}
+        if self.tracing:
+            info["objective"] = np.array(self.objectives).reshape(-1, 2)
+        return info
@@ -0,0 +1,94 @@
+from functools import lru_cache
+import librosa
+import numpy as np
+
+from precision import get_dtype
+
+# sample rate of the STFTs, see stfts.py
+FS = 22050
+# lowest frequency (Hz) of the log-frequency filterbank
+FMIN = 30.0
+
+@lru_cache(maxsize=None)
+def filterbank(window, Fs, bands, scale="log"):
+    """
+        Filterbank matrix mapping the window / 2 + 1 linear STFT bins onto fewer bands.
+        Every band is a triangular filter between its neighbours' centre frequencies,
+        normalized to unit sum, so a band holds the average magnitude of its bins.
+        The matrices are cached per (window, Fs, bands, scale) and are read-only.
+
+        Args:
+            window (int) : STFT window size.
+            Fs (int) : Sample rate of the recordings.
+            bands (int) : The number of bands.
+            scale (str) : "log" for log-spaced centre frequencies from FMIN to Fs / 2 (see log_edges),
+                "mel" for the mel scale (librosa.filters.mel).
+
+        Returns:
+            F (np.ndarray) : Filterbank of size bands x (window / 2 + 1).
+    """
+    K = window // 2 + 1
+    bin_frequencies = np.arange(K) * Fs / window
+    if scale == "mel":
+        F = librosa.filters.mel(sr=Fs, n_fft=window, n_mels=bands, norm=None, dtype=np.float64)
+    elif scale == "log":
+        edges = log_edges(bands, Fs / window, Fs / 2)
+        lower, centre, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+        rising = (bin_frequencies - lower) / (centre - lower)
+        falling = (upper - bin_frequencies) / (upper - centre)
+        F = np.maximum(0, np.minimum(rising, falling))
+    else:
+        raise Exception(f"Unknown filterbank scale {scale}")
+    if (F.sum(axis=1) == 0).any():
+        raise Exception(f"{bands} {scale} bands leave bands without STFT bins for window {window}")
+    F /= F.sum(axis=1, keepdims=True)
+    F.setflags(write=False)
+    return F
+
+def log_edges(bands, bin_width, fmax):
+    """
+        Band edges from FMIN to fmax, each a constant ratio above the previous one, but at
+        least one STFT bin apart, so that the low bands do not collapse onto the same bin.
+        The ratio is found by bisection.
+
+        Returns:
+            edges (np.ndarray) : bands + 2 frequencies (Hz), the outer ones bounding the first and last band.
+    """
+    def edges_for(ratio):
+        edges = [FMIN]
+        for _ in range(bands + 1):
+            edges.append(max(edges[-1] * ratio, edges[-1] + bin_width))
+        return np.array(edges)
+
+    if edges_for(1.0)[-1] > fmax:
+        raise Exception(f"{bands} bands of at least {bin_width:.1f} Hz do not fit below {fmax:.0f} Hz")
+    low, high = 1.0, fmax / FMIN
+    for _ in range(100):
+        ratio = np.sqrt(low * high)
+        if edges_for(ratio)[-1] > fmax:
+            high = ratio
+        else:
+            low = ratio
+    return edges_for(low)
+
+def compress_frequencies(Y, params):
+    """
+        Map a magnitude spectrogram (or template) onto params["bands"] bands of the
+        params["filterbank"] scale ("log" by default), before the logarithmic compression.
+        Without params["bands"] the spectrogram is returned unchanged.
+
+        Args:
+            Y (np.ndarray) : Magnitude spectrogram of size K x N.
+            params (dict) : Dictionary of parameters, defined in main.py.
+
+        Returns:
+            Y (np.ndarray) : Spectrogram of size bands x N, in the type of params["precision"]
+                (see precision.get_dtype); without params["bands"], Y itself.
+    """
+    if params.get("bands") is None:
+        return Y
+    F = filterbank(params["window"], FS, params["bands"], params.get("filterbank", "log"))
+    if F.shape[1] != Y.shape[0]:
+        raise Exception(f"The spectrogram has {Y.shape[0]} bins, the filterbank of window {params['window']} expects {F.shape[1]}")
+    dtype = get_dtype(params)
+    return F.astype(dtype, copy=False) @ Y.astype(dtype, copy=False)
@@ -0,0 +1,136 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+# returned by span and labelled while instrumentation is disabled
+_DISABLED = nullcontext()
+
+class Instrumentation:
+    """
+        Per-stage timing of the pipeline. Stages are timed by span(), which adds their wall
+        time to a counter of the stage under the current labels, e.g. the sample and the
+        configuration set by sweep.run_task with labelled(). Spans nest: the time of a stage
+        includes the stages timed inside it. With _iterations, NMF and NMFD also report every
+        convergence check (iteration, KL divergence and elapsed time), see iteration_callback.
+
+        flush() appends the counters and iteration events as JSON lines to the output file
+        and resets them, so several processes can share one file; summarize() aggregates it.
+
+        Args:
+            _path (str) : JSON lines file the counters are appended to.
+            _iterations (bool) : Record the NMF/NMFD iterations. Their KL divergence is then
+                computed at every check, which costs about as much as an update.
+    """
+    def __init__(self, _path, _iterations=False):
+        self.path = _path
+        self.record_iterations = _iterations
+        self.labels = {}
+        self.counters = defaultdict(lambda: [0, 0.0])  # (labels, stage) -> [count, seconds]
+        self.events = []
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            counter = self.counters[(tuple(self.labels.items()), stage)]
+            counter[0] += 1
+            counter[1] += time.perf_counter() - start
+
+    @contextmanager
+    def labelled(self, **labels):
+        previous = self.labels
+        self.labels = dict(previous, **labels)
+        try:
+            yield
+        finally:
+            self.labels = previous
+
+    def iteration_callback(self, solver):
+        """
+            Callback of convergence.Convergence for the iterations of solver ("NMF" or "NMFD"),
+            or None if iterations are not recorded.
+        """
+        if not self.record_iterations:
+            return None
+        labels = dict(self.labels)
+
+        def callback(iteration, objective, elapsed):
+            self.events.append({"labels": labels, "solver": solver, "iteration": iteration,
+                                "objective": objective, "elapsed": elapsed})
+        return callback
+
+    def flush(self):
+        lines = [{"labels": dict(labels), "stage": stage, "count": count, "seconds": seconds}
+                 for (labels, stage), (count, seconds) in self.counters.items()]
+        lines += self.events
+        if len(lines) > 0:
+            with open(self.path, "a") as output_file:
+                output_file.write("".join(json.dumps(line, default=str) + "\n" for line in lines))
+        self.counters.clear()
+        self.events = []
+
+_instrumentation = None
+
+def configure(path, iterations=False):
+    """
+        Enable the process-wide instrumentation, writing to the JSON lines file path.
+        Passing path=None disables it.
+    """
+    global _instrumentation
+    if _instrumentation is not None:
+        _instrumentation.flush()
+    _instrumentation = None if path is None else Instrumentation(path, iterations)
+    return _instrumentation
+
+def get_instrumentation():
+    """
+        The process-wide instrumentation, or None if it is disabled.
+    """
+    return _instrumentation
+
+def span(stage):
+    """
+        Context timing a pipeline stage, a no-op while instrumentation is disabled.
+    """
+    return _DISABLED if _instrumentation is None else _instrumentation.span(stage)
+
+def labelled(**labels):
+    """
+        Context attaching labels to the stages timed inside it, a no-op while instrumentation is disabled.
+    """
+    return _DISABLED if _instrumentation is None else _instrumentation.labelled(**labels)
+
+def iteration_callback(solver):
+    return None if _instrumentation is None else _instrumentation.iteration_callback(solver)
+
+def flush():
+    if _instrumentation is not None:
+        _instrumentation.flush()
+
+def summarize(path, by=()):
+    """
+        Total count and time of every stage in a JSON lines file written by Instrumentation.
+
+        Args:
+            path (str) : The JSON lines file.
+            by (tuple of str) : Labels to break the totals down by, e.g. ("sample",) or ("nmf_type", "fixW").
+
+        Returns:
+            totals (dict) : (label values..., stage) -> {"count", "seconds"}, and
+                (label values..., solver, "checks") -> {"count"} for the recorded iterations.
+    """
+    totals = defaultdict(lambda: {"count": 0, "seconds": 0.0})
+    with open(path) as input_file:
+        for line in input_file:
+            record = json.loads(line)
+            group = tuple(record["labels"].get(label) for label in by)
+            if "stage" in record:
+                total = totals[group + (record["stage"],)]
+                total["count"] += record["count"]
+                total["seconds"] += record["seconds"]
+            else:
+                totals[group + (record["solver"], "checks")]["count"] += 1
+    return dict(totals)
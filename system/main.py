@@ -1,13 +1,16 @@
-import numpy as np
-from reader import read_data
-import matplotlib.pyplot as plt
-import csv
 import os
-from random import randint
-from copy import deepcopy
+
+from sweep import expand_grid, run_sweep
 
 DATA_FOLDER = r'/Users/juliavaghy/Desktop/0--data'
+# an existing file is resumed: configurations already in it are not run again; a .db path writes the
+# results to an indexed SQLite store instead of a CSV file, see resultstore.py
 data_file = 'data1/nonoise.csv'
+# factorization results are cached here, so rerunning a sweep skips the factorizations
+cache_dir = os.path.join(DATA_FOLDER, 'cache')
+# the time of every pipeline stage of every task is appended here as JSON lines, see instrumentation.py;
+# None disables the instrumentation
+instrumentation_file = None
 
 # init params
 params = {}
@@ -19,63 +22,28 @@ params["window"] = 512
 params["hop"] = int(params["window"]/2)
 params["noise"] = "None"
 params["noise-lvl"] = 0
+# seed of the noise segments mixed into the recordings, see noisebank.py
+params["noise_seed"] = 0
+# start each factorization from the solution of the nearest earlier configuration of the sample in the
+# cache, see sweep.warm_start_chains;
+# this saves NMF iterations, but NMFD always runs its full iteration budget on top of the prior solution
+params["warm_start"] = False
+# map spectrograms and templates onto this many log-frequency bands before factorizing (None keeps
+# all window / 2 + 1 STFT bins); params["filterbank"] = "mel" selects mel bands, see filterbank.py
+params["bands"] = None
+# NMF update rule: "multiplicative" (KL divergence) or "hals" (Euclidean distance, far fewer iterations,
+# best stopped with params["convergence"] = "kl"); NMFD and the batched solvers are multiplicative only
+params["solver"] = "multiplicative"
+# run NMFD coarse-to-fine over these (time decimation factor, iterations) levels instead of at full
+# resolution, e.g. multiresolution.MULTIRES_LEVELS; None keeps the single full-resolution run
+params["nmfd_levels"] = None
 
 nmf_types = ["NMF", "NMFD"]
 fixW_options = ["fixed", "semi", "adaptive"]
 addedCompWs = [0, 1, 2, 3, 4, 5]
 noise_lvls = [0, 1, 2, 3]
 
-while os.path.exists(data_file):
-    data_file = 'data/' + str(randint(0, 100)) + '.csv'
-print(f"Writing results in file {data_file}")
-
-with open(data_file, 'w') as csv_file:
-    header = [key for key, value in params.items() if key != "window" and key != "hop"] + ["Sample", "F", "P", "R"]
-    writer = csv.writer(csv_file)
-    writer.writerow(header)
-
-    for noise_lvl in noise_lvls:
-        if noise_lvl == 0:
-            noises = ["None"]
-        else:
-            noise_dir = "background-loud"
-            noises = ["airplane", "chatter", "ambient"]
-            if noise_lvl == 1:
-                noise_dir = "background"
-            if noise_lvl == 3:
-                noises =[ "mix"]
-
-        params["noise-lvl"] = noise_lvl
-        
-        for fixW_option in fixW_options:
-            params["fixW"] = fixW_option
-            betas = [1, 2, 3, 4, 5, 6]
-            if fixW_option == "adaptive":
-                betas = [0]
-            elif fixW_option == "fixed":
-                betas = [float('inf')]
-            for beta in betas:
-                params["beta"] = beta
-                for addedCompW in addedCompWs:
-                    params["addedCompW"] = addedCompW
-                    for noise in noises:
-                        params["noise"] = noise
-                        for nmf_type in nmf_types:
-                            params["nmf_type"] = nmf_type
-                            print(params)
-
-                            samples = read_data(DATA_FOLDER, params)
-                            precision = np.zeros(len(samples))
-                            recall = np.zeros(len(samples))
-                            f_measure = np.zeros(len(samples))
-
-                            samples = read_data(DATA_FOLDER, params)
-                            for sample_idx in range(len(samples)):
-                                precision[sample_idx], recall[sample_idx], f_measure[sample_idx] = samples[sample_idx].evaluate()
-
-                            print(np.mean(f_measure).round(2))
-
-                            for idx in range(len(samples)):
-                                param_values = [value for key, value in params.items() if key != "window" and key != "hop"] + [samples[idx].dir] + [f_measure[idx], precision[idx], recall[idx]]
-                                print(param_values)
-                                writer.writerow(param_values)
\ No newline at end of file
+if __name__ == "__main__":
+    print(f"Writing results in file {data_file}")
+    configs = expand_grid(params, noise_lvls, fixW_options, addedCompWs, nmf_types)
+    run_sweep(DATA_FOLDER, data_file, configs, cache_dir=cache_dir, instrumentation_path=instrumentation_file)
@@ -0,0 +1,118 @@
+import time
+import numpy as np
+
+from nmfd import NMFD, convModel
+from convergence import iteration_budget
+
+# (time decimation factor, iterations) of every level of multiresolutionNMFD, from coarse to fine
+MULTIRES_LEVELS = [(4, 30), (2, 15), (1, 5)]
+
+def multiresolutionNMFD(V, P_init, params, levels=MULTIRES_LEVELS, H_init=None, P_start=None, info=None):
+    """
+        Coarse-to-fine NMFD: every level runs NMFD on V and the templates decimated in time
+        by its factor (N / factor frames, T / factor lags), starting from the activations and
+        patterns of the previous level, upsampled to full resolution and decimated again.
+        A level of factor f costs about 1 / f^2 of a full-resolution iteration, so the coarse
+        levels place the activations cheaply and a few full-resolution iterations refine them.
+        The semi-adaptive alpha rises once over the iterations of all levels together, so
+        the last level blends the adapted patterns in as NMFD would, rather than every level
+        restarting from the fixed templates (see the schedule argument of NMFD).
+
+        Args:
+            V, P_init, params, H_init, P_start : See NMFD. params["max_iter"] is replaced by
+                the iterations of every level.
+            levels (list of tuple) : (decimation factor, iterations) of every level, from
+                coarse to fine. The last level should have factor 1.
+            info (dict) : Optional dictionary that receives the total number of iterations,
+                whether the last level converged, and the NMFD info of every level in "levels".
+
+        Returns:
+            V_approx, P, H : See NMFD, at full resolution.
+    """
+    K, N = V.shape
+    T = P_init.shape[2]
+    H, P = H_init, P_start
+    level_infos = []
+    first, total = 0, sum(iterations for _, iterations in levels)
+    for factor, iterations in levels:
+        level_info = {}
+        V_approx, P, H = NMFD(decimate(V, factor), decimate(P_init, factor), dict(params, max_iter=iterations),
+                              H_init=None if H is None else decimate(H, factor) * factor,
+                              P_start=None if P is None else decimate(P, factor), info=level_info,
+                              schedule=(first, total))
+        # the schedule follows the level budgets, also if a level converges early
+        first += iterations
+        P = upsample(P, factor, T)
+        H = upsample(H, factor, N) / factor
+        level_infos.append(dict(level_info, factor=factor))
+    if levels[-1][0] != 1:
+        V_approx = convModel(P, H)
+    if info is not None:
+        info.update({"iterations": sum(level_info["iterations"] for level_info in level_infos),
+                     "converged": level_infos[-1]["converged"], "levels": level_infos})
+    return V_approx, P, H
+
+def decimate(X, factor):
+    """
+        Average every factor consecutive frames along the last axis of X; a last, partial
+        block is averaged over the frames it has.
+    """
+    if factor == 1:
+        return X
+    N = X.shape[-1]
+    blocks = -(-N // factor)
+    padded = np.zeros(X.shape[:-1] + (blocks * factor,), dtype=X.dtype)
+    padded[..., :N] = X
+    counts = np.full(blocks, factor, dtype=X.dtype)
+    counts[-1] = N - (blocks - 1) * factor
+    return padded.reshape(X.shape[:-1] + (blocks, factor)).sum(axis=-1) / counts
+
+def upsample(X, factor, N):
+    """
+        Repeat every frame along the last axis of X factor times, truncated to N frames.
+    """
+    if factor == 1:
+        return X
+    return np.repeat(X, factor, axis=-1)[..., :N]
+
+def level_cost(levels):
+    """
+        Cost of a level schedule in full-resolution NMFD iterations: a level of factor f
+        has N / f frames and T / f lags, so an iteration costs about 1 / f^2 of a full one.
+    """
+    return sum(iterations / factor**2 for factor, iterations in levels)
+
+def multiresolution_report(data_folder, params, schedules):
+    """
+        Evaluate every sample with NMFD under every level schedule and print the mean
+        F-measure next to the time spent reading and factorizing the samples.
+
+        Args:
+            data_folder (str) : The main data folder, see reader.read_data.
+            params (dict) : Dictionary of parameters, defined in main.py.
+            schedules (list) : Level schedules, see multiresolutionNMFD; None runs NMFD at
+                full resolution only.
+
+        Returns:
+            scores (list of np.ndarray) : Precision, recall and F-measure of every sample,
+                of size samples x 3, for every schedule.
+    """
+    from reader import read_data
+    from onsets import evaluate_samples
+
+    scores = []
+    for levels in schedules:
+        config = dict(params, nmf_type="NMFD", nmfd_levels=levels)
+        start = time.perf_counter()
+        samples = [sample.load() for sample in read_data(data_folder, config)]
+        elapsed = time.perf_counter() - start
+        scores.append(evaluate_samples(samples)[1])
+        cost = iteration_budget(config, 50) if levels is None else level_cost(levels)
+        print(f"{levels}: F {scores[-1][:, 2].mean():.4f}, {elapsed:.2f} s, "
+              f"at most {cost:.1f} full-resolution iterations")
+    return scores
+
+if __name__ == "__main__":
+    from main import DATA_FOLDER, params
+
+    multiresolution_report(DATA_FOLDER, params, [None, MULTIRES_LEVELS, [(4, 40), (1, 10)], [(2, 40), (1, 10)]])
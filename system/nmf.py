@@ -1,11 +1,14 @@
 import numpy as np
-from copy import deepcopy
 import matplotlib.pyplot as plt
 
+from convergence import Convergence, get_solver
+from precision import get_dtype, eps
+from instrumentation import iteration_callback
+
 EPS = 2.0 ** -52
 
 ## based on https://www.audiolabs-erlangen.de/resources/MIR/FMP/C8/C8S3_NMFbasic.html
-def NMF(V, W_init, params, L = 1000, threshold = 0.001):
+def NMF(V, W_init, params, L = 1000, threshold = 0.001, H_init = None, W_start = None, info = None, workspace = None):
     """
         Non-Negative Matrix Factorization.
 
@@ -16,9 +19,22 @@ def NMF(V, W_init, params, L = 1000, threshold = 0.001):
                 magnitude spectrograms with K spectral bands on T time steps, for each
                 of the R instruments.
             params (dict) : Dictionary of parameters, defined in main.py.
-            L (int) : The number of NMFD iterations.
+            L (int) : The number of NMF iterations, unless params["max_iter"] is set.
             threshold (float) : If the element-wise difference between W and W' and between
-                H and H' is < threshold, the gradient descent stops. 
+                H and H' is < threshold, the gradient descent stops. The criterion is
+                selected by params["convergence"], see convergence.Convergence.
+            H_init (np.ndarray) : Optional initial activations of size (R + addedCompW) x N,
+                replacing the initialization selected by params["initH"].
+            W_start (np.ndarray) : Optional templates of size K x (R + addedCompW) the updates
+                start from, e.g. a warm start, see warmstart.py. W_init stays the reference
+                of fixed and semi-adaptive templates.
+            info (dict) : Optional dictionary that receives the number of iterations run and
+                the objective trace, see convergence.Convergence.trace.
+            workspace (NMFWorkspace) : Optional buffers to reuse, see NMFWorkspace.
+
+            params["solver"] selects the update rule: "multiplicative" (default), the KL
+            multiplicative updates, or "hals", which minimizes the Euclidean distance by
+            updating one row of H and one column of W at a time in closed form, see halsUpdate.
 
         Returns:
             V_approx (np.ndarray) : A 2D numpy array of size K x N,  representing the
@@ -30,43 +46,189 @@ def NMF(V, W_init, params, L = 1000, threshold = 0.001):
     """
     K, N = V.shape
     K, R = W_init.shape
+    # params["precision"] selects the type of all buffers, and EPS follows it
+    dtype = get_dtype(params)
+    EPS = eps(dtype)
+    V = np.asarray(V, dtype=dtype)
 
     # add Q uniformly initialized additional noise template components to W
-    W_init = np.append(W_init, np.ones((K, params["addedCompW"])), axis=1)
+    W_init = np.append(W_init.astype(dtype, copy=False), np.ones((K, params["addedCompW"]), dtype=dtype), axis=1)
     # W_init = np.append(W_init, np.random.rand(K, params["addedCompW"]) + EPS, axis=1)
     R += params["addedCompW"]
 
-    if ("initH" not in params) or (params["initH"] == "uniform"):
-        H = np.ones((R, N))
+    convergence = Convergence(params, L, threshold, iteration_callback("NMF"))
+    L = convergence.L
+    if workspace is None or not workspace.fits(K, R, N, convergence.needs_model(), dtype):
+        workspace = NMFWorkspace(K, R, N, convergence.needs_model(), dtype)
+    ws = workspace
+
+    H = ws.H
+    if H_init is not None:
+        H[...] = H_init
+    elif ("initH" not in params) or (params["initH"] == "uniform"):
+        H.fill(1)
     elif params["initH"] == "random":
-        H = np.random.rand(R, N)
+        H[...] = np.random.rand(R, N)
+    W = ws.W
+    W[...] = W_init if W_start is None else W_start
+    R_fixed = R - params["addedCompW"]
+    if params["fixW"] == "fixed":
+        # a warm start may come from a configuration that adapted the drum templates
+        W[:, :R_fixed] = W_init[:, :R_fixed]
 
-    W = deepcopy(W_init)
-    onesMatrix = np.ones((K, N))
+    if get_solver(params) == "hals":
+        # fixed templates are left out of the W updates instead of being reset after them
+        adapted = range(R_fixed if params["fixW"] == "fixed" else 0, R)
+        for iteration in range(L):
+            if convergence.needs_change(iteration):
+                W_prev, H_prev = ws.W_next, ws.H_next
+                np.copyto(W_prev, W)
+                np.copyto(H_prev, H)
+            if ws.V_approx is not None:
+                np.dot(W, H, out=ws.V_approx)
+            halsUpdate(V, W, H, adapted, ws, EPS)
+            if params["fixW"] == "semi":
+                alpha = (iteration / L)**params["beta"]
+                W[:, :R_fixed] = (1-alpha) * W_init[:, :R_fixed] + alpha * W[:, :R_fixed]
+            if convergence.due(iteration):
+                changes = None
+                if convergence.needs_change(iteration):
+                    changes = [np.subtract(W, W_prev, out=W_prev), np.subtract(H, H_prev, out=H_prev)]
+                if convergence.stop(iteration, V, ws.V_approx, changes):
+                    break
+    elif params["fixW"] == "fixed":
+        ## Equation 2.7 ##
+        # the drum templates stay W_init, so only H and the added noise templates are updated:
+        # the column sums of the drum templates are computed once, and the W update only
+        # correlates Q with the noise activations
+        np.sum(W, axis=0, out=ws.sumW)
+        ws.sumW += EPS
+        noise = slice(R_fixed, R)
+        multNoise = np.empty((R - R_fixed, K), dtype=dtype)
+        for iteration in range(L):
+            Q = np.dot(W, H, out=ws.Q)
+            if ws.V_approx is not None:
+                np.copyto(ws.V_approx, Q)
+            Q += EPS
+            np.divide(V, Q, out=Q)
 
-    for iteration in range(L):
-        V_approx = W.dot(H)
-        Q = V / (V_approx + EPS)
+            np.dot(W.T, Q, out=ws.multH)
+            np.divide(ws.multH, ws.sumW[:, None], out=ws.multH)
+            H_prev, H = H, np.multiply(H, ws.multH, out=ws.H_next)
+            ws.H, ws.H_next = H, H_prev
 
-        ## Equations 2.3 and 2.4 ##
-        H_prev = deepcopy(H)
-        H = H * (W.transpose().dot(Q) / (W.transpose().dot(onesMatrix) + EPS))
-        W_prev = deepcopy(W)
-        W = W * (Q.dot(H.transpose()) / (onesMatrix.dot(H.transpose()) + EPS))
+            W_prev = ws.W_next
+            if convergence.needs_change(iteration):
+                np.copyto(W_prev, W)
+            if R_fixed < R:
+                np.sum(H[noise], axis=1, out=ws.sumH[noise])
+                ws.sumH[noise] += EPS
+                np.dot(H[noise], Q.T, out=multNoise)
+                W[:, noise] *= multNoise.T / ws.sumH[noise]
+                np.sum(W[:, noise], axis=0, out=ws.sumW[noise])
+                ws.sumW[noise] += EPS
 
-        ## Equation 2.7 ##
-        if params["fixW"] == "fixed":
-            W[:, :R-params["addedCompW"]] = W_init[:, :R-params["addedCompW"]]
+            if convergence.due(iteration):
+                changes = None
+                if convergence.needs_change(iteration):
+                    changes = [np.subtract(W, W_prev, out=W_prev), np.subtract(H, H_prev, out=ws.H_next)]
+                if convergence.stop(iteration, V, ws.V_approx, changes):
+                    break
+    else:
+        for iteration in range(L):
+            # Q holds V_approx first and then the ratio V / V_approx
+            Q = np.dot(W, H, out=ws.Q)
+            if ws.V_approx is not None:
+                np.copyto(ws.V_approx, Q)
+            Q += EPS
+            np.divide(V, Q, out=Q)
 
-        ## Equation 2.5 ##
-        elif params["fixW"] == "semi":
-            alpha = (iteration / L)**params["beta"]
-            W[:, :R-params["addedCompW"]] = (1-alpha) * W_init[:, :R-params["addedCompW"]] + alpha * W[:, :R-params["addedCompW"]]
+            ## Equations 2.3 and 2.4 ##
+            # the products with a K x N matrix of ones are the column sums of W and the row sums of H;
+            # the updated matrices are written to the previous iteration's buffers, which are then swapped
+            np.sum(W, axis=0, out=ws.sumW)
+            ws.sumW += EPS
+            np.dot(W.T, Q, out=ws.multH)
+            np.divide(ws.multH, ws.sumW[:, None], out=ws.multH)
+            H_prev, H = H, np.multiply(H, ws.multH, out=ws.H_next)
+            ws.H, ws.H_next = H, H_prev
 
-        W_diff = np.linalg.norm(W - W_prev, ord=2)
-        H_diff = np.linalg.norm(H - H_prev, ord=2)
-        if H_diff < threshold and W_diff < threshold:
-            break
+            np.sum(H, axis=1, out=ws.sumH)
+            ws.sumH += EPS
+            np.dot(Q, H.T, out=ws.multW)
+            np.divide(ws.multW, ws.sumH[None, :], out=ws.multW)
+            W_prev, W = W, np.multiply(W, ws.multW, out=ws.W_next)
+            ws.W, ws.W_next = W, W_prev
 
+            ## Equation 2.5 ##
+            if params["fixW"] == "semi":
+                alpha = (iteration / L)**params["beta"]
+                W[:, :R_fixed] = (1-alpha) * W_init[:, :R_fixed] + alpha * W[:, :R_fixed]
+
+            if convergence.due(iteration):
+                changes = None
+                if convergence.needs_change(iteration):
+                    changes = [np.subtract(W, W_prev, out=ws.W_next), np.subtract(H, H_prev, out=ws.H_next)]
+                if convergence.stop(iteration, V, ws.V_approx, changes):
+                    break
+
+    if info is not None:
+        info.update(convergence.trace())
     V_approx = W.dot(H)
-    return V_approx, W, H
\ No newline at end of file
+    return V_approx, W.copy(), H.copy()
+
+def halsUpdate(V, W, H, adapted, ws, EPS):
+    """
+        One iteration of hierarchical alternating least squares (Cichocki and Phan, 2009)
+        for min ||V - WH||^2 with W, H >= 0: every row of H and then every adapted column
+        of W is set to its nonnegative least squares optimum given all other rows and
+        columns. W and H are updated in place.
+
+        Args:
+            V (np.ndarray) : Spectrogram of size K x N.
+            W (np.ndarray) : Templates of size K x R.
+            H (np.ndarray) : Activations of size R x N.
+            adapted (range) : The columns of W that are updated.
+            ws (NMFWorkspace) : Buffers of the products with V.
+            EPS (float) : Lower bound of the entries, so that no row or column gets stuck at zero.
+    """
+    WtV = np.dot(W.T, V, out=ws.multH)
+    WtW = W.T @ W
+    for r in range(H.shape[0]):
+        H[r] += (WtV[r] - WtW[r] @ H) / (WtW[r, r] + EPS)
+        np.maximum(H[r], EPS, out=H[r])
+    VHt = np.dot(V, H.T, out=ws.multW)
+    HHt = H @ H.T
+    for r in adapted:
+        W[:, r] += (VHt[:, r] - W @ HHt[:, r]) / (HHt[r, r] + EPS)
+        np.maximum(W[:, r], EPS, out=W[:, r])
+
+class NMFWorkspace:
+    """
+        The buffers of one NMF run, allocated once so the iterations allocate no arrays of
+        size K x N. A workspace can be passed to NMF again for a spectrogram of the same
+        size, e.g. the blocks of streaming.stream_factorize.
+
+        Args:
+            _K (int) : The number of spectral bands.
+            _R (int) : The number of components, including the added noise components.
+            _N (int) : The number of time frames.
+            _keep_model (bool) : Keep V_approx next to the ratio Q, for the KL divergence checks.
+            _dtype (np.dtype) : Type of the buffers, see precision.get_dtype.
+    """
+    def __init__(self, _K, _R, _N, _keep_model=False, _dtype=np.float64):
+        self.shape = (_K, _R, _N)
+        self.dtype = np.dtype(_dtype)
+        self.Q = np.empty((_K, _N), dtype=_dtype)
+        self.V_approx = np.empty((_K, _N), dtype=_dtype) if _keep_model else None
+        self.H = np.empty((_R, _N), dtype=_dtype)
+        self.H_next = np.empty((_R, _N), dtype=_dtype)
+        self.W = np.empty((_K, _R), dtype=_dtype)
+        self.W_next = np.empty((_K, _R), dtype=_dtype)
+        self.multH = np.empty((_R, _N), dtype=_dtype)
+        self.multW = np.empty((_K, _R), dtype=_dtype)
+        self.sumW = np.empty(_R, dtype=_dtype)
+        self.sumH = np.empty(_R, dtype=_dtype)
+
+    def fits(self, K, R, N, keep_model=False, dtype=np.float64):
+        return self.shape == (K, R, N) and self.dtype == dtype and (self.V_approx is not None or not keep_model)
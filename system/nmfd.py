@@ -1,10 +1,21 @@
 import numpy as np
 from copy import deepcopy
+from scipy import fft
+import time
+
+from convergence import Convergence, get_solver
+from precision import get_dtype, eps
+from instrumentation import iteration_callback
 
 EPS = 2.0 ** -52
 
+# Number of template time frames from which the FFT backend is faster than the
+# direct one, measured with measureCrossover() for K = 257, R = 4, N = 1000.
+# The direct backend is a single BLAS product, so the FFT only pays off for long templates.
+FFT_CROSSOVER_T = 384
+
 ## based on https://www.audiolabs-erlangen.de/resources/MIR/NMFtoolbox/
-def NMFD(V, P_init, params, L=50, threshold = 0.001):
+def NMFD(V, P_init, params, L=50, threshold = 0.001, H_init = None, P_start = None, info = None, schedule = None):
     """
         Non-Negative Matrix Factor Deconvolution.
 
@@ -15,9 +26,25 @@ def NMFD(V, P_init, params, L=50, threshold = 0.001):
                 magnitude spectrograms with K spectral bands on T time steps, for each
                 of the R instruments.
             params (dict) : Dictionary of parameters, defined in main.py.
-            L (int) : The number of NMFD iterations.
+            L (int) : The number of NMFD iterations, unless params["max_iter"] is set.
             threshold (float) : If the element-wise difference between P and P' and between
-                H and H' is < threshold, the gradient descent stops.
+                H and H' is < threshold, the gradient descent stops. The criterion is
+                selected by params["convergence"], see convergence.Convergence.
+            H_init (np.ndarray) : Optional initial activations of size (R + addedCompW) x N,
+                replacing the initialization selected by params["initH"].
+            P_start (np.ndarray) : Optional pattern tensor of size K x (R + addedCompW) x T the
+                updates start from, e.g. a warm start, see warmstart.py. P_init stays the
+                reference of fixed and semi-adaptive templates.
+            info (dict) : Optional dictionary that receives the number of iterations run and
+                the objective trace, see convergence.Convergence.trace.
+            schedule (tuple) : Optional (first iteration, iterations) of a longer schedule this run
+                is a part of, e.g. a level of multiresolutionNMFD. The semi-adaptive alpha
+                (Equation 2.5) then follows the iteration of that schedule instead of this run's.
+
+            params["nmfd_backend"] selects how the convolutions are computed: "direct",
+            "fft", or "auto" (default), which uses the FFT when T >= FFT_CROSSOVER_T.
+            Only the multiplicative solver is implemented (params["solver"]): an activation row
+            enters T lagged copies of itself, so HALS has no closed-form update of H.
 
         Returns:
             V_approx (np.ndarray) : A 2D numpy array of size K x N,  representing the
@@ -28,74 +55,104 @@ def NMFD(V, P_init, params, L=50, threshold = 0.001):
                 for each of the R instruments over N time steps.
     """
 
+    if get_solver(params) != "multiplicative":
+        raise Exception("NMFD only supports the multiplicative solver")
     # num of spectral bands, num of NMFD components, num of time frames in the component templates
     K, R, T = P_init.shape
     # num of spectral bands, num of time frames in the full spectrogram
     K, N = V.shape
+    # params["precision"] selects the type of all arrays, and EPS follows it
+    dtype = get_dtype(params)
+    EPS = eps(dtype)
+    V = np.asarray(V, dtype=dtype)
 
     #P_init = np.append(P_init, np.random.rand(K, params["addedCompW"], T) + EPS, axis=1)
-    P_init = np.append(P_init, np.ones((K, params["addedCompW"], T)), axis=1)
+    P_init = np.append(P_init.astype(dtype, copy=False), np.ones((K, params["addedCompW"], T), dtype=dtype), axis=1)
     R += params["addedCompW"]
 
     # initalize the activation matrix
-    if ("initH" not in params) or params["initH"] == "uniform":
-        H = np.ones((R, N))
+    if H_init is not None:
+        H = np.array(H_init, dtype=dtype)
+    elif ("initH" not in params) or params["initH"] == "uniform":
+        H = np.ones((R, N), dtype=dtype)
     elif params["initH"] == "random":
-        H = np.random.rand(R, N)
+        H = np.random.rand(R, N).astype(dtype)
 
     if params["beta"] == None:
         params["beta"] = 4
         print("beta 4")
     
-    P = deepcopy(P_init)
-
-    # helper matrix of all ones, denoted as J
-    onesMatrix = np.ones((K, N))
+    P = deepcopy(P_init) if P_start is None else np.array(P_start, dtype=dtype)
+    R_fixed = R - params["addedCompW"]
+    # the components whose patterns are updated: with fixed templates only the added noise
+    # components, so the lag correlations and normalizations of the drum patterns are skipped
+    adapted = slice(0, R)
+    if params["fixW"] == "fixed":
+        ## Equation 2.7 ##
+        P[:, :R_fixed, :] = P_init[:, :R_fixed, :]
+        adapted = slice(R_fixed, R)
+    normP = P / (P.sum(axis=0) + EPS)
+
+    use_fft = selectBackend(params.get("nmfd_backend", "auto"), T) == "fft"
+    n_fft = fft.next_fast_len(N + T - 1, real=True)
+
+    convergence = Convergence(params, L, threshold, iteration_callback("NMFD"))
+    L = convergence.L
+    first, total = (0, L) if schedule is None else schedule
 
     for iteration in range(L):
-        H_prev = deepcopy(H)
-        P_prev = deepcopy(P)
-        V_approx = convModel(P, H)
-
-        # compute the ratio of the input to the model
-        Q = V / (V_approx + EPS)
-
-        # accumulate activation updates here
-        multH = np.zeros((R, N))
+        # P and H are updated in place, so they are only copied when their change is checked
+        if convergence.needs_change(iteration):
+            H_prev = H.copy()
+            P_prev = P.copy()
+
+        if use_fft:
+            H_f = fft.rfft(H, n=n_fft, axis=-1)
+            V_approx = fftConvModel(P, H_f, N, n_fft)
+            Q = V / (V_approx + EPS)
+            Q_f = fft.rfft(Q, n=n_fft, axis=-1)
+            corrP = fftLagCorrelation(Q_f, H_f[adapted], N, T, n_fft)
+        else:
+            # all lagged copies of H at once, R x T x N
+            shiftedH = shiftStack(H, T)
+            V_approx = stackedConvModel(P, shiftedH)
+            # compute the ratio of the input to the model
+            Q = V / (V_approx + EPS)
+            corrP = lagCorrelation(Q, shiftedH[adapted])
 
         ## Equations 2.8 and 2.9 ##
-        for t in range(T):
-            # use tau for shifting and t for indexing
-            tau = deepcopy(t)
-
-            transpH = shiftOperator(H, tau).T
-
-            multP = Q @ transpH / (onesMatrix @ transpH + EPS)
-            P[:, :, t] *= multP
-
-            if params["fixW"] == "fixed":
-                P[:, :R-params["addedCompW"], t] = P_init[:, :R-params["addedCompW"], t]
-
-            ## Equation 2.5 ##            
-            elif params["fixW"] == "semi":
-                alpha = (iteration / L)**params["beta"]
-                P[:, :R-params["addedCompW"], t] = (1-alpha) * P_init[:, :R-params["addedCompW"], t] + alpha * P[:, :R-params["addedCompW"], t]
-
-            transpP = P[:, :, t].T
-            addP = (transpP @ shiftOperator(Q, -tau)) / (transpP @ onesMatrix + EPS)
-            multH += addP
+        # the P update of lag t only depends on Q and the t-shifted H,
+        # so all lags are updated in a single contraction
+        multP = corrP / (laggedSums(H[adapted], T) + EPS)
+        P[:, adapted, :] *= multP
+
+        ## Equation 2.5 ##
+        if params["fixW"] == "semi":
+            alpha = ((first + iteration) / total)**params["beta"]
+            P[:, :R-params["addedCompW"], :] = (1-alpha) * P_init[:, :R-params["addedCompW"], :] + alpha * P[:, :R-params["addedCompW"], :]
+
+        # per-lag H updates, shifted back by their lag and summed
+        normP[:, adapted, :] = P[:, adapted, :] / (P[:, adapted, :].sum(axis=0) + EPS)
+        if use_fft:
+            multH = fftLagProjection(normP, Q_f, N, n_fft)
+        else:
+            multH = shiftSum(lagProjection(normP, Q))
         H *= multH
 
-        H_diff = np.linalg.norm(np.abs(H - H_prev), ord=2)
-        P_diff = np.linalg.norm(np.mean(np.abs(P - P_prev), axis=2), ord=2)
-        if H_diff < threshold and P_diff < threshold:
-            break
+        if convergence.due(iteration):
+            changes = None
+            if convergence.needs_change(iteration):
+                changes = [np.mean(np.abs(P - P_prev), axis=2), np.abs(H - H_prev)]
+            if convergence.stop(iteration, V, V_approx, changes):
+                break
 
+    if info is not None:
+        info.update(convergence.trace())
     V_approx = convModel(P, H)
     return V_approx, P, H
 
 ## taken from https://www.audiolabs-erlangen.de/resources/MIR/NMFtoolbox/
-def convModel(P, H):
+def convModel(P, H, backend="auto"):
     """
         Calculate convolutive approximation of the original magnitude spectrogram V,
         see Equation 1.12.
@@ -106,6 +163,7 @@ def convModel(P, H):
                 of the R instruments.
             H (np.ndarray) : A 2D numpy array of size R x N, representing the activations
                 for each of the R instruments over N time steps.
+            backend (str) : "direct", "fft" or "auto", see selectBackend.
 
         Returns:
             V_approx (np.ndarray) : A 2D numpy array of size K x N, representing the
@@ -113,17 +171,226 @@ def convModel(P, H):
     """
     K, R, T = P.shape
     R, N = H.shape
+    if selectBackend(backend, T) == "fft":
+        n_fft = fft.next_fast_len(N + T - 1, real=True)
+        return fftConvModel(P, fft.rfft(H, n=n_fft, axis=-1), N, n_fft)
+    return stackedConvModel(P, shiftStack(H, T))
+
+def selectBackend(backend, T):
+    """
+        Resolve the convolution backend for templates with T time frames.
+
+        Args:
+            backend (str) : "direct", "fft" or "auto".
+            T (int) : The number of time frames in the templates.
+
+        Returns:
+            backend (str) : "direct" or "fft".
+    """
+    if backend == "auto":
+        return "fft" if T >= FFT_CROSSOVER_T else "direct"
+    if backend not in ("direct", "fft"):
+        raise Exception(f"Unknown NMFD backend {backend}")
+    return backend
+
+def stackedConvModel(P, shiftedH):
+    """
+        Convolutive approximation from precomputed lagged activations, see convModel.
+
+        Args:
+            P (np.ndarray) : A 3D numpy array of size K x R x T.
+            shiftedH (np.ndarray) : A 3D numpy array of size R x T x N, as returned by shiftStack.
+
+        Returns:
+            V_approx (np.ndarray) : A 2D numpy array of size K x N.
+    """
+    K, R, T = P.shape
+    N = shiftedH.shape[-1]
+    # one (K x RT) @ (RT x N) product instead of T separate ones
+    V_approx = P.reshape(K, R * T) @ shiftedH.reshape(R * T, N)
+    V_approx += eps(V_approx.dtype)
+    return V_approx
+
+def lagCorrelation(Q, shiftedH):
+    """
+        Correlate the ratio matrix Q with every lagged copy of H, i.e. compute
+        Q @ shiftOperator(H, t).T for all lags t at once.
+
+        Args:
+            Q (np.ndarray) : A 2D numpy array of size K x N.
+            shiftedH (np.ndarray) : A 3D numpy array of size R x T x N, as returned by shiftStack.
+
+        Returns:
+            corr (np.ndarray) : A 3D numpy array of size K x R x T.
+    """
+    K, N = Q.shape
+    R, T, N = shiftedH.shape
+    return (Q @ shiftedH.reshape(R * T, N).T).reshape(K, R, T)
+
+def lagProjection(P, Q):
+    """
+        Project Q onto every lag of the templates, i.e. compute P[:, :, t].T @ Q for all lags t at once.
+
+        Args:
+            P (np.ndarray) : A 3D numpy array of size K x R x T.
+            Q (np.ndarray) : A 2D numpy array of size K x N.
+
+        Returns:
+            proj (np.ndarray) : A 3D numpy array of size R x T x N.
+    """
+    K, R, T = P.shape
+    K, N = Q.shape
+    return (P.reshape(K, R * T).T @ Q).reshape(R, T, N)
+
+def laggedSums(H, T):
+    """
+        Row sums of the shifted activations shiftOperator(H, t) for t = 0, ..., T-1.
 
-    V_approx = np.zeros((K, N))
+        Args:
+            H (np.ndarray) : An array of size ... x R x N.
+            T (int) : The number of lags.
 
-    for k in range(T):
-        multResult = P[:, :, k] @ shiftOperator(H, k)
-        V_approx += multResult
+        Returns:
+            sums (np.ndarray) : An array of size ... x R x T, where sums[..., r, t] = sum of H[..., r, :N-t].
+    """
+    N = H.shape[-1]
+    cumulative = np.cumsum(H, axis=-1)
+    last = N - 1 - np.arange(T)
+    sums = cumulative[..., np.maximum(last, 0)]
+    sums[..., last < 0] = 0
+    return sums
+
+def fftConvModel(P, H_f, N, n_fft):
+    """
+        Convolutive approximation computed in the frequency domain, see convModel.
 
-    V_approx += EPS
+        Args:
+            P (np.ndarray) : A 3D numpy array of size K x R x T.
+            H_f (np.ndarray) : The real FFT of the activations along time, of size R x (n_fft/2 + 1).
+            N (int) : The number of time frames in the activations.
+            n_fft (int) : FFT length, at least N + T - 1 so that the convolution does not wrap around.
 
+        Returns:
+            V_approx (np.ndarray) : A 2D numpy array of size K x N.
+    """
+    P_f = fft.rfft(P, n=n_fft, axis=-1)
+    V_approx = fft.irfft(np.einsum('krf,rf->kf', P_f, H_f), n=n_fft, axis=-1)[:, :N]
+    # round-off can leave tiny negative values where the model is zero
+    np.maximum(V_approx, 0, out=V_approx)
+    V_approx += eps(V_approx.dtype)
     return V_approx
 
+def fftLagCorrelation(Q_f, H_f, N, T, n_fft):
+    """
+        Frequency-domain counterpart of lagCorrelation.
+
+        Args:
+            Q_f (np.ndarray) : The real FFT of Q along time, of size K x (n_fft/2 + 1).
+            H_f (np.ndarray) : The real FFT of H along time, of size R x (n_fft/2 + 1).
+            N (int) : The number of time frames in Q and H.
+            T (int) : The number of lags.
+            n_fft (int) : FFT length, at least N + T - 1.
+
+        Returns:
+            corr (np.ndarray) : A 3D numpy array of size K x R x T.
+    """
+    corr = fft.irfft(Q_f[:, None, :] * np.conj(H_f)[None, :, :], n=n_fft, axis=-1)[:, :, :T]
+    # lags beyond the signal length only hold round-off
+    corr[:, :, N:] = 0
+    return np.maximum(corr, 0)
+
+def fftLagProjection(P, Q_f, N, n_fft):
+    """
+        Frequency-domain counterpart of shiftSum(lagProjection(P, Q)).
+
+        Args:
+            P (np.ndarray) : A 3D numpy array of size K x R x T.
+            Q_f (np.ndarray) : The real FFT of Q along time, of size K x (n_fft/2 + 1).
+            N (int) : The number of time frames in Q.
+            n_fft (int) : FFT length, at least N + T - 1.
+
+        Returns:
+            summed (np.ndarray) : A 2D numpy array of size R x N.
+    """
+    P_f = fft.rfft(P, n=n_fft, axis=-1)
+    summed = fft.irfft(np.einsum('krf,kf->rf', np.conj(P_f), Q_f), n=n_fft, axis=-1)[:, :N]
+    return np.maximum(summed, 0)
+
+def measureCrossover(K=257, R=4, N=1000, lags=(32, 64, 128, 192, 256, 320, 384, 448, 512, 768), repeats=3):
+    """
+        Time one NMFD iteration with both backends and find the smallest number of
+        template frames T for which the FFT backend is faster. Used to set FFT_CROSSOVER_T.
+
+        Args:
+            K, R, N (int) : Size of the benchmarked problem.
+            lags (iterable of int) : Template lengths T to try, in increasing order.
+            repeats (int) : The best of this many runs is kept for each measurement.
+
+        Returns:
+            crossover (int) : The first T at which the FFT backend wins, or None.
+            timings (list of tuple) : (T, direct seconds, fft seconds) for every T tried.
+    """
+    rng = np.random.default_rng(0)
+    V = rng.random((K, N))
+    params = {"addedCompW": 0, "fixW": "adaptive", "beta": 0}
+    timings = []
+    crossover = None
+    for T in lags:
+        P_init = rng.random((K, R, T))
+        best = {}
+        for backend in ("direct", "fft"):
+            params["nmfd_backend"] = backend
+            runs = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                NMFD(V, P_init, params, L=1)
+                runs.append(time.perf_counter() - start)
+            best[backend] = min(runs)
+        timings.append((T, best["direct"], best["fft"]))
+        if crossover is None and best["fft"] < best["direct"]:
+            crossover = T
+    return crossover, timings
+
+def shiftStack(H, T):
+    """
+        Stack the shifted activations shiftOperator(H, t) for t = 0, ..., T-1 without
+        copying H once per lag. The result is a read-only sliding-window view.
+
+        Args:
+            H (np.ndarray) : An array of size ... x R x N.
+            T (int) : The number of lags.
+
+        Returns:
+            shiftedH (np.ndarray) : An array of size ... x R x T x N, where
+                shiftedH[..., r, t, n] = H[..., r, n - t] (zero for n < t).
+    """
+    N = H.shape[-1]
+    padding = [(0, 0)] * (H.ndim - 1) + [(T - 1, 0)]
+    padded = np.pad(H, padding)
+    # window i starts at frame i of the padded array, i.e. it is H shifted by T-1-i
+    windows = np.lib.stride_tricks.sliding_window_view(padded, N, axis=-1)
+    return windows[..., ::-1, :]
+
+def shiftSum(A):
+    """
+        Shift every lag of A back to the left by its lag and sum over the lags, i.e. compute
+        the sum over t of shiftOperator(A[..., t, :], -t).
+
+        Args:
+            A (np.ndarray) : An array of size ... x T x N.
+
+        Returns:
+            summed (np.ndarray) : An array of size ... x N, where
+                summed[..., n] = sum_t A[..., t, n + t] (terms with n + t >= N are zero).
+    """
+    T, N = A.shape[-2:]
+    padding = [(0, 0)] * (A.ndim - 1) + [(0, T - 1)]
+    padded = np.pad(A, padding)
+    # stepping one lag and one frame at a time walks along the diagonals
+    strides = padded.strides[:-2] + (padded.strides[-2] + padded.strides[-1], padded.strides[-1])
+    diagonals = np.lib.stride_tricks.as_strided(padded, shape=A.shape, strides=strides, writeable=False)
+    return diagonals.sum(axis=-2)
+
 ## taken from https://www.audiolabs-erlangen.de/resources/MIR/NMFtoolbox/
 def shiftOperator(A, shiftAmount):
     """
@@ -148,4 +415,10 @@ def shiftOperator(A, shiftAmount):
     elif shiftAmount > 0:
         shifted[:, 0: shiftAmount] = 0
 
-    return shifted
\ No newline at end of file
+    return shifted
+
+if __name__ == "__main__":
+    crossover, timings = measureCrossover()
+    for T, direct, fft_time in timings:
+        print(f"T={T}: direct {direct * 1000:.1f} ms, fft {fft_time * 1000:.1f} ms")
+    print(f"FFT backend is faster from T={crossover}")
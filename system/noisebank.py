@@ -0,0 +1,98 @@
+import os
+import zlib
+import numpy as np
+
+from specstore import load_spectrogram
+from precision import get_dtype
+
+# parameters that determine the noise segment mixed into a recording, next to the sample and recording
+NOISE_KEYS = ["noise", "noise-lvl", "window", "noise_seed"]
+
+class NoiseBank:
+    """
+        In-memory bank of the background noise spectrograms, shared by all samples of a process.
+        Every (noise, level, window) spectrogram is loaded once, from the memory-mapped
+        spectrogram store if stfts.py has written it (see specstore.py), so worker processes
+        share its pages. The banked spectrograms are read-only and in the stored type; a segment
+        is converted to params["precision"] as it is mixed in.
+
+        The segment mixed into a recording starts at an offset drawn from a generator seeded
+        by the sample, the recording and NOISE_KEYS, so a noisy run is reproducible and its
+        factorizations can be cached. Configurations that only differ in the factorization
+        (e.g. fixW or addedCompW) mix the same segments, so they are compared on the same noise.
+
+        Args:
+            _root (str) : The main data folder, holding the background and background-loud folders.
+                Set by configure, which reader.read_sample calls with its data folder.
+    """
+    def __init__(self, _root=None):
+        self.root = _root
+        self.spectrograms = {}  # (noise, level, window) -> spectrogram
+
+    def noise_file(self, params):
+        if self.root is None:
+            raise Exception("No data folder configured for the background noises, see noisebank.configure")
+        noise_dir = "background" if params["noise-lvl"] == 1 else "background-loud"
+        return os.path.join(self.root, noise_dir, f'{params["noise"]}.wav')
+
+    def get(self, params):
+        """
+            The noise spectrogram of params["noise"] at params["noise-lvl"], of size K x N_noise.
+        """
+        key = (params["noise"], params["noise-lvl"], params["window"])
+        if key not in self.spectrograms:
+            noise = load_spectrogram(self.noise_file(params), params["window"])
+            if noise.flags.writeable:
+                noise.setflags(write=False)
+            self.spectrograms[key] = noise
+        return self.spectrograms[key]
+
+    def offset(self, params, sample, recording, N):
+        """
+            Start frame of the noise segment of N frames mixed into a recording of a sample.
+            It is drawn uniformly from the offsets at which the segment fits into the noise, by a
+            generator seeded with a stable hash of the sample, the recording and NOISE_KEYS.
+        """
+        N_noise = self.get(params).shape[1]
+        if N_noise - N < 1:
+            raise Exception(f"{self.noise_file(params)} has {N_noise} frames, too few to mix into {N} frames of {recording}")
+        seed_key = "|".join([str(sample), os.path.basename(recording)] + [str(params.get(key)) for key in NOISE_KEYS])
+        rng = np.random.default_rng(zlib.crc32(seed_key.encode()))
+        return int(rng.integers(0, N_noise - N))
+
+    def mix(self, Y, params, sample, recording):
+        """
+            Superpose the magnitude spectrogram Y of a recording with its noise segment, see offset.
+
+            Args:
+                Y (np.ndarray) : Magnitude spectrogram of size K x N.
+                params (dict) : Dictionary of parameters, defined in main.py.
+                sample (str) : The sample the recording is read for.
+                recording (str) : Path to the recording, the drum loop or a kit instrument.
+
+            Returns:
+                Y_noisy (np.ndarray) : A new spectrogram of size K x N, in the type of params["precision"]
+                    (see precision.get_dtype).
+        """
+        noise = self.get(params)
+        start = self.offset(params, sample, recording, Y.shape[1])
+        return np.add(Y, noise[:, start:start + Y.shape[1]], dtype=get_dtype(params))
+
+    def clear(self):
+        self.spectrograms.clear()
+
+_bank = NoiseBank()
+
+def configure(root):
+    """
+        Read the background noises from the data folder root. The bank is emptied if root changes.
+    """
+    if _bank.root is None or os.path.abspath(root) != os.path.abspath(_bank.root):
+        _bank.root = root
+        _bank.clear()
+
+def get_noise_bank():
+    """
+        The process-wide noise bank.
+    """
+    return _bank
@@ -0,0 +1,180 @@
+import json
+import os
+import numpy as np
+from mido import MidiFile
+
+# files of the onset index in the data folder, next to the spectrogram stores (see specstore.py)
+INDEX_FILE = "onsets.json"
+DATA_FILE = "onsets.npz"
+# bump when parse_midi changes, so that index entries written before are parsed again
+INDEX_VERSION = 2
+
+def parse_midi(midi_file, bpm):
+    """
+        Ground-truth onsets of a drum loop's MIDI file: every note_on message is an onset
+        of the instrument with its note. The recording plays the loop at bpm beats per
+        minute whatever tempo the MIDI file is written at, so a tick lasts
+        60 / (bpm * ticks_per_beat) seconds.
+
+        Args:
+            midi_file (str) : Path to the MIDI file.
+            bpm (int) : BPM of the recording, from its info.txt.
+
+        Returns:
+            ticks (dict of int: np.ndarray) : MIDI note -> sorted onset ticks.
+            tick_duration (float) : Seconds per tick.
+    """
+    mid = MidiFile(midi_file, clip=True)
+    ticks = 0
+    onsets = {}
+    for msg in mid.tracks[0]:
+        # delta times count from the previous message, meta messages included
+        ticks += msg.time
+        if msg.type == 'note_on':
+            onsets.setdefault(msg.note, []).append(ticks)
+    tick_duration = 60 / (bpm * mid.ticks_per_beat)
+    return {note: np.array(note_ticks, dtype=np.int64) for note, note_ticks in sorted(onsets.items())}, tick_duration
+
+class OnsetIndex:
+    """
+        Precompiled ground-truth onsets of the drum loops of a data folder, so that reading
+        a sample does not parse its MIDI file. The onset ticks and seconds of all instruments
+        of all samples are stored back to back in two arrays of a .npz file, and a JSON index
+        maps each MIDI file (relative to the data folder) to its BPM, tick duration and the
+        range of every note in the arrays. The index is written by compile_onsets.
+
+        An entry is only used while the size and modification time of its MIDI file, its BPM
+        and INDEX_VERSION are unchanged.
+
+        Args:
+            _root (str) : The main data folder, see reader.read_data. The index files are kept here.
+    """
+    def __init__(self, _root):
+        self.root = _root
+        self.index_file = os.path.join(self.root, INDEX_FILE)
+        self.data_file = os.path.join(self.root, DATA_FILE)
+        self.index = {}
+        self.ticks = np.zeros(0, dtype=np.int64)
+        self.seconds = np.zeros(0)
+        if os.path.exists(self.index_file) and os.path.exists(self.data_file):
+            with open(self.index_file) as index_file:
+                self.index = json.load(index_file)
+            with np.load(self.data_file) as data:
+                self.ticks = data["ticks"]
+                self.seconds = data["seconds"]
+            for array in (self.ticks, self.seconds):
+                array.setflags(write=False)
+
+    def key(self, midi_file):
+        return os.path.relpath(os.path.abspath(midi_file), os.path.abspath(self.root)).replace(os.sep, "/")
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, midi_file, bpm):
+        """
+            The onsets of a MIDI file, or None if it is not indexed or has changed since.
+
+            Returns:
+                onsets (dict of int: (np.ndarray, np.ndarray)) : MIDI note -> sorted onset ticks
+                    and seconds, read-only views into the index arrays.
+                tick_duration (float) : Seconds per tick.
+        """
+        entry = self.index.get(self.key(midi_file))
+        if entry is None or entry.get("version") != INDEX_VERSION or entry["bpm"] != bpm:
+            return None
+        stat = os.stat(midi_file)
+        if (entry["size"], entry["mtime"]) != (stat.st_size, stat.st_mtime):
+            return None
+        onsets = {int(note): (self.ticks[start:end], self.seconds[start:end]) for note, (start, end) in entry["notes"].items()}
+        return onsets, entry["tick_duration"]
+
+    def add(self, midi_file, bpm, ticks, tick_duration):
+        """
+            Add or replace the onsets of a MIDI file, see parse_midi. The index is written by save.
+        """
+        stat = os.stat(midi_file)
+        notes = {}
+        start = len(self.ticks)
+        for note, note_ticks in ticks.items():
+            notes[str(note)] = [start, start + len(note_ticks)]
+            start += len(note_ticks)
+        all_ticks = np.concatenate([note_ticks for note_ticks in ticks.values()] or [np.zeros(0, dtype=np.int64)])
+        self.ticks = np.concatenate([self.ticks, all_ticks])
+        self.seconds = np.concatenate([self.seconds, all_ticks * tick_duration])
+        self.index[self.key(midi_file)] = {"version": INDEX_VERSION, "bpm": bpm, "tick_duration": tick_duration, "notes": notes,
+                                           "size": stat.st_size, "mtime": stat.st_mtime}
+
+    def save(self):
+        """
+            Write the index, dropping the array ranges of replaced entries.
+        """
+        ranges = [(start, end) for entry in self.index.values() for start, end in entry["notes"].values()]
+        order = np.concatenate([np.arange(start, end) for start, end in ranges] or [np.zeros(0, dtype=np.int64)])
+        position = 0
+        for entry in self.index.values():
+            for note, (start, end) in entry["notes"].items():
+                entry["notes"][note] = [position, position + end - start]
+                position += end - start
+        self.ticks, self.seconds = self.ticks[order], self.seconds[order]
+        with open(self.data_file + ".tmp", 'wb') as data_file:
+            np.savez(data_file, ticks=self.ticks, seconds=self.seconds)
+        os.replace(self.data_file + ".tmp", self.data_file)
+        with open(self.index_file + ".tmp", 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+_indices = {}
+
+def configure(root):
+    """
+        Make get_onsets read the drum loops under root from their onset index, if compile_onsets has written it.
+    """
+    key = os.path.abspath(root)
+    if key not in _indices:
+        _indices[key] = OnsetIndex(root)
+
+def get_onsets(midi_file, bpm):
+    """
+        The onsets of a drum loop from a configured onset index, see OnsetIndex.get, and
+        parsed from its MIDI file if no index holds them.
+    """
+    for index in list(_indices.values()):
+        if len(index) > 0:
+            onsets = index.get(midi_file, bpm)
+            if onsets is not None:
+                return onsets
+    ticks, tick_duration = parse_midi(midi_file, bpm)
+    return {note: (note_ticks, note_ticks * tick_duration) for note, note_ticks in ticks.items()}, tick_duration
+
+def compile_onsets(data_folder):
+    """
+        Index the onsets of every drum loop in data_folder, given by its MIDI file and the
+        BPM in its info.txt. Drum loops whose entry is up to date are skipped.
+    """
+    index = OnsetIndex(data_folder)
+    drum_loops = os.path.join(data_folder, "drum-loops")
+    compiled = 0
+    sample_directories = sorted(item for item in os.listdir(drum_loops) if os.path.isdir(os.path.join(drum_loops, item)))
+    for sample_directory in sample_directories:
+        directory = os.path.join(drum_loops, sample_directory)
+        midi_files = [item for item in os.listdir(directory) if item.endswith(".mid")]
+        if len(midi_files) != 1 or not os.path.exists(os.path.join(directory, "info.txt")):
+            print(f"There should be a single MIDI file and an info.txt in {sample_directory}")
+            continue
+        midi_file = os.path.join(directory, midi_files[0])
+        with open(os.path.join(directory, "info.txt")) as info_file:
+            bpm = int(info_file.readline().split()[0])
+        if index.get(midi_file, bpm) is None:
+            index.add(midi_file, bpm, *parse_midi(midi_file, bpm))
+            compiled += 1
+    index.save()
+    # a process that has configured data_folder reads the new index from now on
+    _indices[os.path.abspath(data_folder)] = index
+    print(f"Onset index: {compiled} of {len(sample_directories)} drum loops compiled, the others are up to date")
+    return index
+
+if __name__ == "__main__":
+    from main import DATA_FOLDER
+
+    compile_onsets(DATA_FOLDER)
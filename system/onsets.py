@@ -0,0 +1,185 @@
+import numpy as np
+
+# onset tolerance (s) of the evaluation, see Section 2.5
+TOLERANCE = 0.05
+
+def floating(X):
+    """
+        X as a floating point array, keeping float32 (see precision.get_dtype) and converting anything else to float64.
+    """
+    X = np.asarray(X)
+    return X if X.dtype in (np.float32, np.float64) else X.astype(np.float64)
+
+def local_average(X, avg_window=3):
+    """
+        Centered moving average (Equation 2.15) of every row of X, with zero padding at both
+        ends, as a box-filter convolution. The window is summed in the same order as
+        np.mean in Instrument.local_avg, so the results are identical.
+
+        Args:
+            X (np.ndarray) : Matrix of size R x N, or a single row.
+            avg_window (int) : Half width of the window.
+
+        Returns:
+            smoothed (np.ndarray) : Moving average of the same shape as X.
+    """
+    X = floating(X)
+    N = X.shape[-1]
+    padded = np.zeros(X.shape[:-1] + (N + 2 * avg_window,), dtype=X.dtype)
+    padded[..., avg_window:avg_window + N] = X
+    smoothed = padded[..., :N].copy()
+    for shift in range(1, 2 * avg_window + 1):
+        smoothed += padded[..., shift:shift + N]
+    return smoothed / (2 * avg_window + 1)
+
+def enhanced_novelty(H, avg_window=3):
+    """
+        Enhanced novelty (Equations 2.13 to 2.16) of every activation row of H.
+    """
+    H = floating(H)
+    novelty = np.zeros(H.shape, dtype=H.dtype)
+    novelty[:, :-1] = np.maximum(np.diff(H, axis=1), 0)
+    return np.maximum(novelty - local_average(novelty, avg_window), 0)
+
+def pick_peaks(X, heights):
+    """
+        Local maxima of every row of X that reach the row's height, with the semantics of
+        scipy.signal.find_peaks: a peak rises strictly before and falls strictly after,
+        a flat peak is reported at its middle sample, and the first and last samples of a
+        row are never peaks.
+
+        Args:
+            X (np.ndarray) : Matrix of size R x N.
+            heights (np.ndarray) : Minimal peak height of every row, of size R.
+
+        Returns:
+            (rows, cols) : Row and column indices of the peaks, ordered by row and then by column.
+    """
+    # sign changes of each row, with the flat stretches dropped
+    rows, cols = np.nonzero(np.diff(X, axis=1))
+    signs = np.sign(X[rows, cols + 1] - X[rows, cols])
+    # a rise at cols[i] followed, in the same row, by a fall at cols[i + 1]
+    peak = (signs[:-1] > 0) & (signs[1:] < 0) & (rows[:-1] == rows[1:])
+    left = cols[:-1][peak] + 1
+    right = cols[1:][peak]
+    rows = rows[:-1][peak]
+    cols = (left + right) // 2
+    keep = X[rows, cols] >= np.asarray(heights)[rows]
+    return rows[keep], cols[keep]
+
+def detect_onsets(H, THETA, hop, Fs=22050, avg_window=3):
+    """
+        Onset detection of Section 2.4 on all activation rows of H at once, giving the same
+        onsets as Instrument.find_onsets row by row.
+
+        Args:
+            H (np.ndarray) : Activations of size R x N.
+            THETA (float) : Threshold divisor, see Instrument.THETA.
+            hop (int) : STFT hop size.
+            Fs (int) : Sample rate of the recording.
+            avg_window (int) : Half width of the local average.
+
+        Returns:
+            onsets (list of np.ndarray) : The onset times (s) of every row.
+    """
+    enhanced = enhanced_novelty(H, avg_window)
+    ## Equation 2.17 ##
+    rows, cols = pick_peaks(enhanced, enhanced.max(axis=1) / THETA)
+    times = cols / (Fs / hop)
+    return np.split(times, np.searchsorted(rows, np.arange(1, enhanced.shape[0])))
+
+def match_onsets(detections, ground_truth, tolerance=TOLERANCE):
+    """
+        Count the true positives, false positives and false negatives of many instruments at
+        once, with the matching of Instrument.evaluate: every ground truth onset, in order, is
+        matched to the nearest detection not before the last matched one, if within tolerance.
+        Detections skipped on the way are false positives.
+        The nearest detections are found with one sorted-array search over all instruments,
+        and the matching of all onsets of all instruments is solved together, see below.
+        It pays off for many instruments at once; Instrument.evaluate matches a single one.
+
+        Args:
+            detections (list of np.ndarray) : Sorted detected onset times (s) of every instrument.
+            ground_truth (list of np.ndarray) : Sorted ground truth onset times (s) of every instrument.
+            tolerance (float) : Maximal distance (s) of a true positive.
+
+        Returns:
+            (tp, fp, fn) : Arrays of counts, one entry per instrument.
+    """
+    n_instruments = len(detections)
+    n_detections = np.array([len(d) for d in detections], dtype=np.int64)
+    n_truth = np.array([len(g) for g in ground_truth], dtype=np.int64)
+    # detections are indexed in the concatenation of all instruments' detections, the
+    # detections of instrument i being first[i] to end[i] - 1
+    end = np.cumsum(n_detections)
+    first = end - n_detections
+    times = np.concatenate([np.asarray(d, dtype=np.float64) for d in detections] + [[np.inf]])
+    truth = np.zeros((n_instruments, n_truth.max(initial=0)))
+    for i, g in enumerate(ground_truth):
+        truth[i, :len(g)] = g
+
+    # shift every instrument's times into its own range, so one sorted array holds them all
+    span = max(times[:-1].max(initial=0), truth.max(initial=0)) + 2 * tolerance + 1
+    offsets = np.arange(n_instruments) * span
+    shifted = times[:-1] + np.repeat(offsets, n_detections)
+    # nearest detection of every ground truth onset, the earlier one on a tie
+    after = np.searchsorted(shifted, truth + offsets[:, None])
+    before = np.maximum(after - 1, first[:, None])
+    after = np.minimum(after, np.maximum(end - 1, first)[:, None])
+    nearest = np.where(np.abs(times[after] - truth) < np.abs(times[before] - truth), after, before)
+
+    # the matched detection j[k] of the k-th ground truth onset is the nearest one not before
+    # the first unmatched detection idx[k] = j[k - 1] + hit[k - 1] (distances grow away from
+    # the nearest detection). j is found as the fixed point of that recurrence, evaluated for
+    # all k at once: starting from the lower bound nearest, every pass settles at least one
+    # more onset, and it ends after the longest chain of onsets sharing a detection.
+    # Instruments without detections have first == end and count no matches.
+    j = nearest
+    while True:
+        hit = (j < end[:, None]) & (np.abs(times[j] - truth) <= tolerance)
+        idx = np.concatenate([first[:, None], (j + hit)[:, :-1]], axis=1)
+        j_next = np.maximum(nearest, idx)
+        if (j_next == j).all():
+            break
+        j = j_next
+    valid = np.arange(truth.shape[1]) < n_truth[:, None]
+    exhausted = valid & (idx >= end[:, None])
+    active = valid & ~exhausted
+    hit &= active
+    tp = hit.sum(axis=1)
+    fp = np.where(active, j - idx, 0).sum(axis=1)
+    fn = exhausted.sum(axis=1) + (active & ~hit).sum(axis=1)
+    # first detection that is still unmatched after the last ground truth onset
+    unmatched = np.concatenate([first[:, None], j + hit], axis=1)
+    final = np.minimum(unmatched[np.arange(n_instruments), n_truth], end)
+    # as in Instrument.evaluate, one unmatched detection after the last match is not counted
+    fp += np.maximum(end - final - 1, 0)
+    return tp, fp, fn
+
+def evaluate_samples(samples, tolerance=TOLERANCE):
+    """
+        Evaluate the detected onsets of every instrument of every sample in one call.
+        The counts are the same as those of Sample.evaluate, which accumulates them per instrument.
+
+        Args:
+            samples (list of Sample) : Factorized samples, see reader.read_data.
+            tolerance (float) : Maximal distance (s) of a true positive.
+
+        Returns:
+            counts (list of np.ndarray) : TP, FP and FN of every instrument, one R x 3 array per sample.
+            scores (np.ndarray) : Precision, recall and F-measure of every sample, of size len(samples) x 3.
+    """
+    instruments = [instrument for sample in samples for instrument in sample.instrument_codes.values()]
+    detections = [instrument.nmf_onsets for instrument in instruments]
+    ground_truth = [instrument.midi_onset_seconds for instrument in instruments]
+    tp, fp, fn = match_onsets(detections, ground_truth, tolerance)
+    counts = np.stack([tp, fp, fn], axis=1)
+    bounds = np.cumsum([len(sample.instrument_codes) for sample in samples])[:-1]
+    counts = np.split(counts, bounds)
+    totals = np.array([c.sum(axis=0) for c in counts], dtype=np.float64).reshape(-1, 3)
+    tp, fp, fn = totals.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = tp / (tp + fp)
+        recall = tp / (tp + fn)
+        f_measure = (2 * tp) / (2 * tp + fp + fn)
+    return counts, np.stack([precision, recall, f_measure], axis=1)
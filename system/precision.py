@@ -0,0 +1,58 @@
+import time
+import numpy as np
+
+# floating point types selectable with params["precision"]
+PRECISIONS = {"float64": np.float64, "float32": np.float32}
+
+def get_dtype(params):
+    """
+        The floating point type of the spectrograms, templates, factorizations and onset
+        detection, selected by params["precision"] ("float64" by default).
+    """
+    precision = params.get("precision", "float64")
+    if precision not in PRECISIONS:
+        raise Exception(f"Unknown precision {precision}, use one of {list(PRECISIONS)}")
+    return np.dtype(PRECISIONS[precision])
+
+def eps(dtype):
+    """
+        The constant added to denominators to avoid divisions by zero: the machine epsilon
+        of dtype, 2^-52 for float64 as EPS elsewhere, and 2^-23 for float32.
+    """
+    return np.finfo(dtype).eps
+
+def precision_report(data_folder, params):
+    """
+        Evaluate every sample in float64 and in float32 and print the scores side by side,
+        with the time spent reading and factorizing the samples in each precision.
+
+        Returns:
+            scores (dict of str: np.ndarray) : Precision, recall and F-measure of every sample,
+                of size samples x 3, for "float64" and "float32".
+    """
+    from reader import list_sample_directories, read_sample
+    from onsets import evaluate_samples
+
+    sample_directories = list_sample_directories(data_folder)
+    scores = {}
+    for precision in PRECISIONS:
+        config = dict(params, precision=precision)
+        start = time.perf_counter()
+        samples = [read_sample(data_folder, sample_directory, config) for sample_directory in sample_directories]
+        samples = [sample.load() for sample in samples if sample is not None]
+        elapsed = time.perf_counter() - start
+        scores[precision] = evaluate_samples(samples)[1]
+        print(f"{precision}: {elapsed:.2f} s")
+    for sample, double, single in zip(samples, scores["float64"], scores["float32"]):
+        print(f"{sample.dir}: F {double[2]:.4f} (float64) {single[2]:.4f} (float32)")
+    difference = np.abs(scores["float64"] - scores["float32"])
+    print(f"Mean F: {scores['float64'][:, 2].mean():.4f} (float64) {scores['float32'][:, 2].mean():.4f} (float32), "
+          f"largest difference in P/R/F: {difference.max(axis=0).round(4)}")
+    return scores
+
+if __name__ == "__main__":
+    from main import DATA_FOLDER, params
+
+    for nmf_type in ["NMF", "NMFD"]:
+        print(nmf_type)
+        precision_report(DATA_FOLDER, dict(params, nmf_type=nmf_type))
@@ -1,13 +1,22 @@
-import glob
+import json
 import os
+import threading
 
 from Sample import Sample
-from Instrument import Instrument
+from batch import factorize_samples
+import specstore
+import noisebank
+import onsetindex
 
-def read_data(data_folder, params):
+# dataset manifest written to the data folder, see load_manifest
+MANIFEST_FILE = "dataset-manifest.json"
+
+def read_data(data_folder, params, batch=False):
     """
         Main loop for reading data. If data in a sample does not align with the required format, it is skipped
         (not included in evaluation), and the user is notified via a message printed to the terminal.
+        The samples are lazy: they are loaded and factorized when their instruments, labels or
+        scores are first accessed, see Sample. The dataset is listed from its manifest, see load_manifest.
         Parameters:
             data_folder (srt): The main folder in which the samples are located, structured as:
                 data
@@ -72,41 +81,165 @@ def read_data(data_folder, params):
                     |       \-- closed-hi-hat-512.npy
                     ...
             
+            params (dict) : Dictionary of parameters, defined in main.py.
+            batch (bool): If True, all samples are factorized together with batch.factorize_samples
+                instead of one at a time.
+
         Returns:
             ndarray Sample : An array of Sample objects, extracted from the specified data folder. 
     """
     samples = []
-    os.chdir(os.path.join(data_folder, "drum-loops"))
-    sample_directories = [item for item in os.listdir() if os.path.isdir(item)]
-    for sample_directory in sample_directories:
-        os.chdir(os.path.join(data_folder, "drum-loops", sample_directory))
-        make_path = lambda f : os.path.join(data_folder, "drum-loops", sample_directory, f)
-        if len(glob.glob("*.mid")) != 1:
-            print(f"There should be a single MIDI file in {sample_directory}")
+    for sample_directory in list_sample_directories(data_folder):
+        sample = read_sample(data_folder, sample_directory, params, factorize=not batch)
+        if sample is not None:
+            samples.append(sample)
+    if batch:
+        factorize_samples([sample.nmf_labels for sample in samples], params)
+    return samples
+
+def list_sample_directories(data_folder):
+    """
+        Names of the sample directories in data_folder/drum-loops, see read_data.
+    """
+    return list(load_manifest(data_folder)["samples"])
+
+def read_sample(data_folder, sample_directory, params, factorize=True):
+    """
+        Read a single sample, see read_data.
+        Parameters:
+            data_folder (str): The main folder in which the samples are located.
+            sample_directory (str): The name of the sample's directory in data_folder/drum-loops.
+            params (dict) : Dictionary of parameters, defined in main.py.
+            factorize (bool): If False, the factorization is deferred, see NMFLabels.
+
+        Returns:
+            Sample : The lazy sample, or None if its data does not align with the required format.
+    """
+    configure_data_folder(data_folder, params["window"])
+    # the manifest was validated when the samples were listed, see list_sample_directories
+    entry = load_manifest(data_folder, validate=False)["samples"].get(sample_directory)
+    if entry is None:
+        print(f"There is no sample directory {sample_directory}")
+        return None
+    if "error" in entry:
+        print(entry["error"])
+        return None
+    sample_path = os.path.join(data_folder, "drum-loops", sample_directory)
+    instruments_path = os.path.join(data_folder, "kits", entry["kit"], "instruments")
+    instruments = [(midi_note, os.path.join(instruments_path, instrument_wav)) for midi_note, instrument_wav in entry["instruments"]]
+    return Sample(params, sample_directory, entry["bpm"], os.path.join(sample_path, entry["midi_file"]),
+                  os.path.join(sample_path, entry["wav_file"]), instruments, factorize)
+
+_manifests = {}
+_manifest_lock = threading.Lock()
+# (data folder, window) pairs the stores and banks have been configured for, see configure_data_folder
+_configured = set()
+
+def configure_data_folder(data_folder, window):
+    """
+        Point the spectrogram stores, the noise bank and the onset index at data_folder, once
+        per data folder and window size rather than on every read_sample.
+    """
+    key = (os.path.abspath(data_folder), window)
+    with _manifest_lock:
+        if key in _configured:
+            return
+        specstore.configure(data_folder, [window])
+        noisebank.configure(data_folder)
+        onsetindex.configure(data_folder)
+        _configured.add(key)
+
+def load_manifest(data_folder, validate=True):
+    """
+        The dataset manifest of data_folder: every sample directory with its MIDI and WAV
+        files, BPM, kit and instruments (or the reason it does not align with the required
+        format), and the instrument recordings of every kit, see scan_dataset.
+        It is kept in data_folder/dataset-manifest.json and in memory, and rebuilt when the
+        modification time of a directory or info.txt it was built from has changed.
+        With validate=False a manifest already in memory is returned without checking these
+        modification times, which takes a stat of every sample; read_sample relies on the
+        check made when the samples were listed, so read_data checks once per listing.
+        The working directory is never changed, so samples can be read from several threads.
+    """
+    path = os.path.join(data_folder, MANIFEST_FILE)
+    with _manifest_lock:
+        manifest = _manifests.get(os.path.abspath(data_folder))
+        if manifest is not None and not validate:
+            return manifest
+        if manifest is None and os.path.exists(path):
+            with open(path) as manifest_file:
+                manifest = json.load(manifest_file)
+        if manifest is None or not manifest_is_current(data_folder, manifest):
+            manifest = scan_dataset(data_folder)
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.replace(temporary, path)
+        _manifests[os.path.abspath(data_folder)] = manifest
+        return manifest
+
+def manifest_is_current(data_folder, manifest):
+    for relative_path, mtime in manifest["mtimes"].items():
+        try:
+            if os.stat(os.path.join(data_folder, relative_path)).st_mtime != mtime:
+                return False
+        except FileNotFoundError:
+            if mtime is not None:
+                return False
+    return True
+
+def scan_dataset(data_folder):
+    """
+        Build the dataset manifest of data_folder, see load_manifest and read_data for its layout.
+
+        Returns:
+            manifest (dict) : "samples" (sample directory -> its files, "bpm", "kit" and
+                "instruments" as [MIDI note, recording] pairs, or an "error"), "kits"
+                (kit -> its instrument recordings), and "mtimes" (path relative to
+                data_folder -> modification time, None for a missing path).
+    """
+    mtimes = {}
+
+    def list_directory(relative_path):
+        directory = os.path.join(data_folder, relative_path)
+        try:
+            mtimes[relative_path] = os.stat(directory).st_mtime
+            # hidden files are skipped, as glob skips them
+            return sorted(item for item in os.listdir(directory) if not item.startswith("."))
+        except FileNotFoundError:
+            mtimes[relative_path] = None
+            return []
+
+    samples = {}
+    kits = {}
+    for sample_directory in list_directory("drum-loops"):
+        sample_path = os.path.join("drum-loops", sample_directory)
+        if not os.path.isdir(os.path.join(data_folder, sample_path)):
+            continue
+        files = list_directory(sample_path)
+        midi_files = [item for item in files if item.endswith(".mid")]
+        wav_files = [item for item in files if item.endswith(".wav")]
+        if len(midi_files) != 1:
+            samples[sample_directory] = {"error": f"There should be a single MIDI file in {sample_directory}"}
+            continue
+        if len(wav_files) != 1:
+            samples[sample_directory] = {"error": f"There should be a single WAV file in {sample_directory}"}
             continue
-        midi_file = make_path(glob.glob("*.mid")[0])
-        if len(glob.glob("*.wav")) != 1:
-            print(f"There should be a single WAV file in {sample_directory}")
+        info_path = os.path.join(sample_path, "info.txt")
+        if "info.txt" not in files:
+            samples[sample_directory] = {"error": f"There should be an info.txt in {sample_directory}"}
             continue
-        wav_file = make_path(glob.glob("*.wav")[0])
-        instrument_codes = {}
-        kit = ""
-        with open ("info.txt", "r") as info_file:
+        mtimes[info_path] = os.stat(os.path.join(data_folder, info_path)).st_mtime
+        with open(os.path.join(data_folder, info_path), "r") as info_file:
             data = info_file.read().splitlines()
-            n_instruments = len(data) - 4
-            bpm = int(data[0].split()[0])
-            kit = data[2]
-            colors = ["blue", "green", "cyan", "magenta", "yellow", "black", "orange"]
-            info_instruments = []
-            for i in range(4, len(data)):
-                midi_note = int(data[i].split()[0])
-                info_instruments.append(data[i].split()[1])
-                instrument_wav = os.path.join(data_folder, "kits", kit, "instruments", data[i].split()[1])
-                instrument_codes[midi_note] = Instrument(midi_note, colors[i-4], i-4, instrument_wav, params)
-        os.chdir(os.path.join(data_folder, "kits", kit, "instruments"))
-        missing_instruments = [instrument_wav for instrument_wav in info_instruments if instrument_wav not in glob.glob("*.wav")]
+        kit = data[2]
+        instruments = [[int(line.split()[0]), line.split()[1]] for line in data[4:]]
+        if kit not in kits:
+            kits[kit] = [item for item in list_directory(os.path.join("kits", kit, "instruments")) if item.endswith(".wav")]
+        missing_instruments = [instrument_wav for midi_note, instrument_wav in instruments if instrument_wav not in kits[kit]]
         if len(missing_instruments) > 0:
-            print(f"{missing_instruments} missing in {sample_directory}/instruments")
+            samples[sample_directory] = {"error": f"{missing_instruments} missing in {sample_directory}/instruments"}
             continue
-        samples.append(Sample(params, sample_directory, bpm, midi_file, wav_file, instrument_codes))
-    return samples
\ No newline at end of file
+        samples[sample_directory] = {"midi_file": midi_files[0], "wav_file": wav_files[0], "bpm": int(data[0].split()[0]),
+                                     "kit": kit, "instruments": instruments}
+    return {"samples": samples, "kits": kits, "mtimes": mtimes}
@@ -0,0 +1,185 @@
+import numpy as np
+
+from streaming import stream_factorize
+from precision import get_dtype
+from onsets import TOLERANCE
+
+class OnsetTracker:
+    """
+        Causal onset detection on the activation rows of R instruments, fed one time frame
+        at a time. It follows Instrument.find_onsets (Section 2.4) with the steps that need
+        the whole activation row replaced:
+            - the local average (Equation 2.15) only looks back, over the last 2 avg_window + 1 frames,
+            - the global maximum of the threshold (Equation 2.17) becomes a running maximum
+              of the enhanced novelty, which decays with the given half-life.
+        An onset in frame n is emitted once the activations of frame n + 2 are known: the
+        novelty of frame n + 1 needs frame n + 2, and the peak in frame n is only known to
+        be one after the enhanced novelty falls again in frame n + 1.
+
+        Args:
+            _R (int) : Number of instruments, i.e. activation rows.
+            _THETA (float) : Threshold divisor, see Instrument.THETA.
+            _frame_rate (float) : Time frames per second, Fs / hop.
+            _avg_window (int) : Lookback of the local average, see Instrument.local_avg.
+            _halflife (float) : Seconds after which the running maximum has decayed to half.
+            _min_interval (float) : Seconds after an onset during which the instrument emits no other onset.
+            _dtype (np.dtype) : Type of the novelty buffers, that of the activations, see precision.get_dtype.
+    """
+    def __init__(self, _R, _THETA, _frame_rate, _avg_window=3, _halflife=10.0, _min_interval=TOLERANCE, _dtype=np.float64):
+        self.R = _R
+        self.dtype = np.dtype(_dtype)
+        self.THETA = _THETA
+        self.frame_rate = _frame_rate
+        self.decay = self.dtype.type(0.5 ** (1 / (_halflife * _frame_rate)))
+        self.novelty = np.zeros((2 * _avg_window + 1, _R), dtype=_dtype)  # ring buffer of the last novelty values
+        self.enhanced = np.zeros((2, _R), dtype=_dtype)  # enhanced novelty of the two frames before the current one
+        self.running_max = np.zeros(_R, dtype=_dtype)
+        self.min_interval = int(round(_min_interval * _frame_rate))
+        self.last_onset = np.full(_R, -self.min_interval - 1)
+        self.previous = None
+        self.frame = 0  # number of frames pushed so far
+
+    def push(self, activations):
+        """
+            Feed the activations of the next time frame.
+
+            Args:
+                activations (np.ndarray) : The activations of the R instruments in this frame.
+
+            Returns:
+                onsets (list of (int, float)) : The instrument index and time (s) of every
+                    onset detected with this frame.
+        """
+        activations = np.asarray(activations, dtype=self.dtype)[:self.R]
+        self.frame += 1
+        if self.previous is None:
+            self.previous = activations
+            return []
+        # novelty of frame n = self.frame - 2, Equation 2.14
+        n = self.frame - 2
+        novelty = np.maximum(activations - self.previous, 0)
+        self.previous = activations
+        self.novelty[n % len(self.novelty)] = novelty
+        # Equation 2.16 with a lookback local average; frames before the start count as 0, as in local_avg
+        enhanced = np.maximum(novelty - self.novelty.mean(axis=0), 0)
+        self.running_max = np.maximum(enhanced, self.running_max * self.decay)
+        # frame n - 1 is a peak above the running threshold, Equation 2.17
+        before, candidate = self.enhanced
+        peaks = (candidate > before) & (candidate > enhanced) & (candidate >= self.running_max / self.THETA)
+        peaks &= n - 1 - self.last_onset > self.min_interval
+        self.last_onset[peaks] = n - 1
+        self.enhanced = np.array([candidate, enhanced])
+        return [(r, (n - 1) / self.frame_rate) for r in np.flatnonzero(peaks)]
+
+    def push_block(self, H):
+        """
+            Feed the activations of several consecutive time frames.
+
+            Args:
+                H (np.ndarray) : Activations of size R x n (rows beyond R, e.g. added noise components, are ignored).
+
+            Returns:
+                onsets (list of (int, float, int)) : The instrument index, onset time (s) and
+                    the number of frames pushed when it was detected.
+        """
+        onsets = []
+        for column in np.asarray(H).T:
+            onsets += [(r, time, self.frame) for r, time in self.push(column)]
+        return onsets
+
+def stream_onsets(V, templates, params, THETA, block, overlap=None, transform=None, Fs=22050):
+    """
+        Onset events of a recording factorized block by block (see streaming.stream_factorize),
+        with the time at which each became available: the activations of a frame are only
+        known once its whole block of V has been read.
+
+        Args:
+            V (np.ndarray) : Magnitude spectrogram of size K x N.
+            templates (np.ndarray) : W_init (NMF) or P_init (NMFD).
+            params (dict) : Dictionary of parameters, defined in main.py.
+            THETA (float) : Threshold divisor, see Instrument.THETA.
+            block (int) : The number of time frames per block.
+            overlap (int) : The number of frames shared by consecutive blocks.
+            transform (callable) : Applied to every block of V, e.g. streaming.log_compress.
+            Fs (int) : Sample rate of the recording.
+
+        Returns:
+            onsets (list of (int, float, float)) : The instrument index, onset time (s) and
+                emission time (s) of every detected onset.
+    """
+    frame_rate = Fs / params["hop"]
+    tracker = OnsetTracker(templates.shape[1], THETA, frame_rate, _dtype=get_dtype(params))
+    onsets = []
+    for emit_start, H, end in stream_factorize(V, templates, params, block, overlap, transform):
+        for r, time, frame in tracker.push_block(H):
+            onsets.append((r, time, max(frame, end) / frame_rate))
+    return onsets
+
+def onset_latencies(sample, params, block, overlap=None):
+    """
+        Latency benchmark of the causal pipeline on one sample: the delay between every
+        MIDI onset and the emission of the onset event matched to it (within TOLERANCE).
+
+        Args:
+            sample (Sample) : A sample read with factorize=False, see reader.read_sample.
+            params (dict) : Dictionary of parameters, defined in main.py.
+            block (int) : The number of time frames per block.
+            overlap (int) : The number of frames shared by consecutive blocks.
+
+        Returns:
+            latencies (np.ndarray) : Delay (s) of every detected MIDI onset.
+            missed (int) : Number of MIDI onsets without a matching event.
+            spurious (int) : Number of events without a matching MIDI onset.
+    """
+    instruments = list(sample.instrument_codes.values())
+    nmf_labels = sample.nmf_labels
+    onsets = stream_onsets(nmf_labels.V, nmf_labels.templates(), params, instruments[0].THETA, block, overlap)
+    latencies = []
+    missed = 0
+    spurious = 0
+    for r, instrument in enumerate(instruments):
+        times = np.array([time for i, time, emitted in onsets if i == r])
+        emitted = np.array([emitted for i, time, emitted in onsets if i == r])
+        used = np.zeros(len(times), dtype=bool)
+        for tick in instrument.midi_onsets:
+            onset_sec = tick * instrument.tick_duration
+            distance = np.where(used, np.inf, np.abs(times - onset_sec))
+            if len(times) == 0 or distance.min() > TOLERANCE:
+                missed += 1
+                continue
+            match = np.argmin(distance)
+            used[match] = True
+            latencies.append(emitted[match] - onset_sec)
+        spurious += np.count_nonzero(~used)
+    return np.array(latencies), missed, spurious
+
+def latency_report(data_folder, params, block, overlap=None):
+    """
+        Print the onset latency of the causal pipeline over all samples of data_folder.
+    """
+    from reader import list_sample_directories, read_sample
+
+    all_latencies = []
+    for sample_directory in list_sample_directories(data_folder):
+        sample = read_sample(data_folder, sample_directory, params, factorize=False)
+        if sample is None:
+            continue
+        latencies, missed, spurious = onset_latencies(sample, params, block, overlap)
+        all_latencies.append(latencies)
+        if len(latencies) > 0:
+            print(f"{sample.dir}: {len(latencies)} onsets, median latency {np.median(latencies) * 1000:.1f} ms, "
+                  f"max {latencies.max() * 1000:.1f} ms, {missed} missed, {spurious} spurious")
+        else:
+            print(f"{sample.dir}: no onsets detected, {missed} missed, {spurious} spurious")
+    latencies = np.concatenate(all_latencies) if all_latencies else np.zeros(0)
+    if len(latencies) > 0:
+        print(f"All: {len(latencies)} onsets, median latency {np.median(latencies) * 1000:.1f} ms, "
+              f"95th percentile {np.percentile(latencies, 95) * 1000:.1f} ms, max {latencies.max() * 1000:.1f} ms")
+    return latencies
+
+if __name__ == "__main__":
+    from main import DATA_FOLDER, params
+
+    params = dict(params, nmf_type="NMF")
+    # NMF needs no block overlap, so short blocks keep the latency low
+    latency_report(DATA_FOLDER, params, block=16)
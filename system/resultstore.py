@@ -0,0 +1,208 @@
+import csv
+import math
+import os
+import sqlite3
+
+from sweep import RESULT_KEYS, SCORE_KEYS, RUN_KEYS, CONFIG_KEYS, TASK_KEYS, task_key
+
+# column declarations; parameters have no type, so they are returned as they were written
+# (0 stays an int, inf a float) and task_key finds the finished tasks again, see stored
+COLUMNS = {key: "" for key in TASK_KEYS}
+COLUMNS.update({"Sample": "TEXT", "F": "REAL", "P": "REAL", "R": "REAL",
+                "iterations": "INTEGER", "warm_started": "INTEGER", "seconds": "REAL"})
+# the existing CSV files were written from R, which renames "noise-lvl" to "noise.lvl"
+CSV_ALIASES = {"noise.lvl": "noise-lvl"}
+
+class ResultsStore:
+    """
+        Sweep results in an SQLite database, with the sweep parameters as indexed columns,
+        so that aggregates over any parameter are answered without rereading every row.
+        Rows are buffered and inserted in one transaction every _batch rows; the rows of
+        an interrupted batch are lost, and run again when the sweep is resumed. The database
+        is in WAL mode, so it can be queried while a sweep is writing to it.
+
+        It has the interface of sweep.ResultsFile, plus mean, rows, export_csv and import_csv.
+        sweep.open_results selects it for results paths ending in .db or .sqlite.
+
+        Args:
+            _path (str) : Path to the database. If it exists, its rows are kept and their
+                tasks are reported as finished.
+            _batch (int) : Number of rows per insert transaction.
+    """
+    def __init__(self, _path, _batch=32):
+        self.path = _path
+        self.batch = _batch
+        self.header = RESULT_KEYS + SCORE_KEYS + RUN_KEYS + CONFIG_KEYS
+        self.pending = []
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            columns = ", ".join(f"{quote(key)} {COLUMNS[key]}".strip() for key in self.header)
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS results ({columns})")
+            existing = [row[1] for row in self.connection.execute("PRAGMA table_info(results)")]
+            missing = [key for key in self.header if key not in existing]
+            if len(missing) > 0:
+                raise Exception(f"{self.path} has no {missing} columns, so its rows cannot be matched "
+                                f"to configurations; write the sweep to a new results database")
+            task_columns = ", ".join(quote(key) for key in TASK_KEYS + ["Sample"])
+            self.connection.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS results_task ON results ({task_columns})")
+            for key in TASK_KEYS:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {quote('results_' + key)} ON results ({quote(key)})")
+        self.finished = set(tuple(str(value) for value in row) for row in
+                            self.connection.execute(f"SELECT {task_columns} FROM results"))
+
+    def is_finished(self, config, sample_directory):
+        return task_key(config, sample_directory) in self.finished
+
+    def append(self, row):
+        self.pending.append(tuple(stored(row.get(key)) if key in TASK_KEYS else row.get(key) for key in self.header))
+        self.finished.add(task_key(row, row["Sample"]))
+        if len(self.pending) >= self.batch:
+            self.sync()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def sync(self):
+        """
+            Insert the buffered rows in one transaction. A task written again replaces its row.
+        """
+        if len(self.pending) == 0:
+            return
+        placeholders = ", ".join("?" for key in self.header)
+        with self.connection:
+            self.connection.executemany(f"INSERT OR REPLACE INTO results ({', '.join(quote(key) for key in self.header)}) "
+                                        f"VALUES ({placeholders})", self.pending)
+        self.pending = []
+
+    def close(self):
+        self.sync()
+        self.connection.close()
+
+    def mean(self, by=(), where=None):
+        """
+            Mean and standard deviation of the scores of every group of rows.
+
+            Args:
+                by (tuple of str) : Columns to group by, e.g. ("nmf_type", "fixW").
+                where (dict) : Column -> value, or list of values, the rows must have,
+                    e.g. {"addedCompW": 0, "noise-lvl": [1, 2]}.
+
+            Returns:
+                groups (list of dict) : The by columns, "count", and "F", "P", "R" and
+                    "F_sd", "P_sd", "R_sd" of every group, ordered by the by columns.
+        """
+        self.sync()
+        group = ", ".join(quote(key) for key in check_columns(by))
+        scores = ", ".join(f"avg({key}), avg({key} * {key})" for key in ["F", "P", "R"])
+        condition, values = where_clause(where)
+        query = f"SELECT {group + ', ' if group else ''}count(*), {scores} FROM results {condition}"
+        if group:
+            query += f" GROUP BY {group} ORDER BY {group}"
+        groups = []
+        for row in self.connection.execute(query, values):
+            result = dict(zip(by, row))
+            result["count"] = row[len(by)]
+            if result["count"] == 0:
+                continue
+            for idx, key in enumerate(["F", "P", "R"]):
+                mean, square = row[len(by) + 1 + 2 * idx], row[len(by) + 2 + 2 * idx]
+                count = result["count"]
+                result[key] = mean
+                # sample standard deviation, as R's sd
+                result[key + "_sd"] = math.sqrt(max(0, square - mean**2) * count / (count - 1)) if count > 1 else float('nan')
+            groups.append(result)
+        return groups
+
+    def rows(self, where=None, keys=None):
+        """
+            The rows matching where (see mean) as dictionaries of the keys columns, by default all.
+        """
+        self.sync()
+        keys = self.header if keys is None else check_columns(keys)
+        condition, values = where_clause(where)
+        cursor = self.connection.execute(f"SELECT {', '.join(quote(key) for key in keys)} FROM results {condition}", values)
+        return [dict(zip(keys, row)) for row in cursor]
+
+    def export_csv(self, path, keys=RESULT_KEYS + SCORE_KEYS, where=None):
+        """
+            Write the rows matching where (see mean) to a CSV file with the columns keys, by
+            default the header of results/results.csv.
+        """
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(keys)
+            writer.writerows([row[key] for key in keys] for row in self.rows(where, keys))
+
+    def import_csv(self, path):
+        """
+            Add the rows of a results CSV file, e.g. written by sweep.ResultsFile or results/results.csv.
+            Parameters the file has no column for are stored as NULL.
+        """
+        with open(path, newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                row = {CSV_ALIASES.get(key, key): parse_value(value) for key, value in row.items()}
+                row["Sample"] = str(row["Sample"])
+                self.append(row)
+        self.sync()
+
+def quote(key):
+    return '"' + key.replace('"', '""') + '"'
+
+def check_columns(keys):
+    for key in keys:
+        if key not in COLUMNS:
+            raise Exception(f"Unknown results column {key}, expected one of {list(COLUMNS)}")
+    return list(keys)
+
+def where_clause(where):
+    """
+        SQL condition and its values for a where dictionary, see ResultsStore.mean.
+    """
+    if not where:
+        return "", []
+    conditions, values = [], []
+    for key, value in where.items():
+        check_columns([key])
+        if isinstance(value, (list, tuple, set)):
+            conditions.append(f"{quote(key)} IN ({', '.join('?' for item in value)})")
+            values += [stored(item) for item in value]
+        elif value is None:
+            conditions.append(f"{quote(key)} IS NULL")
+        else:
+            conditions.append(f"{quote(key)} = ?")
+            values.append(stored(value))
+    return "WHERE " + " AND ".join(conditions), values
+
+def stored(value):
+    """
+        A task parameter as it is stored: numbers, strings and None as they are, anything
+        else (booleans, lists of levels) as its string, so that task_key reads it back.
+    """
+    if value is None or (isinstance(value, (int, float, str)) and not isinstance(value, bool)):
+        return value
+    return str(value)
+
+def parse_value(value):
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    if value in ("True", "False"):
+        return value == "True"
+    return None if value in ("", "None") else value
+
+if __name__ == "__main__":
+    store = ResultsStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "results", "results.db"))
+    if len(store.finished) == 0:
+        store.import_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "results", "results.csv"))
+    for group in store.mean(by=("nmf_type", "fixW", "noise-lvl"), where={"addedCompW": 0}):
+        print(f"{group['nmf_type']} {group['fixW']} noise {group['noise-lvl']}: "
+              f"F {group['F']:.3f} +/- {group['F_sd']:.3f} ({group['count']} samples)")
+    store.close()
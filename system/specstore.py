@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import numpy as np
+
+from instrumentation import span
+
+# byte alignment of every spectrogram in the data file, so that views of any dtype are aligned
+ALIGNMENT = 64
+
+class SpectrogramStore:
+    """
+        Consolidated store of the magnitude spectrograms of one window size: a single raw
+        data file holding all spectrograms back to back, and a JSON index mapping each
+        recording's path (relative to the data folder) to its offset, shape and dtype.
+        The data file is memory-mapped read-only, so spectrograms are returned as zero-copy
+        views in their stored type and worker processes share the pages through the operating
+        system's page cache. Converting a view to another precision copies it.
+
+        Args:
+            _root (str) : The main data folder, see reader.read_data. The store files are kept here.
+            _window (int) : STFT window size of the stored spectrograms.
+    """
+    def __init__(self, _root, _window):
+        self.root = _root
+        self.window = _window
+        self.data_file = os.path.join(self.root, f"spectrograms-{self.window}.bin")
+        self.index_file = os.path.join(self.root, f"spectrograms-{self.window}.json")
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as index_file:
+                self.index = json.load(index_file)
+        self.data = None
+
+    def key(self, wav_file):
+        return os.path.relpath(os.path.abspath(wav_file), os.path.abspath(self.root)).replace(os.sep, "/")
+
+    def __contains__(self, wav_file):
+        return self.key(wav_file) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, wav_file):
+        """
+            Spectrogram of a recording, as a read-only view into the memory-mapped data file.
+        """
+        entry = self.index[self.key(wav_file)]
+        dtype = np.dtype(entry["dtype"])
+        n_bytes = int(np.prod(entry["shape"])) * dtype.itemsize
+        if self.data is None or entry["offset"] + n_bytes > len(self.data):
+            self.data = np.memmap(self.data_file, dtype=np.uint8, mode='r')
+        return self.data[entry["offset"]:entry["offset"] + n_bytes].view(dtype).reshape(entry["shape"])
+
+    def add(self, wav_file, spectrogram):
+        """
+            Write the spectrogram of a recording to the store. A spectrogram of the same size
+            is overwritten in place, otherwise it is appended to the data file.
+            The store has a single writer; readers pick up new entries when they reopen it.
+        """
+        spectrogram = np.ascontiguousarray(spectrogram)
+        key = self.key(wav_file)
+        entry = self.index.get(key)
+        if entry is None or int(np.prod(entry["shape"])) * np.dtype(entry["dtype"]).itemsize != spectrogram.nbytes:
+            size = os.path.getsize(self.data_file) if os.path.exists(self.data_file) else 0
+            entry = {"offset": -(-size // ALIGNMENT) * ALIGNMENT}
+        entry.update({"shape": list(spectrogram.shape), "dtype": spectrogram.dtype.str})
+        # the memory map of this process must not outlive a write to the file it maps
+        self.data = None
+        with open(self.data_file, 'r+b' if os.path.exists(self.data_file) else 'wb') as data_file:
+            data_file.seek(entry["offset"])
+            data_file.write(spectrogram.tobytes())
+        self.index[key] = entry
+        self.save_index()
+
+    def save_index(self):
+        temporary = self.index_file + ".tmp"
+        with open(temporary, 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temporary, self.index_file)
+
+_stores = {}
+# samples are read from several threads, see reader.load_manifest
+_stores_lock = threading.Lock()
+
+def open_store(root, window):
+    """
+        The process-wide store of a data folder and window size, opened once and then reused.
+    """
+    key = (os.path.abspath(root), window)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = SpectrogramStore(root, window)
+        return _stores[key]
+
+def configure(root, windows):
+    """
+        Make load_spectrogram read the recordings under root from their stores.
+        Stores that stfts.py has not written yet are skipped.
+    """
+    for window in windows:
+        store = open_store(root, window)
+        if len(store) == 0:
+            with _stores_lock:
+                _stores.pop((os.path.abspath(root), window), None)
+
+def load_spectrogram(wav_file, window, dtype=None):
+    """
+        Magnitude spectrogram of a recording, as computed by stfts.py. It is read from a
+        configured spectrogram store if the recording is in one, and from the recording's
+        -{window}.npy file otherwise.
+
+        Args:
+            wav_file (str) : Path to the recording.
+            window (int) : STFT window size.
+            dtype (np.dtype) : Type to convert the spectrogram to, see precision.get_dtype.
+                A spectrogram stored in another type (stfts.py stores float32) is copied by the
+                conversion. Callers that compute on the spectrogram pass None instead and convert
+                it in their first operation that writes a new array, so only that one is allocated.
+
+        Returns:
+            Y (np.ndarray) : Magnitude spectrogram of size K x N, a read-only view into the store
+                if it is held there and dtype is None or its stored type.
+    """
+    with span("load_spectrogram"):
+        with _stores_lock:
+            stores = list(_stores.items())
+        for (root, store_window), store in stores:
+            if store_window == window and wav_file in store:
+                Y = store.get(wav_file)
+                break
+        else:
+            npy_file = wav_file[:-4] + f'-{window}.npy'
+            Y = np.load(npy_file, allow_pickle=True)
+        return Y if dtype is None else Y.astype(dtype, copy=False)
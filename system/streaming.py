@@ -0,0 +1,121 @@
+import numpy as np
+
+from nmf import NMF, NMFWorkspace
+from nmfd import NMFD
+from precision import get_dtype
+
+# default number of time frames per block, about 24 s at a hop of 256 samples
+BLOCK = 2048
+# smallest NMFD block, in template frames T: the 50 multiplicative NMFD iterations spread an
+# activation's influence over many lags, and shorter blocks lose up to 0.1 F against the offline
+# NMFD on synthetic loops (benchmark.synthetic_loop), while blocks of 25 T stay within about 0.05
+MIN_BLOCK_LAGS = 25
+
+def log_compress(Y):
+    """
+        Logarithmic compression applied to every spectrogram before factorization, see NMFLabels.
+    """
+    return np.log(1 + 10 * Y)
+
+def block_ranges(N, block, overlap):
+    """
+        Split N time frames into overlapping blocks. Consecutive blocks share `overlap`
+        frames. A block emits the activations of its frames up to overlap/2 frames
+        before its end (the last block up to the end), so every emitted frame away from
+        the recording's edges has at least overlap/2 frames of context on both sides.
+
+        Args:
+            N (int) : The number of time frames.
+            block (int) : The number of time frames per block.
+            overlap (int) : The number of frames shared by consecutive blocks, < block.
+
+        Yields:
+            (start, end, emit_start, emit_end) : The block's frames [start, end) and the
+                frames [emit_start, emit_end) whose activations it emits.
+    """
+    if overlap >= block:
+        raise Exception("The block overlap has to be smaller than the block")
+    start = 0
+    emit_start = 0
+    while True:
+        end = min(start + block, N)
+        emit_end = N if end == N else end - overlap // 2
+        yield start, end, emit_start, emit_end
+        if end == N:
+            break
+        emit_start = emit_end
+        start += block - overlap
+
+def stream_factorize(V, templates, params, block=BLOCK, overlap=None, transform=None, carry_templates=False):
+    """
+        Block-wise NMF or NMFD (params["nmf_type"]) of a long spectrogram, yielding the
+        activations block by block. Only one block of V is held in memory at a time, so V
+        can be a memory-mapped array (e.g. from specstore) of arbitrary length.
+
+        State carried across block boundaries:
+            - the activations of the shared frames, which initialize the next block's activations,
+            - with carry_templates, the adapted templates, which start the next block.
+        For NMFD the overlap defaults to 2 (T - 1) frames, so the templates triggered in the
+        frames before an emitted frame are always inside the same block.
+
+        Without carry_templates every block adapts the kit templates afresh, which stays
+        closest to the offline factorization. Carried templates keep adapting over the whole
+        recording (every block runs its own iterations), which follows timbre changes in
+        long recordings but drifts away from the offline result.
+
+        NMFD blocks shorter than the recording need at least MIN_BLOCK_LAGS * T frames. Adaptive
+        NMFD patterns fitted to one block at a time do not come close to the offline
+        factorization at any block size (on the synthetic sets, F drops from about 0.7 to
+        0.1-0.5), so they are only streamed with carry_templates, which opts out of matching it.
+
+        Args:
+            V (np.ndarray) : Magnitude spectrogram of size K x N.
+            templates (np.ndarray) : W_init of size K x R (NMF) or P_init of size K x R x T (NMFD).
+            params (dict) : Dictionary of parameters, defined in main.py.
+            block (int) : The number of time frames per block.
+            overlap (int) : The number of frames shared by consecutive blocks.
+            transform (callable) : Applied to every block of V before factorization, e.g. log_compress.
+            carry_templates (bool) : Start each block from the previous block's adapted templates.
+
+        Yields:
+            (emit_start, H, end) : The first frame of the emitted activations, the activations
+                H of size (R + addedCompW) x n of the frames [emit_start, emit_start + n),
+                and the number of frames of V read so far, i.e. when H became available.
+    """
+    K, N = V.shape
+    R = templates.shape[1]
+    if params["nmf_type"] == 'NMFD' and block < N:
+        T = templates.shape[2]
+        if block < MIN_BLOCK_LAGS * T:
+            raise Exception(f"NMFD blocks need at least {MIN_BLOCK_LAGS} x {T} template frames, got {block}")
+        if params["fixW"] == "adaptive" and not carry_templates:
+            raise Exception("Adaptive NMFD patterns cannot be streamed in blocks shorter than the recording; "
+                            "use fixed or semi-adaptive templates, or carry_templates")
+    if overlap is None:
+        overlap = 2 * (templates.shape[2] - 1) if params["nmf_type"] == 'NMFD' else 0
+    dtype = get_dtype(params)
+    H_shared = None
+    # all blocks but the last have the same size, so they share the NMF buffers
+    workspace = NMFWorkspace(K, R + params["addedCompW"], min(block, N), True, dtype) if params["nmf_type"] == 'NMF' else None
+    for start, end, emit_start, emit_end in block_ranges(N, block, overlap):
+        V_block = np.asarray(V[:, start:end], dtype=dtype)
+        if transform is not None:
+            V_block = transform(V_block)
+        H_init = np.ones((R + params["addedCompW"], end - start), dtype=dtype)
+        if H_shared is not None:
+            H_init[:, :H_shared.shape[1]] = H_shared
+        if params["nmf_type"] == 'NMF':
+            V_approx, W, H = NMF(V_block, templates, params, H_init=H_init, workspace=workspace)
+        elif params["nmf_type"] == 'NMFD':
+            V_approx, W, H = NMFD(V_block, templates, params, H_init=H_init)
+        if carry_templates and params["fixW"] != "fixed":
+            templates = W[:, :R]
+        H_shared = H[:, end - start - overlap:]
+        yield emit_start, H[:, emit_start - start:emit_end - start], end
+
+def stream_activations(V, templates, params, block=BLOCK, overlap=None, transform=None, carry_templates=False):
+    """
+        All activations of stream_factorize joined into one R x N matrix, for comparing
+        the block-wise factorization with the offline one.
+    """
+    return np.concatenate([H for emit_start, H, end in stream_factorize(V, templates, params, block, overlap, transform, carry_templates)], axis=1)
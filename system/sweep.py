@@ -0,0 +1,304 @@
+import csv
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from copy import deepcopy
+
+from reader import list_sample_directories, read_sample
+from warmstart import config_distance
+import cache
+import instrumentation
+
+# parameters written next to every score, in the column order of results/results.csv
+RESULT_KEYS = ["nmf_type", "fixW", "beta", "addedCompW", "noise", "noise-lvl"]
+SCORE_KEYS = ["Sample", "F", "P", "R"]
+# how the task was run: NMF/NMFD iterations (0 for a cache hit), whether it was warm-started, and its wall time
+RUN_KEYS = ["iterations", "warm_started", "seconds"]
+# every other parameter that changes the result of a task; they are written next to the scores
+# as well, so that a results file is only resumed for the configurations it holds
+CONFIG_KEYS = ["window", "hop", "noise_seed", "precision", "bands", "filterbank", "solver", "initH", "max_iter",
+               "convergence", "tolerance", "check_every", "nmfd_backend", "nmfd_levels", "stream_block", "warm_start",
+               "warm_start_from"]
+# the parameters that identify a task, next to its sample
+TASK_KEYS = RESULT_KEYS + CONFIG_KEYS
+# extensions of results paths that are written to a resultstore.ResultsStore instead of a CSV file
+STORE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+
+# environment variables read by the BLAS/OpenMP runtimes numpy may be linked against
+BLAS_THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                         "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+def expand_grid(params, noise_lvls, fixW_options, addedCompWs, nmf_types):
+    """
+        Expand the parameter grid of main.py into a list of configurations, in the
+        order in which main.py used to run them.
+
+        Args:
+            params (dict) : Base dictionary of parameters, defined in main.py.
+            noise_lvls (list of int) : Noise levels, 0 meaning no noise.
+            fixW_options (list of str) : Template adaptivity options.
+            addedCompWs (list of int) : Numbers of added noise components.
+            nmf_types (list of str) : "NMF" and/or "NMFD".
+
+        Returns:
+            configs (list of dict) : One parameter dictionary per configuration.
+    """
+    configs = []
+    for noise_lvl in noise_lvls:
+        if noise_lvl == 0:
+            noises = ["None"]
+        elif noise_lvl == 3:
+            noises = ["mix"]
+        else:
+            noises = ["airplane", "chatter", "ambient"]
+        for fixW_option in fixW_options:
+            betas = [1, 2, 3, 4, 5, 6]
+            if fixW_option == "adaptive":
+                betas = [0]
+            elif fixW_option == "fixed":
+                betas = [float('inf')]
+            for beta in betas:
+                for addedCompW in addedCompWs:
+                    for noise in noises:
+                        for nmf_type in nmf_types:
+                            config = deepcopy(params)
+                            config["noise-lvl"] = noise_lvl
+                            config["fixW"] = fixW_option
+                            config["beta"] = beta
+                            config["addedCompW"] = addedCompW
+                            config["noise"] = noise
+                            config["nmf_type"] = nmf_type
+                            configs.append(config)
+    return configs
+
+def warm_start_chains(configs):
+    """
+        Fix the warm start of every configuration with params["warm_start"], so that a sweep
+        gives the same results whatever order its tasks finish in. A configuration starts from
+        its predecessor: the nearest (see warmstart.config_distance) configuration before it
+        that only differs in cache.NEIGHBOUR_KEYS, the first one on ties. The first configuration
+        of every such family starts cold.
+
+        Args:
+            configs (list of dict) : Configurations, e.g. from expand_grid.
+
+        Returns:
+            configs (list of dict) : Copies of configs with params["warm_start_from"], the
+                NEIGHBOUR_KEYS values of the predecessor, of its predecessor and so on, or None.
+            predecessors (list of int) : The index of the predecessor of every configuration, or None.
+    """
+    families = [tuple(str(config.get(key)) for key in TASK_KEYS if key not in cache.NEIGHBOUR_KEYS + ["warm_start_from"])
+                for config in configs]
+    chained, predecessors = [], []
+    for idx, config in enumerate(configs):
+        earlier = [j for j in range(idx) if families[j] == families[idx]] if config.get("warm_start") else []
+        predecessor = min(earlier, key=lambda j: config_distance(config, configs[j])) if len(earlier) > 0 else None
+        chain = None
+        if predecessor is not None:
+            chain = [[configs[predecessor][key] for key in cache.NEIGHBOUR_KEYS]] + (chained[predecessor]["warm_start_from"] or [])
+        chained.append(dict(config, warm_start_from=chain))
+        predecessors.append(predecessor)
+    return chained, predecessors
+
+def task_key(config, sample_directory):
+    """
+        Identify a (configuration, sample) task by the values written to the results file.
+        Parameters missing from config are written, and identified, as None.
+    """
+    return tuple(str(config.get(key)) for key in TASK_KEYS) + (str(sample_directory),)
+
+def run_task(data_folder, config, sample_directory):
+    """
+        Read, factorize and evaluate one sample under one configuration.
+
+        Returns:
+            row (dict) : The result row, or None if the sample could not be read.
+                row["cache"] holds the factorization cache hits and misses of this task.
+    """
+    factorization_cache = cache.get_cache()
+    before = factorization_cache.stats() if factorization_cache is not None else None
+    start = time.perf_counter()
+    with instrumentation.labelled(sample=str(sample_directory), **{key: config[key] for key in RESULT_KEYS}):
+        with instrumentation.span("task"):
+            sample = read_sample(data_folder, sample_directory, config)
+            if sample is not None:
+                precision, recall, f_measure = sample.evaluate()
+    instrumentation.flush()
+    if sample is None:
+        return None
+    row = {key: config.get(key) for key in TASK_KEYS}
+    row.update({"Sample": sample.dir, "F": f_measure, "P": precision, "R": recall})
+    row.update({"iterations": sample.nmf_labels.iterations, "warm_started": sample.nmf_labels.warm_started,
+                "seconds": time.perf_counter() - start})
+    if factorization_cache is not None:
+        after = factorization_cache.stats()
+        row["cache"] = {key: after[key] - before[key] for key in after}
+    return row
+
+def init_worker(cache_dir, cache_bytes, instrumentation_path, record_iterations):
+    """
+        Configure the factorization cache and the instrumentation of a worker process.
+    """
+    cache.configure(cache_dir, cache_bytes)
+    instrumentation.configure(instrumentation_path, record_iterations)
+
+class ResultsFile:
+    """
+        Append-only CSV file of sweep results that can be resumed after an interruption.
+        Every row is flushed to disk as soon as it is written.
+
+        Args:
+            _path (str) : Path to the CSV file. If it exists, its rows are kept and their
+                tasks are reported as finished. Files without the CONFIG_KEYS columns cannot
+                tell which configurations their rows belong to, so they are not resumed.
+    """
+    def __init__(self, _path):
+        self.path = _path
+        self.header = RESULT_KEYS + SCORE_KEYS + RUN_KEYS + CONFIG_KEYS
+        self.finished = set()
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        if exists:
+            with open(self.path, newline='') as csv_file:
+                reader = csv.DictReader(csv_file)
+                missing = [key for key in TASK_KEYS + ["Sample"] if key not in reader.fieldnames]
+                if len(missing) > 0:
+                    raise Exception(f"{self.path} has no {missing} columns, so its rows cannot be matched "
+                                    f"to configurations; write the sweep to a new results file")
+                for row in reader:
+                    self.finished.add(task_key(row, row["Sample"]))
+                self.header = reader.fieldnames
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if not exists:
+            self.writer.writerow(self.header)
+            self.sync()
+
+    def is_finished(self, config, sample_directory):
+        return task_key(config, sample_directory) in self.finished
+
+    def append(self, row):
+        # task parameters are written as task_key reads them back, None as "None" instead of ""
+        self.writer.writerow([str(row.get(key)) if key in TASK_KEYS else row.get(key, "") for key in self.header])
+        self.sync()
+        self.finished.add(task_key(row, row["Sample"]))
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+def open_results(path):
+    """
+        The results of a sweep: a resultstore.ResultsStore if path ends in one of
+        STORE_EXTENSIONS, otherwise a CSV ResultsFile.
+    """
+    if os.path.splitext(path)[1] in STORE_EXTENSIONS:
+        from resultstore import ResultsStore
+        return ResultsStore(path)
+    return ResultsFile(path)
+
+@contextmanager
+def capped_blas_threads(n_threads):
+    """
+        Limit the BLAS/OpenMP thread pools of worker processes started inside the context.
+        Without this, every worker spawns as many BLAS threads as there are cores.
+    """
+    saved = {variable: os.environ.get(variable) for variable in BLAS_THREAD_VARIABLES}
+    for variable in BLAS_THREAD_VARIABLES:
+        os.environ[variable] = str(n_threads)
+    try:
+        yield
+    finally:
+        for variable, value in saved.items():
+            if value is None:
+                del os.environ[variable]
+            else:
+                os.environ[variable] = value
+
+def run_sweep(data_folder, results_path, configs, workers=None, blas_threads=1, cache_dir=None, cache_bytes=2 * 1024**3,
+              instrumentation_path=None, record_iterations=False):
+    """
+        Evaluate every sample under every configuration on a pool of worker processes.
+        Tasks already present in the results file are skipped, so an interrupted sweep
+        is resumed by running it again with the same results file.
+        With params["warm_start"] and a cache_dir, a factorization starts from the solution of
+        its predecessor configuration on the same sample (see warm_start_chains), and its task
+        is only queued once the predecessor's task has finished.
+
+        Args:
+            data_folder (str) : The main data folder, see reader.read_data.
+            results_path (str) : CSV file the result rows are streamed into, or an SQLite
+                database if it ends in .db or .sqlite, see open_results.
+            configs (list of dict) : Configurations, e.g. from expand_grid.
+            workers (int) : Number of worker processes, defaults to the number of cores
+                divided by blas_threads.
+            blas_threads (int) : Number of BLAS threads per worker.
+            cache_dir (str) : Directory of the factorization cache shared by the workers, see cache.py.
+                Repeated factorizations, e.g. when a sweep is run again, are then loaded from it.
+            cache_bytes (int) : Size bound of the factorization cache.
+            instrumentation_path (str) : JSON lines file the workers append the time of every
+                stage of every task to, labelled by sample and configuration, see instrumentation.py.
+            record_iterations (bool) : Also record every NMF/NMFD iteration in instrumentation_path.
+    """
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // blas_threads)
+    results = open_results(results_path)
+    sample_directories = list_sample_directories(data_folder)
+    predecessors = [None] * len(configs)
+    if cache_dir is not None:
+        configs, predecessors = warm_start_chains(configs)
+    tasks = [(idx, sample_directory) for idx, config in enumerate(configs) for sample_directory in sample_directories
+             if not results.is_finished(config, sample_directory)]
+    total = len(configs) * len(sample_directories)
+    print(f"{total - len(tasks)} of {total} tasks already finished, running {len(tasks)} on {workers} workers")
+
+    # spawned workers inherit the capped environment before they import numpy
+    with capped_blas_threads(blas_threads):
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=init_worker,
+                                 initargs=(cache_dir, cache_bytes, instrumentation_path, record_iterations)) as executor:
+            running = {}
+            def submit(task):
+                running[executor.submit(run_task, data_folder, configs[task[0]], task[1])] = task
+            # tasks whose predecessor is queued as well wait for it, the others are queued at once
+            queued = set(tasks)
+            waiting = {}
+            for idx, sample_directory in tasks:
+                predecessor = (predecessors[idx], sample_directory)
+                if predecessor in queued:
+                    waiting.setdefault(predecessor, []).append((idx, sample_directory))
+                else:
+                    submit((idx, sample_directory))
+            done = 0
+            cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+            iterations = {False: [], True: []}
+            while len(running) > 0:
+                future = next(iter(wait(running, return_when=FIRST_COMPLETED)[0]))
+                for task in waiting.pop(running.pop(future), []):
+                    submit(task)
+                row = future.result()
+                done += 1
+                if row is not None:
+                    results.append(row)
+                    for key, count in row.get("cache", {}).items():
+                        cache_stats[key] += count
+                    if row["iterations"]:
+                        iterations[row["warm_started"]].append(row["iterations"])
+                    print(f"[{done}/{len(tasks)}] {[row[key] for key in results.header]}")
+    results.close()
+    if cache_dir is not None:
+        print(f"Factorization cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evictions']} evictions")
+    for warm, counts in iterations.items():
+        if len(counts) > 0:
+            print(f"{'Warm' if warm else 'Cold'} starts: {len(counts)} factorizations, {sum(counts) / len(counts):.1f} iterations on average")
+    if instrumentation_path is not None and os.path.exists(instrumentation_path):
+        for stage, total in sorted(instrumentation.summarize(instrumentation_path).items(), key=lambda item: -item[1]["seconds"]):
+            print(f"{' '.join(stage)}: {total['seconds']:.2f} s in {total['count']} calls")
@@ -0,0 +1,96 @@
+import os
+import numpy as np
+
+from precision import get_dtype
+
+EPS = 2.0 ** -52
+
+# parameters that determine an instrument's log-compressed spectrogram, next to its recording
+TEMPLATE_KEYS = ["window", "noise", "noise-lvl", "noise_seed", "precision", "bands", "filterbank"]
+
+def stack_patterns(Ys, dtype, T=0):
+    """
+        NMFD pattern tensor of the instruments' spectrograms, each zero-padded (with EPS)
+        to the longest one, or to T frames if that is longer, see Instrument.template_2D.
+        It is filled in one allocation instead of appending the padding column by column.
+
+        Args:
+            Ys (list of np.ndarray) : R log-compressed spectrograms of size K x T_r.
+            dtype (np.dtype) : Type of the tensor.
+            T (int) : Minimal number of frames of the patterns.
+
+        Returns:
+            P (np.ndarray) : Pattern tensor of size K x R x max(T, max(T_r)).
+    """
+    K = Ys[0].shape[0]
+    T = max([T] + [Y.shape[1] for Y in Ys])
+    P = np.full((K, len(Ys), T), EPS, dtype=dtype)
+    for r, Y in enumerate(Ys):
+        P[:, r, :Y.shape[1]] = Y
+    return P
+
+class TemplateBank:
+    """
+        In-memory bank of the instrument templates, shared by all samples of a process.
+        A kit's instruments appear in many samples and sweep configurations, so their
+        log-compressed spectrograms, 1D templates, and the template matrices (NMF) and
+        pattern tensors (NMFD) built from them are computed once per process.
+
+        An instrument is identified by its recording (the kit and instrument) and TEMPLATE_KEYS;
+        the template matrices also by params["nmf_type"]. Templates mixed with noise are mixed
+        with a segment seeded by their sample (see noisebank.py), so they are banked per sample
+        and shared by the configurations of that sample only. The banked arrays are read-only,
+        as every instrument and sample shares them.
+    """
+    def __init__(self):
+        self.recordings = {}  # key -> (Y, template)
+        self.matrices = {}    # (nmf_type, recording keys) -> W_init or P_init
+
+    def key(self, wav_file, params, sample=None):
+        """
+            Key of an instrument's templates; noisy templates are keyed by their sample too.
+        """
+        sample = None if params["noise"] == "None" else sample
+        return (os.path.abspath(wav_file), sample) + tuple(params.get(key) for key in TEMPLATE_KEYS)
+
+    def get(self, wav_file, params, sample=None):
+        """
+            The log-compressed spectrogram and 1D template of an instrument, or None.
+        """
+        return self.recordings.get(self.key(wav_file, params, sample))
+
+    def put(self, wav_file, params, Y, template, sample=None):
+        key = self.key(wav_file, params, sample)
+        for array in (Y, template):
+            array.setflags(write=False)
+        self.recordings[key] = (Y, template)
+        return Y, template
+
+    def templates(self, instruments, params):
+        """
+            The template matrix W_init of size K x R (NMF) or pattern tensor P_init of
+            size K x R x T (NMFD) of a sample's instruments, see NMFLabels.initialize_template_matrix.
+        """
+        key = (params["nmf_type"], tuple(self.key(instrument.wav_file, params, instrument.sample) for instrument in instruments))
+        if key in self.matrices:
+            return self.matrices[key]
+        dtype = get_dtype(params)
+        if params["nmf_type"] == 'NMF':
+            templates = np.array([instrument.template for instrument in instruments], dtype=dtype).transpose()
+        elif params["nmf_type"] == 'NMFD':
+            templates = stack_patterns([instrument.Y for instrument in instruments], dtype)
+        templates.setflags(write=False)
+        self.matrices[key] = templates
+        return templates
+
+    def clear(self):
+        self.recordings.clear()
+        self.matrices.clear()
+
+_bank = TemplateBank()
+
+def get_template_bank():
+    """
+        The process-wide template bank.
+    """
+    return _bank
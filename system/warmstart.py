@@ -0,0 +1,67 @@
+import numpy as np
+
+from cache import NEIGHBOUR_KEYS
+
+def extend_components(templates, H, R, addedCompW):
+    """
+        Adapt a prior solution to another number of added noise components. The R instrument
+        components and up to addedCompW of the prior's noise components are kept, and any
+        missing noise components are appended with the initialization NMF/NMFD use for them.
+
+        Args:
+            templates (np.ndarray) : Prior templates W of size K x R' (NMF) or P of size K x R' x T (NMFD).
+            H (np.ndarray) : Prior activations of size R' x N.
+            R (int) : The number of instruments.
+            addedCompW (int) : The number of added noise components to adapt to.
+
+        Returns:
+            (templates, H) : The starting templates of size K x (R + addedCompW) (x T) and
+                activations of size (R + addedCompW) x N.
+    """
+    kept = min(templates.shape[1], R + addedCompW)
+    missing = R + addedCompW - kept
+    templates = np.array(templates[:, :kept])
+    H = np.array(H[:kept])
+    if missing > 0:
+        shape = list(templates.shape)
+        shape[1] = missing
+        templates = np.concatenate([templates, np.ones(shape, dtype=templates.dtype)], axis=1)
+        H = np.concatenate([H, np.ones((missing, H.shape[1]), dtype=H.dtype)], axis=0)
+    return templates, H
+
+def config_distance(params, neighbour):
+    """
+        How far apart two configurations of the same sample are: a different template
+        adaptivity counts most, then the difference in added noise components, then in beta.
+    """
+    if str(params["beta"]) == str(neighbour["beta"]):
+        beta_distance = 0
+    else:
+        beta_distance = abs(float(params["beta"]) - float(neighbour["beta"]))
+    return (params["fixW"] != neighbour["fixW"], abs(int(params["addedCompW"]) - int(neighbour["addedCompW"])), beta_distance)
+
+def warm_start(cache, V, templates, params):
+    """
+        Starting point of a factorization taken from the solution of its predecessor in the
+        factorization cache, the configuration of the same spectrogram and templates given by
+        params["warm_start_from"] (see sweep.warm_start_chains).
+
+        Args:
+            cache (FactorizationCache) : The cache holding the finished factorizations.
+            V (np.ndarray) : The (noisy, compressed) spectrogram to factorize.
+            templates (np.ndarray) : W_init or P_init.
+            params (dict) : Dictionary of parameters, defined in main.py.
+
+        Returns:
+            (templates, H) : Starting templates and activations, see extend_components, or
+                None if params has no predecessor or its solution is not in the cache.
+    """
+    chain = params.get("warm_start_from")
+    if not chain:
+        return None
+    predecessor = dict(params, **dict(zip(NEIGHBOUR_KEYS, chain[0])))
+    predecessor["warm_start_from"] = chain[1:] or None
+    solution = cache.load(cache.key(V, templates, predecessor))
+    if solution is None:
+        return None
+    return extend_components(*solution, templates.shape[1], params["addedCompW"])
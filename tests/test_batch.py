@@ -0,0 +1,32 @@
+import numpy as np
+
+from batch import batched
+from benchmark import write_dataset, PARAMS
+
+class Labels:
+    P_init = np.ones((4, 2, 8))
+
+def test_batched_configurations():
+    params = {"nmf_type": "NMFD", "nmfd_levels": None, "stream_block": None}
+    assert batched(Labels(), params)
+    assert batched(Labels(), dict(params, nmf_type="NMF", nmfd_backend="fft"))
+    assert not batched(Labels(), dict(params, nmf_type="NMF", solver="hals"))
+    assert not batched(Labels(), dict(params, nmfd_levels=[(2, 10), (1, 5)]))
+    assert not batched(Labels(), dict(params, stream_block=64))
+    assert not batched(Labels(), dict(params, nmfd_backend="fft"))
+    assert not batched(Labels(), dict(params, warm_start_from=[["adaptive", 0, 0]]))
+
+def read_scores(data_folder, params, batch):
+    from reader import read_data
+    from onsets import evaluate_samples
+    return evaluate_samples(read_data(data_folder, params, batch=batch))[1]
+
+def test_factorize_samples_falls_back_for_kl(tmp_path):
+    write_dataset(str(tmp_path), 2, {"N": 200, "R": 3, "T": 10})
+    params = dict(PARAMS, nmf_type="NMF", convergence="kl")
+    assert np.array_equal(read_scores(str(tmp_path), params, True), read_scores(str(tmp_path), params, False))
+
+def test_factorize_samples_falls_back_for_hals(tmp_path):
+    write_dataset(str(tmp_path), 2, {"N": 200, "R": 3, "T": 10})
+    params = dict(PARAMS, nmf_type="NMF", solver="hals")
+    assert np.array_equal(read_scores(str(tmp_path), params, True), read_scores(str(tmp_path), params, False))
@@ -0,0 +1,23 @@
+import os
+import numpy as np
+
+from cache import FactorizationCache, LOW_WATER
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+def test_put_keeps_the_cache_within_its_bound(tmp_path):
+    W, H = np.ones((20, 3)), np.ones((3, 40))
+    cache = FactorizationCache(str(tmp_path), 20000)
+    for i in range(100):
+        cache.put(f"entry{i}", W, H)
+        assert directory_size(tmp_path) <= cache.max_bytes
+    assert cache.evictions > 0 and cache.total == directory_size(tmp_path)
+    assert cache.get("entry99") is not None and cache.get("entry0") is None
+
+def test_eviction_shrinks_to_the_low_water_mark(tmp_path):
+    W, H = np.ones((20, 3)), np.ones((3, 40))
+    cache = FactorizationCache(str(tmp_path), 20000)
+    while cache.evictions == 0:
+        cache.put(f"entry{cache.puts}", W, H)
+    assert directory_size(tmp_path) <= LOW_WATER * cache.max_bytes
@@ -0,0 +1,16 @@
+import numpy as np
+
+from benchmark import synthetic_patterns, synthetic_loop, PARAMS
+from nmfd import NMFD
+from multiresolution import multiresolutionNMFD
+
+def test_semi_alpha_rises_once_over_all_levels():
+    # two full-resolution levels must continue the semi-adaptive blend of a single NMFD run
+    P = synthetic_patterns(65, 3, 5, 0)
+    V, _ = synthetic_loop(P, 200, 0)
+    H_init = np.random.default_rng(0).random((3, V.shape[1]))
+    params = dict(PARAMS, nmf_type="NMFD", fixW="semi", beta=1, addedCompW=0, tolerance=0, nmfd_backend="direct")
+    _, P_levels, H_levels = multiresolutionNMFD(V, P, params, levels=[(1, 20), (1, 20)], H_init=H_init)
+    _, P_single, H_single = NMFD(V, P, dict(params, max_iter=40), H_init=H_init)
+    assert np.allclose(P_levels, P_single)
+    assert np.allclose(H_levels, H_single)
@@ -0,0 +1,17 @@
+import mido
+import numpy as np
+
+from onsetindex import parse_midi
+
+def test_parse_midi_plays_ticks_at_the_recording_bpm(tmp_path):
+    midi = mido.MidiFile(ticks_per_beat=96)
+    track = mido.MidiTrack()
+    track.append(mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(100), time=0))
+    track.append(mido.Message('note_on', note=36, velocity=100, time=96))
+    track.append(mido.MetaMessage('marker', text="fill", time=96))
+    track.append(mido.Message('note_on', note=38, velocity=100, time=96))
+    midi.tracks.append(track)
+    midi.save(tmp_path / "loop.mid")
+    ticks, tick_duration = parse_midi(str(tmp_path / "loop.mid"), 90)
+    assert np.array_equal(ticks[36], [96]) and np.array_equal(ticks[38], [288])
+    assert np.isclose(ticks[38][0] * tick_duration, 3 * 60 / 90)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from benchmark import synthetic_patterns, synthetic_loop, f_measure, PARAMS
+from nmf import NMF
+from nmfd import NMFD
+from streaming import stream_activations, log_compress, MIN_BLOCK_LAGS
+
+def offline_and_streamed(nmf_type, fixW, block, seed=0):
+    P = synthetic_patterns(129, 3, 5, seed)
+    V, onsets = synthetic_loop(P, 600, seed)
+    params = dict(PARAMS, nmf_type=nmf_type, fixW=fixW, beta=2)
+    templates = P if nmf_type == "NMFD" else P.mean(axis=2)
+    solver = NMFD if nmf_type == "NMFD" else NMF
+    H_offline = solver(log_compress(V), templates, dict(params))[2][:3]
+    H_streamed = stream_activations(V, templates, dict(params), block, transform=log_compress)[:3]
+    return H_offline, H_streamed, onsets
+
+@pytest.mark.parametrize("nmf_type, fixW, block", [("NMF", "adaptive", 100), ("NMFD", "fixed", 25 * 5), ("NMFD", "semi", 25 * 5)])
+def test_stream_matches_offline(nmf_type, fixW, block):
+    H_offline, H_streamed, onsets = offline_and_streamed(nmf_type, fixW, block)
+    assert H_streamed.shape == H_offline.shape
+    assert min(np.corrcoef(H_offline[r], H_streamed[r])[0, 1] for r in range(3)) > 0.9
+    assert f_measure(H_streamed, onsets, nmf_type) >= f_measure(H_offline, onsets, nmf_type) - 0.06
+
+def test_stream_rejects_short_and_adaptive_nmfd_blocks():
+    with pytest.raises(Exception):
+        offline_and_streamed("NMFD", "fixed", MIN_BLOCK_LAGS * 5 - 1)
+    with pytest.raises(Exception):
+        offline_and_streamed("NMFD", "adaptive", 300)
+    H_offline, H_streamed, onsets = offline_and_streamed("NMFD", "adaptive", 600)
+    assert np.allclose(H_offline, H_streamed)
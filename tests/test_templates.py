@@ -0,0 +1,27 @@
+import numpy as np
+
+from Instrument import Instrument, EPS
+from templatebank import stack_patterns
+
+def instrument_with(Y):
+    instrument = Instrument.__new__(Instrument)
+    instrument.Y = Y
+    return instrument
+
+def test_template_2D_pads_to_T():
+    Y = np.arange(1, 13, dtype=np.float64).reshape(4, 3)
+    template2D = instrument_with(Y).template_2D(7)
+    assert template2D.shape == (4, 7)
+    assert np.array_equal(template2D[:, :3], Y)
+    assert np.all(template2D[:, 3:] == EPS)
+
+def test_template_2D_keeps_longer_templates():
+    Y = np.ones((4, 5))
+    assert instrument_with(Y).template_2D(3) is Y
+
+def test_stack_patterns_pads_to_longest_and_T():
+    Ys = [np.ones((2, 3)), np.ones((2, 5))]
+    assert stack_patterns(Ys, np.float64).shape == (2, 2, 5)
+    P = stack_patterns(Ys, np.float32, T=8)
+    assert P.shape == (2, 2, 8) and P.dtype == np.float32
+    assert np.all(P[:, 0, 3:] == np.float32(EPS)) and np.all(P[:, 1, :5] == 1)
@@ -0,0 +1,22 @@
+import numpy as np
+
+from nmf import NMF
+from sweep import warm_start_chains
+
+def test_fixed_templates_ignore_warm_start():
+    rng = np.random.default_rng(0)
+    V, W_init = rng.random((6, 20)), rng.random((6, 2))
+    W_start = rng.random((6, 3))
+    for solver in ["multiplicative", "hals"]:
+        params = {"fixW": "fixed", "beta": float('inf'), "addedCompW": 1, "solver": solver, "max_iter": 5}
+        V_approx, W, H = NMF(V, W_init, params, W_start=W_start)
+        assert np.allclose(W[:, :2], W_init)
+
+def test_warm_start_chains_follow_config_order():
+    base = {"nmf_type": "NMF", "warm_start": True, "beta": 0, "fixW": "adaptive"}
+    configs = [dict(base, addedCompW=addedCompW) for addedCompW in [0, 2, 3]]
+    configs.append(dict(base, addedCompW=0, nmf_type="NMFD"))
+    chained, predecessors = warm_start_chains(configs)
+    assert predecessors == [None, 0, 1, None]
+    assert chained[2]["warm_start_from"] == [["adaptive", 0, 2], ["adaptive", 0, 0]]
+    assert chained[3]["warm_start_from"] is None and "warm_start_from" not in configs[0]